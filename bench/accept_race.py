@@ -0,0 +1,98 @@
+# Races concurrent accepts of conflicting trades against a running stack.
+#
+# 100 senders each offer their own game for the receiver's single "Contested" game, then the
+# receiver accepts all 100 trades at once from 100 threads. Exactly one accept may win, and no
+# game may be duplicated or lost.
+#
+# Usage: python bench/accept_race.py [--base-url http://localhost:8080] [--threads 100]
+
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+def call(base_url: str, method: str, path: str, body: dict | None = None, jwt: str | None = None) -> tuple[int, dict]:
+    headers: dict[str, str] = {"Content-Type": "application/json"}
+    if jwt is not None:
+        headers["Authorization"] = f"Bearer {jwt}"
+
+    data: bytes | None = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(f"{base_url}{path}", data=data, headers=headers, method=method)
+
+    try:
+        with urllib.request.urlopen(request) as resp:
+            return resp.status, json.loads(resp.read() or b"{}")
+
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+def new_user(base_url: str, email: str, game: str) -> str:
+    call(base_url, "POST", "/api/register", {
+        "name": email, "email": email, "password": "password123", "street_address": "1 Race St"
+    })
+
+    _, login = call(base_url, "POST", "/api/login", {"email": email, "password": "password123"})
+    jwt: str = login["jwt"]
+
+    call(base_url, "POST", "/api/games", {
+        "name": game, "publisher": "Race", "year": 2000, "platform": "PC", "condition": "Good"
+    }, jwt)
+
+    return jwt
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://localhost:8080")
+    parser.add_argument("--threads", type=int, default=100)
+    args = parser.parse_args()
+
+    run_id: int = int(time.time())
+
+    receiver_email: str = f"receiver-{run_id}@test.com"
+    receiver_jwt: str = new_user(args.base_url, receiver_email, "Contested")
+
+    sender_jwts: list[str] = []
+    trade_ids: list[str] = []
+
+    for i in range(args.threads):
+        sender_jwt: str = new_user(args.base_url, f"sender-{run_id}-{i}@test.com", f"Offered-{i}")
+        sender_jwts.append(sender_jwt)
+
+        _, trade = call(args.base_url, "POST", "/api/trades", {
+            "receiver": receiver_email,
+            "offered_game": f"Offered-{i}",
+            "requested_game": "Contested"
+        }, sender_jwt)
+
+        trade_ids.append(trade["trade_id"])
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        statuses: list[int] = list(pool.map(
+            lambda trade_id: call(args.base_url, "POST", f"/api/trades/accept/{trade_id}", jwt=receiver_jwt)[0],
+            trade_ids
+        ))
+
+    accepted: int = statuses.count(200)
+
+    _, receiver = call(args.base_url, "GET", "/api/self", jwt=receiver_jwt)
+    receiver_games: set[str] = set(receiver["games"])
+
+    holders_of_contested: int = 0
+    for sender_jwt in sender_jwts:
+        _, sender = call(args.base_url, "GET", "/api/self", jwt=sender_jwt)
+        holders_of_contested += "Contested" in sender["games"]
+
+    print(f"accepted={accepted} rejected={len(statuses) - accepted}")
+    print(f"receiver games={sorted(receiver_games)} senders holding 'Contested'={holders_of_contested}")
+
+    assert accepted == 1, "Exactly one conflicting accept should win!"
+    assert holders_of_contested == 1 and "Contested" not in receiver_games, "'Contested' was duplicated or lost!"
+    assert len(receiver_games) == 1, "Receiver should hold exactly the one game they traded for!"
+
+    print("OK")
+
+if __name__ == "__main__":
+    main()
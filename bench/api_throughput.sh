@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# Fixed concurrency throughput benchmark for the authenticated read path.
+# Run it once against a build of the previous commit and once against the current one
+# and compare the "Requests/sec" lines.
+#
+# Requires `hey` (https://github.com/rakyll/hey) and `jq`
+
+BASE_URL="${BASE_URL:-http://localhost:8080}"
+CONCURRENCY="${CONCURRENCY:-64}"
+REQUESTS="${REQUESTS:-20000}"
+
+EMAIL="bench-$(date +%s)@test.com"
+
+echo "=== Registering benchmark user '$EMAIL' ==="
+curl -s -X POST "$BASE_URL/api/register" \
+  -H "Content-Type: application/json" \
+  -d "{\"name\":\"Bench\",\"email\":\"$EMAIL\",\"password\":\"password123\",\"street_address\":\"1 Bench St\"}" > /dev/null
+
+JWT=$(curl -s -X POST "$BASE_URL/api/login" \
+  -H "Content-Type: application/json" \
+  -d "{\"email\":\"$EMAIL\",\"password\":\"password123\"}" | jq -r '.jwt')
+
+curl -s -X POST "$BASE_URL/api/games" \
+  -H "Content-Type: application/json" \
+  -H "Authorization: Bearer $JWT" \
+  -d '{"name":"Halo","publisher":"Bungie","year":2001,"platform":"Xbox","condition":"Good"}' > /dev/null
+
+for endpoint in "/api/self" "/api/games/Halo" "/api/trades"; do
+  echo ""
+  echo "=== GET $endpoint (c=$CONCURRENCY, n=$REQUESTS) ==="
+  hey -n "$REQUESTS" -c "$CONCURRENCY" \
+    -H "Authorization: Bearer $JWT" \
+    "$BASE_URL$endpoint" | grep -E "Requests/sec|Average|99%"
+done
@@ -0,0 +1,104 @@
+# Encode/decode cost and size of a cached user for each cache format, at 10, 100 and 1000 games.
+#
+# Sizes are the encoded value's length, plus what Redis reports (MEMORY USAGE) for the user's whole
+# cache entry when --redis-host is given.
+#
+# Usage: python bench/cache_codec.py [--seconds 0.5] [--games 10,100,1000] [--redis-host localhost]
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from models.cache_codec import CacheCodec, CacheFormat
+
+import redis
+
+PUBLISHERS: list[str] = ["Nintendo", "Sony Interactive Entertainment", "Microsoft", "Capcom", "Square Enix", "Sega"]
+PLATFORMS: list[str] = ["Switch", "PlayStation 5", "Xbox Series X", "PC"]
+CONDITIONS: list[str] = ["mint", "good", "fair", "poor"]
+
+def make_user(games: int) -> dict:
+    rng: random.Random = random.Random(games)
+
+    return {
+        "name": "Alice",
+        "email": "alice@test.com",
+        "password": "hunter2",
+        "street_address": "1 Main St, Springfield",
+        "version": 42,
+        "games": {
+            f"Game Title {seq}": {
+                "name": f"Game Title {seq}",
+                "publisher": rng.choice(PUBLISHERS),
+                "year": str(rng.randint(1985, 2025)),
+                "platform": rng.choice(PLATFORMS),
+                "condition": rng.choice(CONDITIONS)
+            }
+            for seq in range(games)
+        }
+    }
+
+# NOTE: What was cached before, a JSON string with no format byte
+def legacy_encode(value: dict) -> bytes:
+    return json.dumps(value).encode("utf-8")
+
+def per_op_us(op, seconds: float) -> float:
+    ops: int = 0
+    deadline: float = time.perf_counter() + seconds
+
+    start: float = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for _ in range(10):
+            op()
+        ops += 10
+
+    return (time.perf_counter() - start) / ops * 1e6
+
+def redis_bytes(cache: redis.Redis | None, encoded: bytes) -> str:
+    if cache is None:
+        return "-"
+
+    # NOTE: Stored the same way Users stores it, a hash of the version and the data
+    cache.hset("bench:cache-codec", mapping={"ver": 42, "data": encoded})
+    used: int = cache.memory_usage("bench:cache-codec", samples=0)
+    cache.delete("bench:cache-codec")
+
+    return str(used)
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=0.5)
+    parser.add_argument("--games", default="10,100,1000")
+    parser.add_argument("--redis-host", default=None)
+    args = parser.parse_args()
+
+    cache: redis.Redis | None = redis.Redis(host=args.redis_host, port=6379) if args.redis_host else None
+
+    print(f"{'games':>5} {'format':<14} {'bytes':>8} {'redis':>8} {'encode':>10} {'decode':>10}")
+    for games in [int(games) for games in args.games.split(",")]:
+        user: dict = make_user(games)
+
+        codecs: list[tuple[str, object, object]] = [("legacy json", legacy_encode, json.loads)]
+        for cache_format in CacheFormat:
+            codec: CacheCodec = CacheCodec(cache_format)
+            codecs.append((cache_format.name.lower(), codec.encode, codec.decode))
+
+        for label, encode, decode in codecs:
+            encoded: bytes = encode(user)
+            assert decode(encoded) == user, f"{label} didn't round trip!"
+
+            encode_us: float = per_op_us(lambda: encode(user), args.seconds)
+            decode_us: float = per_op_us(lambda: decode(encoded), args.seconds)
+
+            print(
+                f"{games:5} {label:<14} {len(encoded):8} {redis_bytes(cache, encoded):>8} "
+                f"{encode_us:8.1f}us {decode_us:8.1f}us"
+            )
+
+if __name__ == "__main__":
+    main()
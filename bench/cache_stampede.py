@@ -0,0 +1,123 @@
+# Mongo reads when a popular user's cache entry expires under load, with and without stampede
+# protection, plus Mongo reads for repeated lookups of an unknown email.
+#
+# Runs two `Users` stores side by side (as two API replicas would) against a real Redis, with a
+# stand-in Mongo collection that counts queries and takes --mongo-ms to answer each one. The
+# user's entry is expired on both tiers at once and --requests concurrent lookups are fired at it.
+#
+# Usage: python bench/cache_stampede.py [--redis-host localhost] [--requests 500] [--mongo-ms 20]
+#                                       [--unknown-lookups 200]
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from models.users import Users
+
+from redis.asyncio import Redis
+
+EMAIL: str = "popular@test.com"
+UNKNOWN_EMAIL: str = "nobody@test.com"
+
+class StandInUsersCollection:
+    def __init__(self, latency_s: float) -> None:
+        self.latency_s: float = latency_s
+        self.queries: int = 0
+
+        self.docs: dict[str, dict] = {
+            EMAIL: {
+                "_id": EMAIL,
+                "name": "Popular",
+                "email": EMAIL,
+                "password": "pw",
+                "street_address": "1 Main St",
+                "games": {},
+                "version": 1
+            }
+        }
+
+    async def find_one(self, query: dict) -> dict | None:
+        self.queries += 1
+        await asyncio.sleep(self.latency_s)
+
+        doc: dict | None = self.docs.get(query["_id"])
+        return dict(doc) if doc is not None else None
+
+# NOTE: What every miss did before, go straight to Mongo
+class UnprotectedFill:
+    async def fill(self, key, load, read_cached):
+        return await load()
+
+    def should_refresh_early(self, ttl_s: float) -> bool:
+        return False
+
+class BenchUsers(Users):
+    def __init__(self, collection: StandInUsersCollection, protected: bool) -> None:
+        super().__init__(logging.getLogger("bench"))
+
+        self.users = collection
+        if not protected:
+            self.cache_fill = UnprotectedFill()
+
+async def expire(users: list[BenchUsers], redis: Redis, email: str) -> None:
+    await redis.delete(f"user:v2:{email}")
+
+    for replica in users:
+        replica.local_cache.clear()
+
+async def stampede(args: argparse.Namespace, redis: Redis, protected: bool) -> None:
+    collection: StandInUsersCollection = StandInUsersCollection(args.mongo_ms / 1000)
+    replicas: list[BenchUsers] = [BenchUsers(collection, protected) for _ in range(2)]
+
+    # NOTE: Warm, then expire the entry everywhere at the same moment
+    await replicas[0].get_user(EMAIL)
+    await expire(replicas, redis, EMAIL)
+    collection.queries = 0
+
+    start: float = time.perf_counter()
+    found: list = await asyncio.gather(*(
+        replicas[seq % len(replicas)].get_user(EMAIL) for seq in range(args.requests)
+    ))
+    elapsed: float = time.perf_counter() - start
+
+    assert all(user is not None and user.email == EMAIL for user in found), "Lookup returned the wrong user!"
+
+    print(
+        f"protected={str(protected):<5} {args.requests} concurrent lookups after expiry: "
+        f"{collection.queries:4} Mongo reads ({collection.queries / elapsed:7.0f} reads/s) in {elapsed * 1000:6.1f}ms"
+    )
+
+async def unknown_lookups(args: argparse.Namespace, redis: Redis) -> None:
+    collection: StandInUsersCollection = StandInUsersCollection(args.mongo_ms / 1000)
+    replicas: list[BenchUsers] = [BenchUsers(collection, protected=True) for _ in range(2)]
+    await expire(replicas, redis, UNKNOWN_EMAIL)
+
+    for seq in range(args.unknown_lookups):
+        assert await replicas[seq % len(replicas)].get_user(UNKNOWN_EMAIL) is None, "Unknown user was found!"
+
+    print(f"{args.unknown_lookups} lookups of an unknown email: {collection.queries} Mongo reads (was {args.unknown_lookups})")
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--mongo-ms", type=float, default=20.0)
+    parser.add_argument("--unknown-lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    BenchUsers.REDIS_HOST = args.redis_host
+    redis: Redis = Redis(host=args.redis_host, port=6379, decode_responses=True)
+
+    for protected in (False, True):
+        await stampede(args, redis, protected)
+
+    await unknown_lookups(args, redis)
+    await redis.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+# Consumer throughput with per message commits vs batched commits against a local broker stand-in.
+#
+# The stand-in serves pre-built notification records from memory and charges `--commit-rtt-ms`
+# for every synchronous commit, emails are built but not sent so only the consume + commit
+# path is measured. A batch size of 1 is the old commit-per-message behaviour.
+#
+# Usage: python bench/consumer_batching.py [--notifs 5000] [--commit-rtt-ms 2] [--batch-sizes 1,50,500]
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "email-service"))
+
+import email_notif_consumer
+from email_notif_consumer import EmailNotifConsumer
+
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import TopicPartition, OffsetAndMetadata
+
+TOPIC_PARTITION: TopicPartition = TopicPartition("email-notifs", 0)
+
+# NOTE: Raised once every record has been committed, a BaseException so that the consumer's
+# own `except Exception` doesn't swallow it
+class Drained(BaseException):
+    pass
+
+class StandInBroker:
+    def __init__(self, notifs: int, commit_rtt_s: float) -> None:
+        self.commit_rtt_s: float = commit_rtt_s
+        self.commits: int = 0
+
+        self.records: list[ConsumerRecord] = [
+            ConsumerRecord(
+                TOPIC_PARTITION.topic, TOPIC_PARTITION.partition, -1, offset, int(time.time() * 1000), 0, None,
+                json.dumps({
+                    "type": "trade_offer_accepted",
+                    "trade_id": str(offset),
+                    "sender_info": ["Alice", f"alice{offset % 100}@test.com", "pw"],
+                    "receiver_info": ["Bob", f"bob{offset % 100}@test.com", "pw"],
+                    "games": ["Halo", "Doom"]
+                }).encode("utf-8"),
+                [], None, -1, -1, -1
+            )
+            for offset in range(notifs)
+        ]
+
+        self.next_offset: int = 0
+
+    def poll(self, timeout_ms: int, max_records: int) -> dict[TopicPartition, list[ConsumerRecord]]:
+        batch: list[ConsumerRecord] = self.records[self.next_offset:self.next_offset + max_records]
+        self.next_offset += len(batch)
+
+        return {TOPIC_PARTITION: batch} if batch else {}
+
+    def assignment(self) -> set[TopicPartition]:
+        return {TOPIC_PARTITION}
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return len(self.records)
+
+    def position(self, tp: TopicPartition) -> int:
+        return self.next_offset
+
+    def commit(self, offsets: dict[TopicPartition, OffsetAndMetadata]) -> None:
+        time.sleep(self.commit_rtt_s)
+        self.commits += 1
+
+        if offsets[TOPIC_PARTITION].offset == len(self.records):
+            raise Drained()
+
+# NOTE: Nothing is dead lettered here, this just keeps the consumer from connecting to a real broker
+class StandInDeadLetters:
+    def __init__(self, logger: logging.Logger) -> None:
+        pass
+
+email_notif_consumer.DeadLetterQueue = StandInDeadLetters
+
+class BenchConsumer(EmailNotifConsumer):
+    broker: StandInBroker
+
+    # NOTE: Every email is flushed straight through, holding or throttling them would only
+    # measure the window and the rate limits
+    COALESCE_WINDOW_S = 0.0
+    SMTP_HOST_RATE_PER_S = 1e9
+    SMTP_HOST_BURST = 1_000_000
+    RECIPIENT_RATE_PER_S = 1e9
+    RECIPIENT_BURST = 1_000_000
+
+    def _new_consumer(self) -> StandInBroker:
+        return self.broker
+
+def run(notifs: int, batch_size: int, commit_rtt_s: float) -> tuple[float, int]:
+    BenchConsumer.broker = StandInBroker(notifs, commit_rtt_s)
+
+    consumer: BenchConsumer = BenchConsumer(
+        logging.getLogger("bench"),
+        batch_max_records=batch_size,
+        batch_timeout_ms=0
+    )
+    consumer.dispatcher.send = lambda notif_email: None
+
+    start: float = time.perf_counter()
+    try:
+        consumer.start_consuming_notifs()
+
+    except Drained:
+        pass
+
+    elapsed: float = time.perf_counter() - start
+    consumer.dispatcher.shutdown()
+
+    return elapsed, BenchConsumer.broker.commits
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notifs", type=int, default=5000)
+    parser.add_argument("--commit-rtt-ms", type=float, default=2.0)
+    parser.add_argument("--batch-sizes", default="1,50,500")
+    args = parser.parse_args()
+
+    for batch_size in (int(size) for size in args.batch_sizes.split(",")):
+        elapsed, commits = run(args.notifs, batch_size, args.commit_rtt_ms / 1000)
+        print(f"batch={batch_size:<4} {args.notifs} notifs in {elapsed:6.2f}s -> {args.notifs / elapsed:9.1f} notifs/s ({commits} commits)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Time and memory for turning a cached user document into a `User` (`Users._dict_to_user`), at 10,
+# 100 and 1000 games, eagerly building every `Game` (as before) vs the slotted, lazy models.
+#
+# Time is measured for the conversion alone and for a typical request that then looks at one game.
+# Memory is what each converted user holds on to beyond the cached document it was built from.
+#
+# Usage: python bench/dict_to_user.py [--seconds 0.5] [--games 10,100,1000] [--users 200]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from models.user import User
+
+# NOTE: What the models looked like before, a `__dict__` per instance and every game built up front
+class EagerGame:
+    def __init__(self, name: str, publisher: str, year: int, platform: str, condition: str) -> None:
+        self.name: str      = name
+        self.publisher: str = publisher
+        self.year: int      = year
+        self.platform: str  = platform
+        self.condition: str = condition
+
+class EagerUser:
+    def __init__(self, name: str, email: str, password: str, street_address: str, games: dict) -> None:
+        self.name: str = name
+        self.email: str = email
+        self.password: str = password
+        self.street_address: str = street_address
+        self.games: dict[str, EagerGame] = games
+
+    def get_game(self, name: str) -> EagerGame | None:
+        return self.games.get(name)
+
+def eager_dict_to_user(data: dict) -> EagerUser:
+    games: dict[str, EagerGame] = {
+        title: EagerGame(
+            name=title,
+            publisher=str(g["publisher"]),
+            year=int(g["year"]),
+            platform=str(g["platform"]),
+            condition=str(g["condition"])
+        )
+        for title, g in data.get("games", {}).items()
+    }
+
+    return EagerUser(data["name"], data["email"], data["password"], data["street_address"], games)
+
+def make_user_doc(games: int) -> dict:
+    rng: random.Random = random.Random(games)
+
+    return {
+        "name": "Alice",
+        "email": "alice@test.com",
+        "password": "hunter2",
+        "street_address": "1 Main St, Springfield",
+        "version": 42,
+        "games": {
+            f"Game Title {seq}": {
+                "name": f"Game Title {seq}",
+                "publisher": rng.choice(["Nintendo", "Sony", "Microsoft", "Capcom"]),
+                "year": str(rng.randint(1985, 2025)),
+                "platform": rng.choice(["Switch", "PlayStation 5", "Xbox Series X", "PC"]),
+                "condition": rng.choice(["mint", "good", "fair", "poor"])
+            }
+            for seq in range(games)
+        }
+    }
+
+def per_op_us(op, seconds: float) -> float:
+    ops: int = 0
+    deadline: float = time.perf_counter() + seconds
+
+    start: float = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for _ in range(10):
+            op()
+        ops += 10
+
+    return (time.perf_counter() - start) / ops * 1e6
+
+def retained_bytes(convert, doc: dict, users: int) -> float:
+    tracemalloc.start()
+    before: int = tracemalloc.get_traced_memory()[0]
+
+    converted: list = [convert(doc) for _ in range(users)]
+    after: int = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+    del converted
+
+    return (after - before) / users
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=0.5)
+    parser.add_argument("--games", default="10,100,1000")
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'games':>5} {'models':<7} {'convert':>10} {'+get_game':>10} {'retained':>12}")
+    for games in [int(games) for games in args.games.split(",")]:
+        doc: dict = make_user_doc(games)
+        wanted: str = f"Game Title {games // 2}"
+
+        for label, convert in (("eager", eager_dict_to_user), ("lazy", User.from_dict)):
+            assert convert(doc).get_game(wanted).condition == doc["games"][wanted]["condition"], "Wrong game!"
+
+            convert_us: float = per_op_us(lambda: convert(doc), args.seconds)
+            request_us: float = per_op_us(lambda: convert(doc).get_game(wanted), args.seconds)
+
+            print(
+                f"{games:5} {label:<7} {convert_us:8.2f}us {request_us:8.2f}us "
+                f"{retained_bytes(convert, doc, args.users):10.0f}B"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# Email dispatch throughput against a local stand-in SMTP server with injected latency.
+#
+# Compares a single dispatch lane (i.e. the old one-notification-at-a-time consumer) against the
+# concurrent lanes, and checks that every recipient still receives their emails in order.
+#
+# Usage: python bench/email_dispatch.py [--notifs 200] [--latency-ms 50] [--lanes 16]
+
+import os
+import sys
+import time
+import smtplib
+import logging
+import argparse
+import threading
+import socketserver
+
+from typing import Callable
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "email-service"))
+
+from emailer import NotifEmail
+from notif_dispatcher import NotifDispatcher
+
+from kafka.structs import TopicPartition
+
+# NOTE: Just enough SMTP for smtplib to deliver a message, every command is delayed by `latency`
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    latency: float = 0.0
+    received: list[tuple[str, str]] = []
+    received_lock: threading.Lock = threading.Lock()
+
+    def reply(self, line: str) -> None:
+        time.sleep(self.latency)
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self) -> None:
+        self.reply("220 stand-in ESMTP")
+
+        recipient: str = ""
+        while True:
+            line: str = self.rfile.readline().decode("utf-8", errors="replace").strip()
+            command: str = line[:4].upper()
+
+            if command in ("EHLO", "HELO"):
+                self.reply("250 stand-in")
+
+            elif command == "RCPT":
+                recipient = line.split(":", 1)[1].strip(" <>")
+                self.reply("250 OK")
+
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+
+                subject: str = ""
+                while (data_line := self.rfile.readline().decode("utf-8", errors="replace")) != ".\r\n":
+                    if data_line.startswith("Subject: "):
+                        subject = data_line[len("Subject: "):].strip()
+
+                with self.received_lock:
+                    self.received.append((recipient, subject))
+
+                self.reply("250 OK")
+
+            elif command == "QUIT" or not line:
+                self.reply("221 Bye")
+                return
+
+            else:
+                self.reply("250 OK")
+
+def send_to_stand_in(port: int) -> Callable[[list[NotifEmail]], None]:
+    def _send(notif_emails: list[NotifEmail]) -> None:
+        notif_email: NotifEmail = notif_emails[0]
+
+        msg: EmailMessage = EmailMessage()
+        msg["From"] = "noreply@email-service.com"
+        msg["To"] = notif_email.email
+        msg["Subject"] = notif_email.subject
+        msg.set_content(notif_email.body)
+
+        with smtplib.SMTP("127.0.0.1", port, timeout=15) as smtp_server:
+            smtp_server.send_message(msg)
+
+    return _send
+
+def dead_letter(notif_email: NotifEmail, reason: str, attempts: int) -> None:
+    raise AssertionError(f"Email to {notif_email.email} failed! Reason: {reason}")
+
+def run(port: int, lanes: int, notifs: int, recipients: int) -> float:
+    StandInSMTPHandler.received = []
+
+    dispatcher: NotifDispatcher = NotifDispatcher(
+        logging.getLogger("bench"),
+        send=send_to_stand_in(port),
+        lanes=lanes,
+        max_in_flight=256,
+        max_attempts=1,
+        retry_base_delay_s=1.0,
+        retry_max_delay_s=1.0,
+        coalesce_window_s=0.0,
+        coalesce_max_delay_s=0.0,
+        coalesce_max_batch=1,
+        smtp_host="127.0.0.1",
+        host_rate_per_s=1e9,
+        host_burst=1_000_000,
+        recipient_rate_per_s=1e9,
+        recipient_burst=1_000_000
+    )
+
+    tp: TopicPartition = TopicPartition("email-notifs", 0)
+
+    start: float = time.perf_counter()
+    for offset in range(notifs):
+        dispatcher.submit(tp, offset, [
+            NotifEmail(f"user{offset % recipients}@test.com", "", f"{offset}-sender", "body"),
+            NotifEmail(f"user{(offset + 1) % recipients}@test.com", "", f"{offset}-receiver", "body"),
+        ], produced_at=time.time(), dead_letter=dead_letter)
+
+    dispatcher.shutdown()
+    elapsed: float = time.perf_counter() - start
+
+    committed = dispatcher.pop_committable()[tp].offset
+    assert committed == notifs, f"Expected offset {notifs} to be committable, got {committed}!"
+
+    # NOTE: Each recipient must have received their emails in offset order
+    last_seen: dict[str, int] = {}
+    for recipient, subject in StandInSMTPHandler.received:
+        offset: int = int(subject.split("-")[0])
+        assert last_seen.get(recipient, -1) <= offset, f"Emails to {recipient} were reordered!"
+        last_seen[recipient] = offset
+
+    return elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notifs", type=int, default=200)
+    parser.add_argument("--recipients", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--lanes", type=int, default=16)
+    args = parser.parse_args()
+
+    StandInSMTPHandler.latency = args.latency_ms / 1000
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StandInSMTPHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    port: int = server.server_address[1]
+    emails: int = args.notifs * 2
+
+    for lanes in (1, args.lanes):
+        elapsed: float = run(port, lanes, args.notifs, args.recipients)
+        print(f"lanes={lanes:<3} {emails} emails in {elapsed:6.2f}s -> {emails / elapsed:8.1f} emails/s")
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Sends a burst of emails through the dispatcher's rate limits and checks how they come out.
+#
+# Every email must be sent (queued, never dropped), the SMTP host must never see more than its
+# burst plus its rate in any one second, the hot recipient must be held to its own limit, every
+# recipient's emails must still go out in order, and the hot recipient's queue must not hold up
+# anyone else (every other recipient's emails go out as fast as the host limit alone allows).
+#
+# Usage: python bench/email_rate_limit.py [--emails 300] [--host-rate 50] [--host-burst 20]
+#                                         [--recipient-rate 2] [--recipient-burst 3]
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "email-service"))
+
+from emailer import NotifEmail
+from notif_dispatcher import NotifDispatcher
+
+from kafka.structs import TopicPartition
+
+HOT_RECIPIENT: str = "hot@test.com"
+
+class RecordingSend:
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.sent: list[tuple[float, str, int]] = []
+
+    def __call__(self, notif_emails: list[NotifEmail]) -> None:
+        now: float = time.perf_counter()
+
+        with self.lock:
+            for notif_email in notif_emails:
+                self.sent.append((now, notif_email.email, int(notif_email.subject)))
+
+def dead_letter(notif_email: NotifEmail, reason: str, attempts: int) -> None:
+    raise AssertionError(f"Email to {notif_email.email} failed! Reason: {reason}")
+
+def max_in_any_second(times: list[float]) -> int:
+    most: int = 0
+    start: int = 0
+    for end in range(len(times)):
+        while times[end] - times[start] >= 1.0:
+            start += 1
+        most = max(most, end - start + 1)
+
+    return most
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=300)
+    parser.add_argument("--recipients", type=int, default=100)
+    parser.add_argument("--hot-share", type=float, default=0.05)
+    parser.add_argument("--host-rate", type=float, default=50.0)
+    parser.add_argument("--host-burst", type=int, default=20)
+    parser.add_argument("--recipient-rate", type=float, default=2.0)
+    parser.add_argument("--recipient-burst", type=int, default=3)
+    args = parser.parse_args()
+
+    send: RecordingSend = RecordingSend()
+
+    dispatcher: NotifDispatcher = NotifDispatcher(
+        logging.getLogger("bench"),
+        send=send,
+        lanes=16,
+        max_in_flight=args.emails,
+        max_attempts=1,
+        retry_base_delay_s=1.0,
+        retry_max_delay_s=1.0,
+        coalesce_window_s=0.0,
+        coalesce_max_delay_s=0.0,
+        coalesce_max_batch=1,
+        smtp_host="stand-in",
+        host_rate_per_s=args.host_rate,
+        host_burst=args.host_burst,
+        recipient_rate_per_s=args.recipient_rate,
+        recipient_burst=args.recipient_burst
+    )
+
+    tp: TopicPartition = TopicPartition("email-notifs", 0)
+    hot_every: int = max(1, round(1 / args.hot_share))
+
+    # NOTE: The hot recipient's emails lead the burst, so their queue is already backed up by the
+    # time everyone else's emails arrive
+    recipients: list[str] = [HOT_RECIPIENT] * (args.emails // hot_every) + [
+        f"user{seq % args.recipients}@test.com" for seq in range(args.emails - args.emails // hot_every)
+    ]
+
+    # NOTE: The whole burst arrives at once
+    start: float = time.perf_counter()
+    for seq, recipient in enumerate(recipients):
+        dispatcher.submit(tp, seq, [NotifEmail(recipient, "", str(seq), "body")], time.time(), dead_letter)
+
+    # NOTE: Everyone else's emails drain at the host's rate, the hot recipient's throttled ones take
+    # their turn in the host's queue behind them and are then spaced at the recipient's rate
+    hot_emails: int = recipients.count(HOT_RECIPIENT)
+    cold_drain_s: float = max(0.0, (args.emails - hot_emails + args.recipient_burst - args.host_burst) / args.host_rate)
+    expected_s: float = cold_drain_s + max(0, hot_emails - args.recipient_burst) / args.recipient_rate
+
+    deadline: float = time.perf_counter() + expected_s + 10
+    while time.perf_counter() < deadline and len(send.sent) < args.emails:
+        time.sleep(0.05)
+
+    dispatcher.shutdown()
+    elapsed: float = max(sent_at for sent_at, _, _ in send.sent) - start
+
+    sent: list[tuple[float, str, int]] = sorted(send.sent)
+    host_peak: int = max_in_any_second([sent_at for sent_at, _, _ in sent])
+    hot_peak: int = max_in_any_second([sent_at for sent_at, recipient, _ in sent if recipient == HOT_RECIPIENT])
+
+    print(f"{len(sent)}/{args.emails} emails sent in {elapsed:.2f}s (at most ~{expected_s:.2f}s)")
+    print(f"host peak {host_peak}/s (limit {args.host_rate:g}/s + burst {args.host_burst})")
+    print(f"hot recipient peak {hot_peak}/s (limit {args.recipient_rate:g}/s + burst {args.recipient_burst})")
+
+    # NOTE: Only the hot recipient's burst can go ahead of everyone else, the rest of their emails
+    # wait on their own limit and must leave the host's tokens to the others
+    cold_wait_s: float = max(sent_at for sent_at, recipient, _ in sent if recipient != HOT_RECIPIENT) - start
+
+    print(f"other recipients done after {cold_wait_s:.2f}s (host limit alone allows ~{cold_drain_s:.2f}s)")
+
+    assert len(sent) == args.emails, "Emails were dropped!"
+    assert host_peak <= args.host_rate + args.host_burst, "SMTP host limit exceeded!"
+    assert hot_peak <= args.recipient_rate + args.recipient_burst, "Recipient limit exceeded!"
+    assert cold_wait_s <= cold_drain_s + 0.5, "Other recipients were held up behind the hot recipient!"
+
+    last_seen: dict[str, int] = {}
+    for _, recipient, seq in sent:
+        assert last_seen.get(recipient, -1) < seq, f"Emails to {recipient} were reordered!"
+        last_seen[recipient] = seq
+
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Emails rendered per second, ad-hoc f-strings + EmailMessage vs the precompiled templates.
+#
+# Renders the sender and receiver emails of a trade offer all the way to the bytes handed to
+# SMTP, and checks that both paths parse back to the same message.
+#
+# Usage: python bench/email_render.py [--seconds 2]
+
+import os
+import sys
+import time
+import argparse
+
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "email-service"))
+
+from mime import SENDER, render_mime
+from templates import TEMPLATES
+
+SENDER_INFO: tuple[str, str, str] = ("Alice", "alice@test.com", "pw")
+RECEIVER_INFO: tuple[str, str, str] = ("Bob", "bob@test.com", "pw")
+GAMES: tuple[str, str] = ("Halo", "Doom")
+TRADE_ID: str = "6f1c8a2e-31b4-4f7e-9d0a-1b2c3d4e5f60"
+
+# NOTE: What Emailer used to do for every trade offer
+def render_adhoc() -> list[bytes]:
+    sender_name, sender_email, _ = SENDER_INFO
+    receiver_name, receiver_email, _ = RECEIVER_INFO
+    offered_game, requested_game = GAMES
+
+    emails: list[tuple[str, str, str]] = [
+        (sender_email, "Trade offer processed", (
+            f"Hello, {sender_name}!\n"
+            f"We have received your trade offer of {offered_game} for {requested_game} from {receiver_name} | {receiver_email}!\n"
+            f"The trade ID of your trade offer is {TRADE_ID}!\n"
+            "Sincerely, ok\n"
+        )),
+        (receiver_email, "Trade offer received", (
+            f"Hello, {receiver_name}!\n"
+            f"You have received a trade offer from '{sender_name}/{sender_email}'!\n"
+            f"They have offered '{offered_game}' for '{requested_game}'!\n"
+            f"Use this trade ID: '/api/trades/accept/{TRADE_ID}' or '/api/trades/reject/{TRADE_ID}' to accept/reject the offer!\n"
+            "Sincerely, yeah whatever"
+        )),
+    ]
+
+    rendered: list[bytes] = []
+    for to, subject, body in emails:
+        msg: EmailMessage = EmailMessage()
+        msg["From"] = SENDER
+        msg["To"] = to
+        msg["Subject"] = subject
+        msg.set_content(body)
+
+        rendered.append(msg.as_bytes())
+
+    return rendered
+
+def render_templates(with_html: bool) -> list[bytes]:
+    sender_msg, receiver_msg = TEMPLATES["trade_offer_init"].render_pair({
+        "sender_name"    : SENDER_INFO[0],
+        "sender_email"   : SENDER_INFO[1],
+        "receiver_name"  : RECEIVER_INFO[0],
+        "receiver_email" : RECEIVER_INFO[1],
+        "offered_game"   : GAMES[0],
+        "requested_game" : GAMES[1],
+        "trade_id"       : TRADE_ID,
+    })
+
+    return [
+        render_mime(SENDER_INFO[1], sender_msg.subject, sender_msg.text, sender_msg.html if with_html else None),
+        render_mime(RECEIVER_INFO[1], receiver_msg.subject, receiver_msg.text, receiver_msg.html if with_html else None),
+    ]
+
+def plain_text(raw: bytes) -> tuple[str, str, str]:
+    msg = message_from_bytes(raw, policy=policy.default)
+    return msg["To"], msg["Subject"], msg.get_body(preferencelist=("plain",)).get_content().replace("\r\n", "\n").rstrip("\n")
+
+def rate(label: str, render, seconds: float) -> None:
+    emails: int = 0
+    deadline: float = time.perf_counter() + seconds
+
+    start: float = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            emails += len(render())
+
+    elapsed: float = time.perf_counter() - start
+    print(f"{label:<28} {emails / elapsed:10.0f} emails/s ({elapsed / emails * 1e6:7.2f}us/email)")
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    for adhoc, compiled, compiled_html in zip(render_adhoc(), render_templates(False), render_templates(True)):
+        assert plain_text(adhoc) == plain_text(compiled) == plain_text(compiled_html), "Rendered emails differ!"
+
+    rate("f-strings + EmailMessage", render_adhoc, args.seconds)
+    rate("templates, text", lambda: render_templates(False), args.seconds)
+    rate("templates, text + html", lambda: render_templates(True), args.seconds)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# SMTP sends saved by coalescing a spike of trade notifications, and the delay it adds.
+#
+# Replays a burst of trade notifications (two emails each) concentrated on a few popular
+# recipients through the dispatcher, once without coalescing and once with it, against a stand-in
+# send that only counts sends and records how long each email waited.
+#
+# Usage: python bench/notif_coalescing.py [--notifs 2000] [--recipients 20] [--spike-s 5]
+#                                         [--window-s 0.5] [--max-delay-s 2]
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "email-service"))
+
+from emailer import NotifEmail
+from notif_dispatcher import NotifDispatcher
+
+from kafka.structs import TopicPartition
+
+class CountingSend:
+    def __init__(self, submitted_at: dict[str, float]) -> None:
+        self.submitted_at: dict[str, float] = submitted_at
+        self.lock: threading.Lock = threading.Lock()
+
+        self.sends: int = 0
+        self.delays: list[float] = []
+
+    def __call__(self, notif_emails: list[NotifEmail]) -> None:
+        now: float = time.perf_counter()
+
+        with self.lock:
+            self.sends += 1
+            self.delays.extend(now - self.submitted_at[notif_email.subject] for notif_email in notif_emails)
+
+def dead_letter(notif_email: NotifEmail, reason: str, attempts: int) -> None:
+    raise AssertionError(f"Email to {notif_email.email} failed! Reason: {reason}")
+
+def run(args: argparse.Namespace, coalesce: bool) -> None:
+    submitted_at: dict[str, float] = {}
+    send: CountingSend = CountingSend(submitted_at)
+
+    dispatcher: NotifDispatcher = NotifDispatcher(
+        logging.getLogger("bench"),
+        send=send,
+        lanes=16,
+        max_in_flight=args.notifs,
+        max_attempts=1,
+        retry_base_delay_s=1.0,
+        retry_max_delay_s=1.0,
+        coalesce_window_s=args.window_s,
+        coalesce_max_delay_s=args.max_delay_s,
+        coalesce_max_batch=50,
+        smtp_host="stand-in",
+        host_rate_per_s=1e9,
+        host_burst=1_000_000,
+        recipient_rate_per_s=1e9,
+        recipient_burst=1_000_000
+    )
+
+    tp: TopicPartition = TopicPartition("email-notifs", 0)
+    rng: random.Random = random.Random(0)
+
+    # NOTE: Popularity is skewed, a handful of recipients get most of the trades
+    weights: list[float] = [1 / (rank + 1) for rank in range(args.recipients)]
+    gap_s: float = args.spike_s / args.notifs
+
+    start: float = time.perf_counter()
+    for offset in range(args.notifs):
+        sender, receiver = rng.choices(range(args.recipients), weights=weights, k=2)
+
+        notif_emails: list[NotifEmail] = [
+            NotifEmail(f"user{sender}@test.com", "", f"{offset}-sender", "body"),
+            NotifEmail(f"user{receiver}@test.com", "", f"{offset}-receiver", "body"),
+        ]
+        for notif_email in notif_emails:
+            submitted_at[notif_email.subject] = time.perf_counter()
+
+        dispatcher.submit(tp, offset, notif_emails, time.time(), dead_letter, coalesce=coalesce)
+        time.sleep(max(0.0, start + (offset + 1) * gap_s - time.perf_counter()))
+
+    # NOTE: Wait for the coalescer to flush on its own, shutting down would flush it early
+    deadline: float = time.perf_counter() + args.max_delay_s + 5
+    while time.perf_counter() < deadline and len(send.delays) < args.notifs * 2:
+        time.sleep(0.05)
+
+    dispatcher.shutdown()
+
+    emails: int = len(send.delays)
+    send.delays.sort()
+    p99: float = send.delays[int(emails * 0.99) - 1]
+
+    print(
+        f"coalesce={str(coalesce):<5} {emails} emails in {send.sends:5} sends "
+        f"(ratio {emails / send.sends:5.2f}x), added delay p99={p99 * 1000:7.1f}ms max={send.delays[-1] * 1000:7.1f}ms"
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notifs", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=20)
+    parser.add_argument("--spike-s", type=float, default=5.0)
+    parser.add_argument("--window-s", type=float, default=0.5)
+    parser.add_argument("--max-delay-s", type=float, default=2.0)
+    args = parser.parse_args()
+
+    for coalesce in (False, True):
+        run(args, coalesce)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/bin/bash
+
+# p99 latency of POST /api/trades, which publishes a trade offer notification on every call.
+# Run it once against a build of the previous commit (flush per message) and once against
+# the current one (fire and forget) and compare the "99%" lines.
+#
+# Requires `hey` (https://github.com/rakyll/hey) and `jq`
+
+BASE_URL="${BASE_URL:-http://localhost:8080}"
+CONCURRENCY="${CONCURRENCY:-32}"
+REQUESTS="${REQUESTS:-5000}"
+
+RUN_ID="$(date +%s)"
+
+register_with_game() {
+  local email="$1"
+  local game="$2"
+
+  curl -s -X POST "$BASE_URL/api/register" \
+    -H "Content-Type: application/json" \
+    -d "{\"name\":\"Bench\",\"email\":\"$email\",\"password\":\"password123\",\"street_address\":\"1 Bench St\"}" > /dev/null
+
+  local jwt
+  jwt=$(curl -s -X POST "$BASE_URL/api/login" \
+    -H "Content-Type: application/json" \
+    -d "{\"email\":\"$email\",\"password\":\"password123\"}" | jq -r '.jwt')
+
+  curl -s -X POST "$BASE_URL/api/games" \
+    -H "Content-Type: application/json" \
+    -H "Authorization: Bearer $jwt" \
+    -d "{\"name\":\"$game\",\"publisher\":\"Bench\",\"year\":2000,\"platform\":\"PC\",\"condition\":\"Good\"}" > /dev/null
+
+  echo "$jwt"
+}
+
+SENDER_JWT=$(register_with_game "sender-$RUN_ID@test.com" "Halo")
+register_with_game "receiver-$RUN_ID@test.com" "Doom" > /dev/null
+
+echo "=== POST /api/trades (c=$CONCURRENCY, n=$REQUESTS) ==="
+hey -n "$REQUESTS" -c "$CONCURRENCY" -m POST \
+  -H "Authorization: Bearer $SENDER_JWT" \
+  -T "application/json" \
+  -d "{\"receiver\":\"receiver-$RUN_ID@test.com\",\"offered_game\":\"Halo\",\"requested_game\":\"Doom\"}" \
+  "$BASE_URL/api/trades" | grep -E "Requests/sec|50%|99%"
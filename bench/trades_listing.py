@@ -0,0 +1,104 @@
+# Cache miss latency of the trade listing query over a large trades collection.
+#
+# Seeds a separate `video_game_exchange_bench.trades` collection and times the old listing
+# (two unindexed finds) against the new one (single $or over the compound indexes).
+#
+# Usage: python bench/trades_listing.py [--mongo-uri mongodb://localhost:27017/?directConnection=true] [--trades 1000000]
+
+import time
+import random
+import argparse
+import statistics
+
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.collection import Collection
+
+STATUSES: list[str] = ["PENDING", "ACCEPTED", "REJECTED"]
+
+PROJECTION: dict[str, int] = {
+    "sender_email": 1,
+    "receiver_email": 1,
+    "offered_game": 1,
+    "requested_game": 1,
+    "status": 1,
+    "created": 1,
+}
+
+def seed(trades: Collection, count: int, user_count: int) -> None:
+    trades.drop()
+
+    now: datetime = datetime.now(timezone.utc)
+    batch: list[dict] = []
+
+    for i in range(count):
+        sender: int = random.randrange(user_count)
+        receiver: int = (sender + random.randrange(1, user_count)) % user_count
+
+        batch.append({
+            "_id": f"trade-{i}",
+            "sender_email": f"user{sender}@test.com",
+            "receiver_email": f"user{receiver}@test.com",
+            "offered_game": f"game-{random.randrange(1000)}",
+            "requested_game": f"game-{random.randrange(1000)}",
+            "status": random.choice(STATUSES),
+            "created": now - timedelta(seconds=i)
+        })
+
+        if len(batch) == 10_000:
+            trades.insert_many(batch, ordered=False)
+            batch.clear()
+
+    if batch:
+        trades.insert_many(batch, ordered=False)
+
+def list_two_finds(trades: Collection, email: str) -> int:
+    incoming: list[dict] = list(trades.find({"receiver_email": email}))
+    outgoing: list[dict] = list(trades.find({"sender_email": email}))
+    return len(incoming) + len(outgoing)
+
+def list_single_or(trades: Collection, email: str) -> int:
+    cursor = trades.find(
+        {"$or": [{"receiver_email": email}, {"sender_email": email}]},
+        projection=PROJECTION
+    ).sort("created", DESCENDING)
+
+    return len(list(cursor))
+
+def time_listing(label: str, listing, trades: Collection, emails: list[str]) -> None:
+    samples: list[float] = []
+    for email in emails:
+        start: float = time.perf_counter()
+        listing(trades, email)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    samples.sort()
+    p99: float = samples[int(len(samples) * 0.99) - 1]
+    print(f"{label:<32} p50={statistics.median(samples):8.2f}ms  p99={p99:8.2f}ms")
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/?directConnection=true")
+    parser.add_argument("--trades", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--samples", type=int, default=100)
+    args = parser.parse_args()
+
+    trades: Collection = MongoClient(args.mongo_uri)["video_game_exchange_bench"]["trades"]
+
+    print(f"Seeding {args.trades} trades across {args.users} users...")
+    seed(trades, args.trades, args.users)
+
+    emails: list[str] = [f"user{random.randrange(args.users)}@test.com" for _ in range(args.samples)]
+
+    time_listing("two finds, no indexes", list_two_finds, trades, emails)
+
+    trades.create_index([("receiver_email", ASCENDING), ("status", ASCENDING), ("created", DESCENDING)])
+    trades.create_index([("sender_email", ASCENDING), ("status", ASCENDING), ("created", DESCENDING)])
+
+    time_listing("two finds, compound indexes", list_two_finds, trades, emails)
+    time_listing("single $or, compound indexes", list_single_or, trades, emails)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Time to turn a cached page of 500 trades into a GET /api/trades response body.
+#
+# Each path starts from the bytes Redis hands back on a cache hit and ends with the response body:
+#   - json + JSONResponse: what was cached before, decoded and re-encoded with the stdlib json
+#   - msgpack + FastJSONResponse: the page decoded into dicts and encoded again with orjson
+#   - passthrough: the cached JSON body spliced into the response without being decoded
+#
+# Usage: python bench/trades_response.py [--trades 500] [--seconds 1]
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from models.trade import Trade, TradeStatus
+from models.cache_codec import CacheCodec, CacheFormat
+from responses import FastJSONResponse
+
+import orjson
+from fastapi.responses import JSONResponse
+
+EMAIL: str = "alice@test.com"
+LINKS: dict[str, dict[str, str]] = {
+    "get_self": {"endpoint": "/api/self", "method": "GET"},
+    "next": {"endpoint": "/api/trades?limit=500&cursor=WyIyMDI1LTAxLTAxIiwgImlkIl0%3D", "method": "GET"},
+}
+NEXT_CURSOR: str = "WyIyMDI1LTAxLTAxIiwgImlkIl0="
+
+def make_page(trades: int) -> dict[str, list[dict]]:
+    created: datetime = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    page: dict[str, list[dict]] = {"incoming": [], "outgoing": []}
+
+    for seq in range(trades):
+        incoming: bool = seq % 2 == 0
+        trade: Trade = Trade(
+            sender_email=f"user{seq}@test.com" if incoming else EMAIL,
+            receiver_email=EMAIL if incoming else f"user{seq}@test.com",
+            offered_game=f"Game Title {seq}",
+            requested_game=f"Game Title {seq + 1}",
+            status=TradeStatus.PENDING,
+            created=created - timedelta(minutes=seq)
+        )
+        page["incoming" if incoming else "outgoing"].append(trade.to_dict())
+
+    return page
+
+def per_op_us(op, seconds: float) -> float:
+    ops: int = 0
+    deadline: float = time.perf_counter() + seconds
+
+    start: float = time.perf_counter()
+    while time.perf_counter() < deadline:
+        op()
+        ops += 1
+
+    return (time.perf_counter() - start) / ops * 1e6
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trades", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    page: dict[str, list[dict]] = make_page(args.trades)
+    codec: CacheCodec = CacheCodec(CacheFormat.MSGPACK_ZSTD)
+
+    cached_json: bytes = json.dumps({**page, "next_cursor": NEXT_CURSOR}).encode("utf-8")
+    cached_dict: bytes = codec.encode({**page, "next_cursor": NEXT_CURSOR})
+    cached_body: bytes = codec.encode([NEXT_CURSOR, orjson.dumps(page)])
+
+    def json_response() -> bytes:
+        cached: dict = json.loads(cached_json)
+        cached.pop("next_cursor")
+        return JSONResponse(content={"trades": cached, "links": LINKS}).body
+
+    def orjson_response() -> bytes:
+        cached: dict = codec.decode(cached_dict)
+        cached.pop("next_cursor")
+        return FastJSONResponse(content={"trades": cached, "links": LINKS}).body
+
+    def passthrough_response() -> bytes:
+        _, body = codec.decode(cached_body)
+        return FastJSONResponse(content={"trades": orjson.Fragment(body), "links": LINKS}).body
+
+    expected: dict = {"trades": page, "links": LINKS}
+    paths = (
+        ("json + JSONResponse", json_response),
+        ("msgpack + FastJSONResponse", orjson_response),
+        ("passthrough", passthrough_response),
+    )
+
+    for label, respond in paths:
+        assert json.loads(respond()) == expected, f"{label} rendered a different response!"
+
+    print(f"{args.trades} trades, response body {len(passthrough_response())} bytes")
+    for label, respond in paths:
+        print(f"{label:<26} {per_op_us(respond, args.seconds):9.1f}us/response")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,37 @@
-import time
+import orjson
+import asyncio
+import hashlib
 import logging
 
-from typing import Any, Callable, Awaitable
+from urllib.parse import urlencode
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
 # === Internal models and middleware(s) imports === #
 
 from models.users import Users
 from models.user  import User, Game
 
-from models.trade  import Trade
-from models.trades import Trades
+from models.trade  import Trade, TradeStatus
+from models.trades import Trades, TradesPage
+from models.user_identity_map import UserIdentityMap
 
-from middleware.user_auth import UserAuth
+from middleware.user_auth import UserAuth, Principal
+from middleware.request_metrics import init_metrics
+
+from responses import FastJSONResponse
 
 from models.email_notif_producer import EmailNotifProducer
 
 # === FastAPI imports === #
 
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import Response
 from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 # === Prometheus import(s) === #
 
-from prometheus_client import Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 # === Logging initialization === #
 
@@ -38,7 +46,18 @@ logger.setLevel(logging.INFO)
 
 # === Application initialization setup === #
 
-app: FastAPI = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    await trades.ensure_indexes()
+
+    invalidation_listener: asyncio.Task = asyncio.create_task(users.listen_for_invalidations())
+
+    yield
+
+    invalidation_listener.cancel()
+    await asyncio.to_thread(email_notif_producer.close)
+
+app: FastAPI = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 bearer: HTTPBearer = HTTPBearer()
 
 trades: Trades = Trades(logger)
@@ -46,38 +65,11 @@ users: Users = Users(logger)
 
 auth_service: UserAuth = UserAuth(users)
 
-email_notif_producer: EmailNotifProducer = EmailNotifProducer(users, trades)
-
-# NOTE: [AI CITATION]: Partially generated by chatGPT
-request_latency_histo: Histogram = Histogram(
-    "api_request_latency_s",
-    "HTTP request latency in seconds",
-    ["method", "endpoint"],
-    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
-)
+email_notif_producer: EmailNotifProducer = EmailNotifProducer()
 
 # === Metrics endpoint/middleware === #
 
-# NOTE: [AI CITATION]: Got help from chatGPT but documentation was mostly used
-
-@app.middleware("http")
-async def init_metrics(
-    request: Request,
-    call_next: Callable[[Request], Awaitable[Response]]
-) -> Response:
-    if request.url.path == "/metrics":
-        return await call_next(request)
-
-    start: float = time.perf_counter()
-    api_resp: Response = await call_next(request)
-    end: float = time.perf_counter()
-
-    request_latency_histo.labels(
-        method=request.method,
-        endpoint=request.url.path
-    ).observe(end - start)
-
-    return api_resp
+app.middleware("http")(init_metrics)
 
 @app.get("/metrics")
 def get_metrics() -> Response:
@@ -85,26 +77,34 @@ def get_metrics() -> Response:
 
 # === Authentication === #
 
-def auth_middleware(
-    credentials: HTTPAuthorizationCredentials = Depends(bearer)
-) -> User | None:
-    jwt: str = credentials.credentials
+# NOTE: FastAPI caches dependencies per request, so the auth dependencies and the handler all share
+# this one identity map. It's also stashed on the request state for the metrics middleware
+async def request_identity_map(request: Request) -> UserIdentityMap:
+    identity_map: UserIdentityMap = UserIdentityMap(users)
+    request.state.user_identity_map = identity_map
 
-    try:
-        jwt_payload: dict[str, Any] = auth_service.verify_jwt(jwt)
+    return identity_map
 
-        user: User | None = auth_service.users.get_user(jwt_payload["sub"])
-        if user is None:
-            raise HTTPException(
-                status_code=409,
-                detail="Failed to auth user! User does not exist!"
-            )
+# NOTE: Two tiers of auth, handlers that only need the caller's email depend on `auth_principal`
+# and skip loading the user entirely, the rest depend on `auth_middleware` for the full user
 
-        return user
+async def auth_principal(
+    credentials: HTTPAuthorizationCredentials = Depends(bearer),
+    identity_map: UserIdentityMap = Depends(request_identity_map)
+) -> Principal:
+    try:
+        return auth_service.principal_from_jwt(credentials.credentials, identity_map)
 
     except Exception:
         raise HTTPException(status_code=401, detail="Failed to auth user! Invalid JWT!")
 
+async def auth_middleware(principal: Principal = Depends(auth_principal)) -> User:
+    user: User | None = await principal.load_user()
+    if user is None:
+        raise HTTPException(status_code=401, detail="Failed to auth user! User does not exist!")
+
+    return user
+
 # === User API === #
 # NOTE: [AI CITATION] Partially generated with claude code
 
@@ -114,11 +114,38 @@ def _new_hateos_link(*link_info: tuple[str, str, str]) -> dict[str, dict[str, st
         for name, endpoint, method in link_info
     }
 
+# === Conditional GETs === #
+
+# NOTE: Responses that clients poll carry a strong ETag made from the version of what they were built
+# from, so a client that already has the current version gets a 304 before anything is loaded or
+# serialized. The owner is part of the tag since the same URL serves every user their own data
+def _etag(email: str, version: int) -> str:
+    owner: str = hashlib.blake2b(email.encode("utf-8"), digest_size=8).hexdigest()
+    return f'"{owner}-{version}"'
+
+def _not_modified(request: Request, etag: str) -> bool:
+    if_none_match: str | None = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+
+    # NOTE: If-None-Match compares weakly, so a W/ prefix added along the way still matches
+    client_etags: list[str] = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in client_etags or "*" in client_etags
+
+def _with_etag(response: Response, etag: str) -> Response:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    return response
+
+def _not_modified_response(etag: str) -> Response:
+    return _with_etag(Response(status_code=304), etag)
+
 @app.post("/api/register")
-def register(reg_body: dict[str, str]) -> JSONResponse:
+async def register(reg_body: dict[str, str]) -> FastJSONResponse:
     try:
         email: str = reg_body["email"]
-        if users.get_user(email):
+        if await users.get_user(email):
             raise HTTPException(
                 status_code=400,
                 detail="Email already registered!"
@@ -131,12 +158,12 @@ def register(reg_body: dict[str, str]) -> JSONResponse:
             street_address=reg_body["street_address"],
         )
 
-        users.add_user(user)
+        await users.add_user(user)
         user_email: str = user.email
 
         logging.info(f"User '{user_email}' successfully registered!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=201,
             content={
                 "links": _new_hateos_link(("login", "/api/login", "POST"))
@@ -154,14 +181,14 @@ def register(reg_body: dict[str, str]) -> JSONResponse:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/login")
-def login(user: dict[str, str]) -> JSONResponse:
+async def login(user: dict[str, str]) -> FastJSONResponse:
     # NOTE: Would definitely be better to have setting auth token in the cookies directly
 
     try:
-        jwt: str = auth_service.auth(user["email"], user["password"])
+        jwt: str = await auth_service.auth(user["email"], user["password"])
         logging.info(f"User '{user['email']}' successfully logged in!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=201,
             content={
                 "jwt" : jwt,
@@ -180,24 +207,37 @@ def login(user: dict[str, str]) -> JSONResponse:
         raise HTTPException(status_code=401, detail=str(e))
 
 @app.get("/api/self")
-def get_self(authed_user: User = Depends(auth_middleware)) -> dict[str, str | dict]:
-    return {
-        "name": authed_user.name,
-        "email": authed_user.email,
-        "password" : authed_user.password,
-        "street_address": authed_user.street_address,
-        "games" : {
-            name: game.to_dict()
-            for name, game in authed_user.games.items()
+async def get_self(request: Request, principal: Principal = Depends(auth_principal)) -> Response:
+    version: int | None = await users.get_user_version(principal.email)
+    if version is not None:
+        etag: str = _etag(principal.email, version)
+        if _not_modified(request, etag):
+            return _not_modified_response(etag)
+
+    authed_user: User = await auth_middleware(principal)
+
+    response: FastJSONResponse = FastJSONResponse(
+        status_code=200,
+        content={
+            "name": authed_user.name,
+            "email": authed_user.email,
+            "password" : authed_user.password,
+            "street_address": authed_user.street_address,
+            "games" : {
+                name: game.to_dict()
+                for name, game in authed_user.games.items()
+            },
+            "links": _new_hateos_link(("update_self", "/api/self", "PUT"))
         },
-        "links": _new_hateos_link(("update_self", "/api/self", "PUT"))
-    }
+    )
+
+    return _with_etag(response, _etag(authed_user.email, authed_user.version))
 
 @app.put("/api/self")
-def update_self(
+async def update_self(
     update_body: dict[str, str],
     authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
+) -> FastJSONResponse:
     try:
         email: str = authed_user.email
 
@@ -208,7 +248,7 @@ def update_self(
         new_password: str | None = update_body.get("password")
         new_street_address: str | None = update_body.get("street_address")
 
-        users.update_user(
+        await users.update_user(
             email=email,
             name=new_name,
             password=new_password,
@@ -216,14 +256,14 @@ def update_self(
         )
 
         if new_password is not None:
-            email_notif_producer.send_pw_update_notif(
+            await email_notif_producer.send_pw_update_notif(
                 name=old_name,
                 auth_combo=(email, old_password)
             )
 
         logging.info(f"Successfully updated user '{email}'!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={
                 "links": _new_hateos_link(("read_self", "/api/self", "GET"))
@@ -237,10 +277,10 @@ def update_self(
 # === Game API === #
 
 @app.post("/api/games")
-def add_game(
+async def add_game(
     game_body: dict[str, str | int],
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
+    principal: Principal = Depends(auth_principal)
+) -> FastJSONResponse:
     try:
         game: Game = Game(
             name=str(game_body["name"]),
@@ -250,12 +290,12 @@ def add_game(
             condition=str(game_body["condition"])
         )
 
-        email: str = authed_user.email
-        users.add_game(email, game)
+        email: str = principal.email
+        await users.add_game(email, game)
 
         logging.info(f"Successfully added game '{game.name}' to user '{email}'s games!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=201,
             content={
                 "links": _new_hateos_link(("get_game", "/api/games/{game_name}", "GET"))
@@ -269,14 +309,23 @@ def add_game(
         )
 
     except ValueError as e:
-        logging.error(f"Failed to add game '{game_body['name']}' to {authed_user.email}'s games! Reason: {str(e)}")
+        logging.error(f"Failed to add game '{game_body['name']}' to {principal.email}'s games! Reason: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/games/{game_name}")
-def get_game(
+async def get_game(
     game_name: str,
-    authed_user: User = Depends(auth_middleware)
-) -> dict[str, str | dict]:
+    request: Request,
+    principal: Principal = Depends(auth_principal)
+) -> Response:
+    version: int | None = await users.get_user_version(principal.email)
+    if version is not None:
+        etag: str = _etag(principal.email, version)
+        if _not_modified(request, etag):
+            return _not_modified_response(etag)
+
+    authed_user: User = await auth_middleware(principal)
+
     game: Game | None = authed_user.get_game(game_name)
     if game is None:
         raise HTTPException(status_code=404, detail="Failed to find game!")
@@ -289,22 +338,31 @@ def get_game(
         )
     })
 
-    return game_json
+    return _with_etag(
+        FastJSONResponse(status_code=200, content=game_json),
+        _etag(authed_user.email, authed_user.version)
+    )
 
 @app.put("/api/games/{game_name}")
-def update_game(
+async def update_game(
     game_name: str,
     update_body: dict[str, str], 
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
+    principal: Principal = Depends(auth_principal)
+) -> FastJSONResponse:
     try:
-        users.update_game(
-            email=authed_user.email,
+        new_name: str | None = update_body.get("name")
+
+        await users.update_game(
+            email=principal.email,
             game_name=game_name,
-            new_name=update_body.get("name"),
+            new_name=new_name,
             condition=update_body.get("condition")
         )
-        return JSONResponse(
+
+        if new_name is not None and new_name != game_name:
+            await trades.supersede_trades_for_game(principal.email, game_name)
+
+        return FastJSONResponse(
             status_code=200,
             content={
                 "links": _new_hateos_link(("get_game", "/api/games/{game_name}", "GET"))
@@ -312,19 +370,21 @@ def update_game(
         )
 
     except ValueError as e:
-        logger.error(f"Failed to update game for user '{authed_user.email}'! Reason: {str(e)}")
+        logger.error(f"Failed to update game for user '{principal.email}'! Reason: {str(e)}")
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.delete("/api/games/{game_name}")
-def delete_game(
+async def delete_game(
     game_name: str,
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
+    principal: Principal = Depends(auth_principal)
+) -> FastJSONResponse:
     try:
-        users.delete_game(email=authed_user.email, game_name=game_name)
-        logging.info(f"Successfully deleted game '{game_name}' from user '{authed_user.email}'s games!")
+        await users.delete_game(email=principal.email, game_name=game_name)
+        await trades.supersede_trades_for_game(principal.email, game_name)
+
+        logging.info(f"Successfully deleted game '{game_name}' from user '{principal.email}'s games!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={
                 "links": _new_hateos_link(("get_game", "/api/games/{game_name}", "GET"))
@@ -332,21 +392,22 @@ def delete_game(
         )
 
     except ValueError as e:
-        logger.error(f"Failed to delete game '{game_name}' for user '{authed_user.email}'! Reason: {str(e)}")
+        logger.error(f"Failed to delete game '{game_name}' for user '{principal.email}'! Reason: {str(e)}")
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.post("/api/trades")
-def init_trade_offer(
+async def init_trade_offer(
     trade_body: dict[str, str],
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
-    def _validate_trade_body(
+    authed_user: User = Depends(auth_middleware),
+    identity_map: UserIdentityMap = Depends(request_identity_map)
+) -> FastJSONResponse:
+    async def _validate_trade_body(
         sender: User,
         receiver_email: str,
         offered_game: str,
         requested_game: str
-    ) -> None:
-        receiver: User | None = users.get_user(receiver_email)
+    ) -> User:
+        receiver: User | None = await identity_map.get_user(receiver_email)
         if receiver is None:
             raise ValueError(f"Receiver '{receiver}' does not exist!")
 
@@ -362,6 +423,8 @@ def init_trade_offer(
         if offered_game == requested_game:
             raise ValueError("Offered game and requested game cannot be the same!")
 
+        return receiver
+
     try:
         sender_email: str = authed_user.email
         receiver_email: str = trade_body["receiver"]
@@ -369,7 +432,7 @@ def init_trade_offer(
         offered_game: str = trade_body["offered_game"]
         requested_game: str = trade_body["requested_game"]
 
-        _validate_trade_body(authed_user, receiver_email, offered_game, requested_game)
+        receiver: User = await _validate_trade_body(authed_user, receiver_email, offered_game, requested_game)
 
         trade: Trade = Trade(
             sender_email=sender_email,
@@ -378,12 +441,12 @@ def init_trade_offer(
             requested_game=requested_game,
         )
 
-        trade_id: str = trades.add_trade(trade)
-        email_notif_producer.send_trade_offer_notif(trade_id=trade_id)
+        trade_id: str = await trades.add_trade(trade)
+        await email_notif_producer.send_trade_offer_notif(trade, sender=authed_user, receiver=receiver)
 
         logger.info(f"Trade request from {sender_email} to {receiver_email} successfully created!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=201,
             content={
                 "trade_id" : trade_id,
@@ -405,37 +468,94 @@ def init_trade_offer(
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/trades")
-def get_trades(
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
-    return JSONResponse(
+async def get_trades(
+    request: Request,
+    status: str | None = None,
+    limit: int = Trades.DEFAULT_PAGE_SIZE,
+    cursor: str | None = None,
+    principal: Principal = Depends(auth_principal)
+) -> Response:
+    try:
+        status_filter: TradeStatus | None = TradeStatus[status.upper()] if status else None
+
+        # NOTE: Checked before the ETag, a bad request is a 400 even if nothing has changed since
+        trades.check_page_request(limit, cursor)
+
+        version: int | None = await trades.get_trades_version(principal.email)
+        if version is not None:
+            etag: str = _etag(principal.email, version)
+            if _not_modified(request, etag):
+                return _not_modified_response(etag)
+
+        page: TradesPage = await trades.get_trades_for(
+            principal.email,
+            version,
+            status=status_filter,
+            limit=limit,
+            cursor=cursor
+        )
+
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown trade status '{status}'!")
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    links: list[tuple[str, str, str]] = [("get_self", "/api/self", "GET")]
+
+    if page.next_cursor is not None:
+        query: dict[str, str | int] = {"limit": limit, "cursor": page.next_cursor}
+        if status_filter is not None:
+            query["status"] = status_filter.name
+
+        links.append(("next", f"/api/trades?{urlencode(query)}", "GET"))
+
+    # NOTE: The page is already JSON (straight from the cache on a hit), so it's spliced into the
+    # response as is rather than being decoded only to be encoded again
+    response: FastJSONResponse = FastJSONResponse(
         status_code=200,
         content={
-            "trades": trades.get_trades_for(authed_user.email),
-            "links": _new_hateos_link(("get_self", "/api/self", "GET"))
+            "trades": orjson.Fragment(page.body),
+            "links": _new_hateos_link(*links)
         },
     )
 
+    return _with_etag(response, _etag(principal.email, page.version)) if page.version is not None else response
+
+async def _load_traders(trade: Trade, identity_map: UserIdentityMap) -> tuple[User, User]:
+    sender: User | None = await identity_map.get_user(trade.sender_email)
+    if sender is None:
+        raise ValueError(f"Sender '{trade.sender_email}' does not exist!")
+
+    receiver: User | None = await identity_map.get_user(trade.receiver_email)
+    if receiver is None:
+        raise ValueError(f"Receiver '{trade.receiver_email}' does not exist!")
+
+    return sender, receiver
+
 @app.post("/api/trades/accept/{trade_id}")
-def accept_trade_offer(
+async def accept_trade_offer(
     trade_id: str,
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
+    principal: Principal = Depends(auth_principal),
+    identity_map: UserIdentityMap = Depends(request_identity_map)
+) -> FastJSONResponse:
     try:
-        trade: Trade | None = trades.get_trade(trade_id)
+        trade: Trade | None = await trades.get_trade(trade_id)
         if trade is None:
             raise Exception("Trade does not exist!")
 
-        email: str = authed_user.email
+        email: str = principal.email
         if trade.receiver_email != email:
             raise Exception("User is not authorized to accept this trade!")
 
-        trades.accept_trade(trade_id, users)
-        email_notif_producer.send_trade_accepted_notif(trade_id=trade_id)
+        await trades.accept_trade(trade_id, users)
+
+        sender, receiver = await _load_traders(trade, identity_map)
+        await email_notif_producer.send_trade_accepted_notif(trade, sender=sender, receiver=receiver)
 
         logger.info(f"User '{email}' successfully accepted trade '{trade_id}'!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={
                 "links": _new_hateos_link(("get_self", "/api/self", "GET"))
@@ -443,30 +563,32 @@ def accept_trade_offer(
         )
 
     except ValueError as e:
-        logger.error(f"Failed to accept trade for user '{authed_user.email}'! Reason: {str(e)}")
+        logger.error(f"Failed to accept trade for user '{principal.email}'! Reason: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/trades/reject/{trade_id}")
-def reject_trade_offer(
+async def reject_trade_offer(
     trade_id: str,
-    authed_user: User = Depends(auth_middleware)
-) -> JSONResponse:
+    principal: Principal = Depends(auth_principal),
+    identity_map: UserIdentityMap = Depends(request_identity_map)
+) -> FastJSONResponse:
     try:
-        trade: Trade | None = trades.get_trade(trade_id)
+        trade: Trade | None = await trades.get_trade(trade_id)
         if trade is None:
             raise ValueError("Trade does not exist!")
 
-        email: str = authed_user.email
+        email: str = principal.email
         if trade.receiver_email != email:
             raise ValueError("User is not authorized to reject this trade!")
 
-        trades.reject_trade(trade_id)
+        await trades.reject_trade(trade_id)
 
-        email_notif_producer.send_trade_rejected_notif(trade_id=trade_id)
+        sender, receiver = await _load_traders(trade, identity_map)
+        await email_notif_producer.send_trade_rejected_notif(trade, sender=sender, receiver=receiver)
 
         logging.info(f"User '{email}' successfully rejected trade '{trade_id}'!")
 
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=200,
             content={
                 "links": _new_hateos_link(("get_self", "/api/self", "GET"))
@@ -474,6 +596,6 @@ def reject_trade_offer(
         )
 
     except ValueError as e:
-        logger.error(f"Failed to reject trade for user '{authed_user.email}'! Reason: {str(e)}")
+        logger.error(f"Failed to reject trade for user '{principal.email}'! Reason: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -0,0 +1,153 @@
+import time
+import typing
+import threading
+
+from logging import Logger
+
+from metrics import (
+    notif_coalescer_emails_in,
+    notif_coalescer_sends_out,
+    notif_coalescer_held,
+    notif_digest_size_histo
+)
+
+T = typing.TypeVar("T")
+
+class Bucket(typing.Generic[T]):
+    def __init__(self, now: float) -> None:
+        self.items: list[T] = []
+        self.first_at: float = now
+        self.last_at: float = now
+
+    # NOTE: Flushes once the recipient has gone quiet for a window, but never later than
+    # max_delay after the first email was held
+    def due(self, window_s: float, max_delay_s: float) -> float:
+        return min(self.last_at + window_s, self.first_at + max_delay_s)
+
+# NOTE: Groups a recipient's emails into a single send. A recipient that hasn't been emailed within
+# the last window is flushed straight away, so a one-off email isn't delayed at all, while every
+# further email within the window is held in that recipient's bucket and flushed together
+class NotifCoalescer(typing.Generic[T]):
+    def __init__(
+        self,
+        logger: Logger,
+        flush: typing.Callable[[list[T]], None],
+        window_s: float,
+        max_delay_s: float,
+        max_batch: int
+    ) -> None:
+        self.logger: Logger = logger
+        self.flush: typing.Callable[[list[T]], None] = flush
+
+        self.window_s: float = window_s
+        self.max_delay_s: float = max_delay_s
+        self.max_batch: int = max_batch
+
+        self.buckets: dict[str, Bucket[T]] = {}
+        self.last_flushed: dict[str, float] = {}
+
+        self.cond: threading.Condition = threading.Condition()
+        self.closed: bool = False
+
+        self.thread: threading.Thread = threading.Thread(
+            target=self._run,
+            name="email-coalescer",
+            daemon=True
+        )
+        self.thread.start()
+
+    def add(self, recipient: str, item: T) -> None:
+        notif_coalescer_emails_in.inc()
+
+        now: float = time.monotonic()
+        ready: list[T] | None = None
+
+        with self.cond:
+            bucket: Bucket[T] | None = self.buckets.get(recipient)
+
+            if self.closed or (bucket is None and now - self.last_flushed.get(recipient, -self.window_s) >= self.window_s):
+                self.last_flushed[recipient] = now
+                ready = [item]
+
+            else:
+                if bucket is None:
+                    bucket = self.buckets[recipient] = Bucket(now)
+                    self.cond.notify()
+
+                bucket.items.append(item)
+                bucket.last_at = now
+                notif_coalescer_held.inc()
+
+                if len(bucket.items) >= self.max_batch:
+                    ready = self._pop(recipient, now)
+
+        if ready is not None:
+            self._flush(ready)
+
+    # NOTE: Caller must hold the lock
+    def _pop(self, recipient: str, now: float) -> list[T]:
+        bucket: Bucket[T] = self.buckets.pop(recipient)
+        self.last_flushed[recipient] = now
+
+        notif_coalescer_held.dec(len(bucket.items))
+        return bucket.items
+
+    def _flush(self, items: list[T]) -> None:
+        notif_coalescer_sends_out.inc()
+        notif_digest_size_histo.observe(len(items))
+
+        try:
+            self.flush(items)
+
+        except Exception as e:
+            self.logger.error(f"Failed to flush {len(items)} coalesced email(s)! Reason: {str(e)}")
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        return
+
+                    now: float = time.monotonic()
+
+                    due: list[str] = [
+                        recipient for recipient, bucket in self.buckets.items()
+                        if bucket.due(self.window_s, self.max_delay_s) <= now
+                    ]
+                    if due:
+                        ready: list[list[T]] = [self._pop(recipient, now) for recipient in due]
+                        break
+
+                    # NOTE: Recipients that have been quiet for a whole window are cold again
+                    self.last_flushed = {
+                        recipient: flushed_at for recipient, flushed_at in self.last_flushed.items()
+                        if now - flushed_at < self.window_s
+                    }
+
+                    # NOTE: With nothing held there's only the pruning above left to do, once a window
+                    # (or a second, so that a zero window doesn't spin)
+                    if not self.buckets:
+                        self.cond.wait(timeout=max(self.window_s, 1.0))
+                        continue
+
+                    next_due: float = min(bucket.due(self.window_s, self.max_delay_s) for bucket in self.buckets.values())
+                    self.cond.wait(timeout=next_due - now)
+
+            for items in ready:
+                self._flush(items)
+
+    # NOTE: Everything still held is flushed immediately rather than being left for kafka to redeliver
+    def shutdown(self) -> None:
+        with self.cond:
+            self.closed = True
+
+            now: float = time.monotonic()
+            ready: list[list[T]] = [self._pop(recipient, now) for recipient in list(self.buckets)]
+
+            self.cond.notify()
+
+        self.thread.join()
+
+        for items in ready:
+            self._flush(items)
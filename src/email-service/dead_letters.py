@@ -0,0 +1,134 @@
+import json
+import time
+import typing
+import threading
+
+from enum import Enum
+from logging import Logger
+
+from metrics import notif_dead_letters, notif_dead_letter_failures, notif_dead_letter_depth
+
+from kafka import KafkaConsumer, KafkaProducer
+from kafka.errors import KafkaError
+from kafka.structs import TopicPartition
+
+# NOTE: Where a dead letter gave up, only "send" failures are worth replaying as is, "parse" and
+# "handle" failures need the notification (or the handler) fixed first
+class DeadLetterStage(Enum):
+    PARSE = "parse"    # Empty, not valid JSON, not an object or with malformed recipients/event_id
+    HANDLE = "handle"  # Unknown type, missing fields or the handler otherwise failed
+    SEND = "send"      # Ran out of attempts (or was refused outright) by the SMTP server
+
+# NOTE: Publishes notifications that can't be delivered to the dead letter topic, alongside why
+# they failed and where they came from, so that they can be inspected and replayed (replay_dlq.py)
+class DeadLetterQueue:
+    TOPIC: typing.Final[str] = "email-notifs-dlq"
+    BOOTSTRAP_SERVERS: typing.Final[str] = "kafka:9092"
+
+    PUBLISH_TIMEOUT_S: typing.Final[float] = 10.0
+
+    # NOTE: The consumer group replay_dlq.py reads the dead letter topic as
+    REPLAY_GROUP_ID: typing.Final[str] = "email-notifs-dlq-replay"
+    DEPTH_REFRESH_S: typing.Final[float] = 30.0
+    DEPTH_TIMEOUT_MS: typing.Final[int] = 5000
+
+    def __init__(self, logger: Logger) -> None:
+        self.logger: Logger = logger
+
+        self.producer: KafkaProducer = KafkaProducer(
+            bootstrap_servers=self.BOOTSTRAP_SERVERS,
+            value_serializer=lambda msg: json.dumps(msg).encode("utf-8"),
+            acks="all"
+        )
+
+        # NOTE: Only reads offsets (the replay group's committed ones among them), it never
+        # subscribes, so it never joins the replay group or commits on its behalf
+        self.offsets_reader: KafkaConsumer = KafkaConsumer(
+            bootstrap_servers=self.BOOTSTRAP_SERVERS,
+            group_id=self.REPLAY_GROUP_ID,
+            enable_auto_commit=False
+        )
+
+        # NOTE: Its own thread rather than the poll loop, looking up the topic's partitions blocks
+        # for as long as kafka is unreachable
+        self.depth_stop: threading.Event = threading.Event()
+        self.depth_thread: threading.Thread = threading.Thread(
+            target=self._refresh_depth_forever,
+            name="dead-letter-depth",
+            daemon=True
+        )
+        self.depth_thread.start()
+
+    # NOTE: Blocks until kafka acknowledges the dead letter, the notification's offset is only
+    # committed after this returns. A dead letter that can't be published is logged and dropped
+    # rather than stalling the partition forever
+    def publish(
+        self,
+        tp: TopicPartition,
+        offset: int,
+        stage: DeadLetterStage,
+        reason: str,
+        attempts: int,
+        notif: dict | None = None,
+        raw: str | None = None,
+        recipients: list[str] | None = None
+    ) -> None:
+        dead_letter: dict = {
+            "source"     : {"topic": tp.topic, "partition": tp.partition, "offset": offset},
+            "stage"      : stage.value,
+            "reason"     : reason,
+            "attempts"   : attempts,
+            "failed_at"  : time.time(),
+            "notif"      : notif,
+            "raw"        : raw,
+            "recipients" : recipients,
+        }
+
+        try:
+            self.producer.send(self.TOPIC, value=dead_letter).get(timeout=self.PUBLISH_TIMEOUT_S)
+            notif_dead_letters.labels(stage=stage.value).inc()
+
+        except KafkaError as e:
+            notif_dead_letter_failures.inc()
+            self.logger.error(f"Failed to dead letter offset {offset} of {tp} due to a kafka error! Reason: {str(e)}")
+
+    def _refresh_depth_forever(self) -> None:
+        while True:
+            self._refresh_depth()
+
+            if self.depth_stop.wait(self.DEPTH_REFRESH_S):
+                return
+
+    def _refresh_depth(self) -> None:
+        try:
+            partitions: set[int] | None = self.offsets_reader.partitions_for_topic(self.TOPIC)
+            if not partitions:
+                notif_dead_letter_depth.set(0)
+                return
+
+            tps: list[TopicPartition] = [TopicPartition(self.TOPIC, partition) for partition in partitions]
+            beginnings: dict[TopicPartition, int] = self.offsets_reader.beginning_offsets(tps, timeout_ms=self.DEPTH_TIMEOUT_MS)
+            ends: dict[TopicPartition, int] = self.offsets_reader.end_offsets(tps, timeout_ms=self.DEPTH_TIMEOUT_MS)
+
+            depth: int = 0
+            for tp in tps:
+                replayed: int | None = self.offsets_reader.committed(tp, timeout_ms=self.DEPTH_TIMEOUT_MS)
+                depth += ends[tp] - max(beginnings[tp], replayed if replayed is not None else 0)
+
+            notif_dead_letter_depth.set(depth)
+
+        except KafkaError as e:
+            self.logger.warning(f"Failed to refresh the dead letter depth due to a kafka error! Reason: {str(e)}")
+
+        except Exception as e:
+            self.logger.warning(f"Failed to refresh the dead letter depth due to an unexpected error! Reason: {str(e)}")
+
+    def close(self) -> None:
+        self.producer.flush(timeout=self.PUBLISH_TIMEOUT_S)
+        self.producer.close(timeout=self.PUBLISH_TIMEOUT_S)
+
+        # NOTE: A refresh stuck waiting on kafka is left to die with the process
+        self.depth_stop.set()
+        self.depth_thread.join(timeout=self.PUBLISH_TIMEOUT_S)
+        if not self.depth_thread.is_alive():
+            self.offsets_reader.close(autocommit=False)
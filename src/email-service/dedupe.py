@@ -0,0 +1,141 @@
+import uuid
+import typing
+import threading
+
+from enum import Enum
+from logging import Logger
+
+from emailer import NotifEmail
+from notif_dispatcher import SendDeferred
+from metrics import notif_duplicates_skipped, notif_dedupe_errors
+
+import redis
+from redis.commands.core import Script
+
+# NOTE: Claims the email for this consumer if nobody holds it (or this consumer already does,
+# i.e. a retry), otherwise returns whoever holds it ("sent" once it has been delivered)
+CLAIM_SCRIPT: typing.Final[str] = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 'acquired'
+end
+return holder
+"""
+
+# NOTE: Only gives the claim up if this consumer still holds it
+RELEASE_SCRIPT: typing.Final[str] = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class ClaimResult(Enum):
+    ACQUIRED = "acquired"          # Send it
+    SENT = "sent"                  # Already delivered, skip it
+    CLAIMED_ELSEWHERE = "claimed"  # Another consumer is sending it right now
+
+class NotifClaimedElsewhere(SendDeferred):
+    pass
+
+# NOTE: Remembers which (event id, recipient) emails have already been sent so that a redelivered
+# notification (consumer restart, rebalance, replay) doesn't email anyone twice. Each email is
+# claimed before it's sent and marked as sent afterwards, the claim expires on its own if its
+# consumer dies mid send. Redis being unavailable fails open, a rare duplicate beats a lost email
+class NotifDeduper:
+    REDIS_HOST: typing.Final[str] = "redis"
+    REDIS_TIMEOUT_S: typing.Final[float] = 1.0
+
+    CLAIM_TTL_S: typing.Final[int] = 60
+    SENT_TTL_S: typing.Final[int] = 7 * 24 * 60 * 60
+
+    SENT: typing.Final[str] = "sent"
+
+    def __init__(self, logger: Logger) -> None:
+        self.logger: Logger = logger
+
+        self.cache: redis.Redis = redis.Redis(
+            host=self.REDIS_HOST,
+            port=6379,
+            decode_responses=True,
+            socket_timeout=self.REDIS_TIMEOUT_S,
+            socket_connect_timeout=self.REDIS_TIMEOUT_S
+        )
+        self.claim_script: Script = self.cache.register_script(CLAIM_SCRIPT)
+        self.release_script: Script = self.cache.register_script(RELEASE_SCRIPT)
+
+        # NOTE: Identifies this consumer's claims, so its own retries can reclaim them. A new id per
+        # process, so the claims still held are given up on shutdown (see `release_all`)
+        self.consumer_id: str = uuid.uuid4().hex
+
+        self.held_lock: threading.Lock = threading.Lock()
+        self.held: set[str] = set()
+
+    def _dedupe_key(self, notif_email: NotifEmail) -> str:
+        return f"email-notif:{notif_email.event_id}:{notif_email.email}"
+
+    def claim(self, notif_email: NotifEmail) -> ClaimResult:
+        try:
+            holder: str = self.claim_script(
+                keys=[self._dedupe_key(notif_email)],
+                args=[self.consumer_id, self.CLAIM_TTL_S]
+            )
+
+        except redis.RedisError as e:
+            notif_dedupe_errors.inc()
+            self.logger.warning(f"Redis unavailable, sending email for event '{notif_email.event_id}' undeduped! Reason: {str(e)}")
+            return ClaimResult.ACQUIRED
+
+        if holder == ClaimResult.ACQUIRED.value:
+            with self.held_lock:
+                self.held.add(self._dedupe_key(notif_email))
+
+            return ClaimResult.ACQUIRED
+
+        if holder == self.SENT:
+            notif_duplicates_skipped.inc()
+            return ClaimResult.SENT
+
+        return ClaimResult.CLAIMED_ELSEWHERE
+
+    def mark_sent(self, notif_email: NotifEmail) -> None:
+        with self.held_lock:
+            self.held.discard(self._dedupe_key(notif_email))
+
+        try:
+            self.cache.set(self._dedupe_key(notif_email), self.SENT, ex=self.SENT_TTL_S)
+
+        except redis.RedisError as e:
+            notif_dedupe_errors.inc()
+            self.logger.warning(f"Failed to mark email for event '{notif_email.event_id}' as sent! Reason: {str(e)}")
+
+    # NOTE: Failed sends give their claim up so that their retry (or a redelivery to another
+    # consumer) can claim it, and dead lettered emails so that replaying them isn't skipped
+    def release(self, notif_email: NotifEmail) -> None:
+        key: str = self._dedupe_key(notif_email)
+
+        with self.held_lock:
+            self.held.discard(key)
+
+        try:
+            self.release_script(keys=[key], args=[self.consumer_id])
+
+        except redis.RedisError as e:
+            notif_dedupe_errors.inc()
+            self.logger.warning(f"Failed to release email for event '{notif_email.event_id}'! Reason: {str(e)}")
+
+    # NOTE: Called on shutdown once nothing is being sent anymore, otherwise whatever is redelivered
+    # after the restart would find its emails claimed by a consumer that's gone until CLAIM_TTL_S
+    def release_all(self) -> None:
+        with self.held_lock:
+            held: list[str] = list(self.held)
+            self.held.clear()
+
+        try:
+            for key in held:
+                self.release_script(keys=[key], args=[self.consumer_id])
+
+        except redis.RedisError as e:
+            notif_dedupe_errors.inc()
+            self.logger.warning(f"Failed to release {len(held)} claim(s) on shutdown! Reason: {str(e)}")
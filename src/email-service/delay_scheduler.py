@@ -0,0 +1,87 @@
+import time
+import heapq
+import typing
+import itertools
+import threading
+
+from logging import Logger
+
+from prometheus_client import Gauge
+
+# NOTE: A local delay heap, a single thread sleeps until the earliest task is due and runs it
+# (i.e. hands an email back to the dispatcher). Delayed tasks live only in memory, which is fine
+# because their offsets haven't been committed yet, so a restart just redelivers them from kafka
+class DelayScheduler:
+    # NOTE: `pending` (if given) tracks how many tasks are waiting, leave it out when the tasks don't
+    # map onto what's worth reporting
+    def __init__(self, logger: Logger, name: str, pending: Gauge | None = None) -> None:
+        self.logger: Logger = logger
+        self.name: str = name
+        self.pending: Gauge | None = pending
+
+        # NOTE: (due, seq, task), seq breaks ties (keeping equal delays in FIFO order) so
+        # callables are never compared
+        self.heap: list[tuple[float, int, typing.Callable[[], None]]] = []
+        self.seq: itertools.count = itertools.count()
+
+        self.cond: threading.Condition = threading.Condition()
+        self.closed: bool = False
+
+        self.thread: threading.Thread = threading.Thread(
+            target=self._run,
+            name=name,
+            daemon=True
+        )
+        self.thread.start()
+
+    def schedule(self, delay_s: float, task: typing.Callable[[], None]) -> bool:
+        with self.cond:
+            if self.closed:
+                return False
+
+            heapq.heappush(self.heap, (time.monotonic() + delay_s, next(self.seq), task))
+            if self.pending is not None:
+                self.pending.inc()
+
+            self.cond.notify()
+
+        return True
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+
+                    wait_s: float = self.heap[0][0] - time.monotonic()
+                    if wait_s <= 0:
+                        break
+
+                    self.cond.wait(timeout=wait_s)
+
+                if self.closed:
+                    return
+
+                _, _, task = heapq.heappop(self.heap)
+                if self.pending is not None:
+                    self.pending.dec()
+
+            try:
+                task()
+
+            except Exception as e:
+                self.logger.error(f"Failed to run a task scheduled on '{self.name}'! Reason: {str(e)}")
+
+    # NOTE: Tasks still waiting are dropped, their notifications are redelivered by kafka
+    def shutdown(self) -> None:
+        with self.cond:
+            self.closed = True
+            if self.pending is not None:
+                self.pending.dec(len(self.heap))
+            self.heap.clear()
+
+            self.cond.notify()
+
+        self.thread.join()
@@ -1,28 +1,127 @@
 import json
+import time
 import typing
+import threading
+import dataclasses
 
-from emailer import Emailer
+from emailer import Emailer, NotifEmail
+from notif_dispatcher import NotifDispatcher, DeadLetter
+from dead_letters import DeadLetterQueue, DeadLetterStage
+from dedupe import NotifDeduper, ClaimResult, NotifClaimedElsewhere
 from logging import Logger
 
-from kafka import KafkaConsumer
+from metrics import notif_consumer_lag, notif_errors
+
+from kafka import KafkaConsumer, ConsumerRebalanceListener
 from kafka.errors import KafkaError
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import TopicPartition, OffsetAndMetadata
+
+# NOTE: Runs inside `poll` whenever the group rebalances. What has completed is committed before
+# partitions are handed over, then their offset tracking starts over, any of their notifications
+# still in flight may be redelivered to whoever owns the partition now (or to this consumer again)
+class NotifRebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, notif_consumer: "EmailNotifConsumer") -> None:
+        self.notif_consumer: EmailNotifConsumer = notif_consumer
+
+    def on_partitions_revoked(self, revoked: set[TopicPartition]) -> None:
+        try:
+            self.notif_consumer._commit_completed()
+
+        except KafkaError as e:
+            self.notif_consumer.logger.error(f"Failed to commit completed notifications before a rebalance! Reason: {str(e)}")
+
+        self.notif_consumer.dispatcher.forget_partitions(revoked)
+
+    def on_partitions_assigned(self, assigned: set[TopicPartition]) -> None:
+        self.notif_consumer.dispatcher.forget_partitions(assigned)
 
 class EmailNotifConsumer:
     TOPIC: typing.Final[str] = "email-notifs"
     BOOTSTRAP_SERVERS: typing.Final[str] = "kafka:9092"
 
-    def __init__(self, logger: Logger) -> None:
+    DISPATCH_LANES: typing.Final[int] = 16
+    # NOTE: Large enough that coalesced emails held for up to COALESCE_MAX_DELAY_S don't stop
+    # the consumer from reading on during a spike
+    MAX_IN_FLIGHT_NOTIFS: typing.Final[int] = 10_000
+
+    # NOTE: Worst case a failing email holds its partition's commits back for roughly the sum
+    # of the backoffs (~1 + 2 + 4 + 8s) before it's dead lettered
+    MAX_SEND_ATTEMPTS: typing.Final[int] = 5
+    RETRY_BASE_DELAY_S: typing.Final[float] = 1.0
+    RETRY_MAX_DELAY_S: typing.Final[float] = 30.0
+
+    # NOTE: Trade emails to a recipient who was emailed within the last COALESCE_WINDOW_S are held
+    # and sent as a single digest once they go quiet for COALESCE_WINDOW_S, or COALESCE_MAX_DELAY_S
+    # after the first was held, whichever comes first. Password updates are never delayed
+    COALESCE_WINDOW_S: typing.Final[float] = 30.0
+    COALESCE_MAX_DELAY_S: typing.Final[float] = 120.0
+    COALESCE_MAX_BATCH: typing.Final[int] = 50
+    COALESCED_NOTIF_TYPES: typing.Final[frozenset[str]] = frozenset({
+        "trade_offer_init",
+        "trade_offer_accepted",
+        "trade_offer_rejected",
+    })
+
+    # NOTE: Token bucket limits on sends to the SMTP relay as a whole and to any one recipient,
+    # emails over a limit are queued until they're allowed through
+    SMTP_HOST_RATE_PER_S: typing.Final[float] = 20.0
+    SMTP_HOST_BURST: typing.Final[int] = 40
+    RECIPIENT_RATE_PER_S: typing.Final[float] = 0.2
+    RECIPIENT_BURST: typing.Final[int] = 5
+
+    # NOTE: How often the per partition lag gauge is refreshed from the poll loop
+    LAG_REFRESH_S: typing.Final[float] = 5.0
+
+    # NOTE: Pause after an error escapes the poll loop, so a broken broker isn't busy-spun against
+    ERROR_BACKOFF_S: typing.Final[float] = 1.0
+
+    # NOTE: A batch is whatever a single poll returns, up to BATCH_MAX_RECORDS records or
+    # however many arrived within BATCH_TIMEOUT_MS
+    BATCH_MAX_RECORDS: typing.Final[int] = 500
+    BATCH_TIMEOUT_MS: typing.Final[int] = 200
+
+    def __init__(
+        self,
+        logger: Logger,
+        batch_max_records: int = BATCH_MAX_RECORDS,
+        batch_timeout_ms: int = BATCH_TIMEOUT_MS
+    ) -> None:
         self.logger = logger
         self.emailer = Emailer(logger)
 
-        self.consumer: KafkaConsumer = KafkaConsumer(
-            self.TOPIC,
-            bootstrap_servers=self.BOOTSTRAP_SERVERS,
-            value_deserializer=lambda msg: json.loads(msg.decode("utf-8")),
-            auto_offset_reset="latest",
-            group_id="email-notif-stream"
+        self.batch_max_records: int = batch_max_records
+        self.batch_timeout_ms: int = batch_timeout_ms
+
+        self.dispatcher: NotifDispatcher = NotifDispatcher(
+            logger,
+            send=self._send_notif_emails,
+            lanes=self.DISPATCH_LANES,
+            max_in_flight=self.MAX_IN_FLIGHT_NOTIFS,
+            max_attempts=self.MAX_SEND_ATTEMPTS,
+            retry_base_delay_s=self.RETRY_BASE_DELAY_S,
+            retry_max_delay_s=self.RETRY_MAX_DELAY_S,
+            coalesce_window_s=self.COALESCE_WINDOW_S,
+            coalesce_max_delay_s=self.COALESCE_MAX_DELAY_S,
+            coalesce_max_batch=self.COALESCE_MAX_BATCH,
+            smtp_host=Emailer.ETHEREAL_SMTP_SERVER,
+            host_rate_per_s=self.SMTP_HOST_RATE_PER_S,
+            host_burst=self.SMTP_HOST_BURST,
+            recipient_rate_per_s=self.RECIPIENT_RATE_PER_S,
+            recipient_burst=self.RECIPIENT_BURST
         )
 
+        self.dead_letters: DeadLetterQueue = DeadLetterQueue(logger)
+        self.deduper: NotifDeduper = NotifDeduper(logger)
+
+        self.consumer: KafkaConsumer = self._new_consumer()
+
+        self.stopping: threading.Event = threading.Event()
+        self.fetching_paused: bool = False
+
+        self.lag_refreshed_at: float = 0.0
+        self.lag_partitions: set[str] = set()
+
         self.notif_handlers: dict = {
             "pw_update"            : self._handle_pw_update,
             "trade_offer_init"     : self._handle_trade_offer_init,
@@ -30,38 +129,267 @@ class EmailNotifConsumer:
             "trade_offer_rejected" : self._handle_trade_offer_rejected,
         }
 
+    # NOTE: Offsets are committed manually once a notification's emails have all been sent.
+    # Values are left as raw bytes and parsed per notification, a deserializer that raises would
+    # fail the whole poll and keep refetching the same poison message forever
+    def _new_consumer(self) -> KafkaConsumer:
+        consumer: KafkaConsumer = KafkaConsumer(
+            bootstrap_servers=self.BOOTSTRAP_SERVERS,
+            auto_offset_reset="latest",
+            group_id="email-notif-stream",
+            enable_auto_commit=False,
+            max_poll_records=self.batch_max_records
+        )
+        consumer.subscribe([self.TOPIC], listener=NotifRebalanceListener(self))
+
+        return consumer
+
+    # NOTE: At least once, a batch's offsets are only committed once every notification below them
+    # has been sent. Whatever is still in flight gets committed with a later batch (the poll timeout
+    # keeps batches coming even when the topic is quiet). Runs until `stop` is called
     def start_consuming_notifs(self) -> None:
-        while True:
+        while not self.stopping.is_set():
             try:
-                for notif in self.consumer:
-                    self._handle_notif(notif.value)
-                    self.consumer.commit()
+                batch: dict[TopicPartition, list[ConsumerRecord]] = self.consumer.poll(
+                    timeout_ms=self.batch_timeout_ms,
+                    max_records=self.batch_max_records
+                )
+
+                for tp, notifs in batch.items():
+                    for notif in notifs:
+                        self._dispatch_notif(tp, notif)
+
+                self._commit_completed()
+                self._apply_backpressure()
+                self._refresh_lag()
+
+                if not batch:
+                    self.emailer.recycle_idle_sessions()
 
             except KafkaError as e:
+                notif_errors.labels(stage="consume", error=type(e).__name__).inc()
                 self.logger.error(f"Failed to start consuming due to a kafka error! Reason: {str(e)}")
+                self.stopping.wait(self.ERROR_BACKOFF_S)
                 continue
 
             except Exception as e:
+                notif_errors.labels(stage="consume", error=type(e).__name__).inc()
                 self.logger.error(f"Failed to start consuming due to an unexpected error! Reason: {str(e)}")
+                self.stopping.wait(self.ERROR_BACKOFF_S)
+                continue
+
+        self._shutdown()
+
+    # NOTE: Only sets a flag, so it's safe to call from a signal handler. The poll loop finishes
+    # the batch it's on and then shuts everything down
+    def stop(self) -> None:
+        self.stopping.set()
+
+    # NOTE: Held emails are flushed and sends already on the lanes finish, then whatever completed is
+    # committed. Anything still waiting on a retry or the rate limits is dropped uncommitted and is
+    # redelivered to whichever consumer picks up the partition next
+    def _shutdown(self) -> None:
+        self.logger.info("Consumer stopping!")
+
+        self.dispatcher.shutdown()
+        self.deduper.release_all()
+
+        try:
+            self._commit_completed()
+
+        except KafkaError as e:
+            self.logger.error(f"Failed to commit completed notifications on shutdown! Reason: {str(e)}")
+
+        self.consumer.close(autocommit=False)
+        self.emailer.close()
+        self.dead_letters.close()
+
+        self.logger.info("Consumer stopped!")
+
+    # NOTE: Once the dispatcher holds MAX_IN_FLIGHT_NOTIFS, fetching is paused rather than blocking
+    # the poll loop, which has to keep polling (and committing) or the group would drop this
+    # consumer after max_poll_interval_ms. Partitions assigned while paused are paused as well
+    def _apply_backpressure(self) -> None:
+        if self.dispatcher.saturated():
+            if not self.fetching_paused:
+                self.logger.warning("Too many notifications in flight, pausing fetching!")
+
+            self.consumer.pause(*self.consumer.assignment())
+            self.fetching_paused = True
+            return
+
+        if self.fetching_paused:
+            self.logger.info("Notifications in flight back under the limit, resuming fetching!")
+
+            self.consumer.resume(*self.consumer.paused())
+            self.fetching_paused = False
+
+    # NOTE: Lag is how far the consumer's position trails the partition's highwater mark (as of the
+    # last fetch), partitions that were revoked by a rebalance stop being reported
+    def _refresh_lag(self) -> None:
+        now: float = time.monotonic()
+        if now - self.lag_refreshed_at < self.LAG_REFRESH_S:
+            return
+
+        self.lag_refreshed_at = now
+
+        assigned: set[str] = set()
+        for tp in self.consumer.assignment():
+            highwater: int | None = self.consumer.highwater(tp)
+            if highwater is None:
                 continue
 
-    def _handle_notif(self, notif: dict) -> None:
+            partition: str = str(tp.partition)
+            notif_consumer_lag.labels(partition=partition).set(max(0, highwater - self.consumer.position(tp)))
+            assigned.add(partition)
+
+        for partition in self.lag_partitions - assigned:
+            notif_consumer_lag.remove(partition)
+
+        self.lag_partitions = assigned
+
+    # NOTE: A notification that can't be parsed or handled will never succeed, so it's dead lettered
+    # straight away (and its offset completed) instead of being retried
+    def _dispatch_notif(self, tp: TopicPartition, notif: ConsumerRecord) -> None:
+        produced_at: float = notif.timestamp / 1000
+
+        # NOTE: Anything raised for a single notification is dead lettered here rather than let out to
+        # the poll loop, which would skip the rest of the batch without ever starting their offsets
+        try:
+            value: dict = self._parse_notif(notif.value)
+
+        except Exception as e:
+            notif_errors.labels(stage="parse", error=type(e).__name__).inc()
+            self.logger.error(f"Dead lettering unparseable notification at offset {notif.offset} of {tp}! Reason: {str(e)}")
+            self.dead_letters.publish(
+                tp, notif.offset, DeadLetterStage.PARSE, str(e), attempts=0,
+                raw=notif.value.decode("utf-8", errors="replace") if notif.value is not None else None
+            )
+            self.dispatcher.submit(tp, notif.offset, [], produced_at, self._dead_letter_for(tp, notif.offset, {}))
+            return
+
+        try:
+            notif_emails: list[NotifEmail] = self._handle_notif(value)
+
+        except Exception as e:
+            notif_errors.labels(stage="handle", error=type(e).__name__).inc()
+            self.logger.error(f"Dead lettering malformed notification at offset {notif.offset} of {tp}! Reason: {str(e)}")
+            self.dead_letters.publish(tp, notif.offset, DeadLetterStage.HANDLE, str(e), attempts=0, notif=value)
+            notif_emails = []
+
+        # NOTE: Set on notifications replayed from the dead letter topic, so only the recipients
+        # whose emails failed get them again
+        recipients: list[str] | None = value.get("recipients")
+        if recipients is not None:
+            notif_emails = [notif_email for notif_email in notif_emails if notif_email.email in recipients]
+
+        event_id: str | None = value.get("event_id")
+        if event_id is not None:
+            notif_emails = [dataclasses.replace(notif_email, event_id=event_id) for notif_email in notif_emails]
+
+        # NOTE: Only known types are used as a metric label, anything else could be unbounded
+        raw_type: typing.Any = value.get("type")
+        notif_type: str = raw_type if isinstance(raw_type, str) and raw_type in self.notif_handlers else "unknown"
+
+        self.dispatcher.submit(
+            tp, notif.offset, notif_emails, produced_at, self._dead_letter_for(tp, notif.offset, value),
+            coalesce=notif_type in self.COALESCED_NOTIF_TYPES,
+            notif_type=notif_type
+        )
+
+    # NOTE: Runs on the dispatcher's lanes, every email is to the same recipient and more than one
+    # is sent as a single digest. An email claimed by another consumer defers the send (without
+    # using up an attempt), so it's checked again once that consumer has either sent it or its claim
+    # has expired. Claims this send took are given back if it fails, so its retry (or whichever
+    # consumer the notification is redelivered to) doesn't find it claimed
+    def _send_notif_emails(self, notif_emails: list[NotifEmail]) -> None:
+        unsent: list[NotifEmail] = []
+
+        try:
+            for notif_email in notif_emails:
+                if notif_email.event_id is None:
+                    unsent.append(notif_email)
+                    continue
+
+                claim: ClaimResult = self.deduper.claim(notif_email)
+                if claim == ClaimResult.SENT:
+                    self.logger.info(f"Skipping already sent email for event '{notif_email.event_id}'")
+                    continue
+
+                if claim == ClaimResult.CLAIMED_ELSEWHERE:
+                    raise NotifClaimedElsewhere(f"Email for event '{notif_email.event_id}' is being sent by another consumer!")
+
+                unsent.append(notif_email)
+
+            if not unsent:
+                return
+
+            self.emailer.send_notif_email(unsent[0] if len(unsent) == 1 else self.emailer.build_digest(unsent))
+
+        except Exception:
+            for notif_email in unsent:
+                if notif_email.event_id is not None:
+                    self.deduper.release(notif_email)
+
+            raise
+
+        for notif_email in unsent:
+            if notif_email.event_id is not None:
+                self.deduper.mark_sent(notif_email)
+
+    # NOTE: Also checks the fields `_dispatch_notif` reads itself, the rest are up to the handlers
+    def _parse_notif(self, raw: bytes | None) -> dict:
+        if raw is None:
+            raise ValueError("Expected a JSON object but got an empty message!")
+
+        value = json.loads(raw.decode("utf-8"))
+        if not isinstance(value, dict):
+            raise ValueError(f"Expected a JSON object but got {type(value).__name__}!")
+
+        recipients = value.get("recipients")
+        if recipients is not None and not (isinstance(recipients, list) and all(isinstance(r, str) for r in recipients)):
+            raise ValueError(f"Expected recipients to be a list of emails but got {type(recipients).__name__}!")
+
+        event_id = value.get("event_id")
+        if event_id is not None and not isinstance(event_id, str):
+            raise ValueError(f"Expected event_id to be a string but got {type(event_id).__name__}!")
+
+        return value
+
+    def _dead_letter_for(self, tp: TopicPartition, offset: int, notif: dict) -> DeadLetter:
+        def _dead_letter(notif_email: NotifEmail, reason: str, attempts: int) -> None:
+            if notif_email.event_id is not None:
+                self.deduper.release(notif_email)
+
+            self.dead_letters.publish(
+                tp, offset, DeadLetterStage.SEND, reason, attempts,
+                notif=notif, recipients=[notif_email.email]
+            )
+
+        return _dead_letter
+
+    def _commit_completed(self) -> None:
+        committable: dict[TopicPartition, OffsetAndMetadata] = self.dispatcher.pop_committable()
+        if committable:
+            self.consumer.commit(offsets=committable)
+
+    def _handle_notif(self, notif: dict) -> list[NotifEmail]:
         notif_type = notif.get("type")
         notif_handler = self.notif_handlers.get(notif_type)
         if notif_handler is None:
             raise ValueError(f"Failed to find handler for unexpected notification type: {notif_type}!")
 
-        notif_handler(notif)
+        return notif_handler(notif)
 
-    def _handle_pw_update(self, notif: dict) -> None:
+    def _handle_pw_update(self, notif: dict) -> list[NotifEmail]:
         self.logger.info(notif)
 
-        self.emailer.send_pw_update(
+        return self.emailer.build_pw_update(
             notif["name"],
             *notif["auth_combo"]
         )
 
-    def _handle_trade_offer_init(self, notif: dict) -> None:
+    def _handle_trade_offer_init(self, notif: dict) -> list[NotifEmail]:
         self.logger.info(notif)
 
         trade_id: str = notif["trade_id"]
@@ -71,14 +399,14 @@ class EmailNotifConsumer:
 
         games: tuple[str, str] = tuple(notif["games"])
 
-        self.emailer.send_trade_offer_init(
+        return self.emailer.build_trade_offer_init(
             trade_id=trade_id,
             sender_info=sender_info,
             receiver_info=receiver_info,
             games=games
         )
 
-    def _handle_trade_offer_accepted(self, notif: dict) -> None:
+    def _handle_trade_offer_accepted(self, notif: dict) -> list[NotifEmail]:
         self.logger.info(notif)
 
         sender_info: tuple[str, str, str] = tuple(notif["sender_info"])
@@ -86,13 +414,13 @@ class EmailNotifConsumer:
 
         games: tuple[str, str] = tuple(notif["games"])
 
-        self.emailer.send_trade_offer_accepted(
+        return self.emailer.build_trade_offer_accepted(
             sender_info=sender_info,
             receiver_info=receiver_info,
             games=games
         )
 
-    def _handle_trade_offer_rejected(self, notif: dict) -> None:
+    def _handle_trade_offer_rejected(self, notif: dict) -> list[NotifEmail]:
         self.logger.info(notif)
 
         sender_info: tuple[str, str, str] = tuple(notif["sender_info"])
@@ -100,7 +428,7 @@ class EmailNotifConsumer:
 
         games: tuple[str, str] = tuple(notif["games"])
 
-        self.emailer.send_trade_offer_rejected(
+        return self.emailer.build_trade_offer_rejected(
             sender_info=sender_info,
             receiver_info=receiver_info,
             games=games
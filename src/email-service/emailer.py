@@ -1,177 +1,168 @@
 # NOTE: [AI CITATION] Used chatGPT to introduce using email.message/smtplib, but all of the code is mine
 
+import time
 import typing
-import smtplib
-import threading
+import functools
 
 from logging import Logger
-from email.message import EmailMessage
+from dataclasses import dataclass
 from ssl import SSLContext, create_default_context
 
+from smtp_pool import SMTPPool
+from mime import SENDER, render_mime
+from templates import TEMPLATES, RenderedEmail
+from metrics import smtp_send_latency_histo
+
+# NOTE: A single email to a single recipient, every notification is built into one or more of
+# these so that they can be dispatched (and ordered) per recipient. `event_id` is the id of the
+# notification it was built from (None for notifications published before event ids existed)
+@dataclass(frozen=True)
+class NotifEmail:
+    email: str
+    password: str
+    subject: str
+    body: str
+    event_id: str | None = None
+    html: str | None = None
+
 class Emailer:
     ETHEREAL_SMTP_SERVER: typing.Final[str] = "smtp.ethereal.email"
     ETHEREAL_SMTP_STARTTLS_PORT: typing.Final[int] = 587
 
+    SMTP_TIMEOUT_S: typing.Final[float] = 15.0
+    SMTP_SESSION_MAX_IDLE_S: typing.Final[float] = 60.0
+    SMTP_SESSION_MAX_SENDS: typing.Final[int] = 100
+    SMTP_MAX_IDLE_SESSIONS_PER_KEY: typing.Final[int] = 4
+
+    # NOTE: Rendered messages are kept around for retries and redeliveries of the same email
+    RENDER_CACHE_SIZE: typing.Final[int] = 1024
+
     def __init__(self, logger: Logger) -> None:
         self.logger: Logger = logger
         self.ssl_ctx: SSLContext = create_default_context()
 
-    def _send_notif_email(
-        self,
-        email: str,
-        password: str,
-        subject: str,
-        body: str
-    ) -> None:
-        def _internal_send() -> None:
-            notif_msg: EmailMessage = EmailMessage()
-            notif_msg["From"]    = "noreply@email-service.com"
-            notif_msg["To"]      = email
-            notif_msg["Subject"] = subject
-            notif_msg.set_content(body)
-
-            with smtplib.SMTP(
+        self.smtp_pool: SMTPPool = SMTPPool(
+            logger,
+            ssl_ctx=self.ssl_ctx,
+            max_idle_s=self.SMTP_SESSION_MAX_IDLE_S,
+            max_sends_per_session=self.SMTP_SESSION_MAX_SENDS,
+            max_idle_sessions_per_key=self.SMTP_MAX_IDLE_SESSIONS_PER_KEY,
+            timeout=self.SMTP_TIMEOUT_S
+        )
+
+        self.render: typing.Callable[[str, str, str, str | None], bytes] = functools.lru_cache(
+            maxsize=self.RENDER_CACHE_SIZE
+        )(render_mime)
+
+    # NOTE: Blocking, concurrency comes from the consumer's dispatcher running this on its workers
+    def send_notif_email(self, notif_email: NotifEmail) -> None:
+        notif_msg: bytes = self.render(notif_email.email, notif_email.subject, notif_email.body, notif_email.html)
+
+        start: float = time.perf_counter()
+
+        self.smtp_pool.send(
+            (
                 self.ETHEREAL_SMTP_SERVER,
                 self.ETHEREAL_SMTP_STARTTLS_PORT,
-                timeout=15
-            ) as smtp_server:
-                smtp_server.starttls(context=self.ssl_ctx)
-                smtp_server.login(email, password)
-                smtp_server.send_message(notif_msg)
+                notif_email.email,
+                notif_email.password
+            ),
+            SENDER,
+            notif_email.email,
+            notif_msg
+        )
+
+        smtp_send_latency_histo.observe(time.perf_counter() - start)
+
+    def recycle_idle_sessions(self) -> None:
+        self.smtp_pool.recycle_idle()
+
+    def close(self) -> None:
+        self.smtp_pool.close_all()
+
+    def _notif_email(self, email: str, password: str, rendered: RenderedEmail) -> NotifEmail:
+        return NotifEmail(
+            email=email,
+            password=password,
+            subject=rendered.subject,
+            body=rendered.text,
+            html=rendered.html
+        )
+
+    # NOTE: Several emails to the same recipient rolled into one, the latest email's credentials
+    # are used as they're the freshest
+    def build_digest(self, notif_emails: list[NotifEmail]) -> NotifEmail:
+        sections: str = "\n".join(
+            f"--- {notif_email.subject} ---\n{notif_email.body.rstrip()}\n"
+            for notif_email in notif_emails
+        )
+
+        rendered: RenderedEmail = TEMPLATES["digest"].sender.render({
+            "count"    : str(len(notif_emails)),
+            "sections" : sections,
+        })
 
-        email_thread = threading.Thread(target=_internal_send)
-        email_thread.start()
-        email_thread.join(timeout=15)
+        return self._notif_email(notif_emails[-1].email, notif_emails[-1].password, rendered)
 
-    def send_pw_update(
+    def build_pw_update(
         self,
         name: str,
         email: str,
         password: str
-    ) -> None:
-        body: str = (
-            f"Hello, {name}!\n"
-            "Your password has been successfully reset!\n"
-            "If this was not you then contact support immediately!\n"
-            "Sincerely, Notification Service"
-        )
+    ) -> list[NotifEmail]:
+        rendered: RenderedEmail = TEMPLATES["pw_update"].sender.render({"name": name})
 
-        self._send_notif_email(
-            email=email,
-            password=password,
-            subject="Password Update",
-            body=body
-        )
+        return [self._notif_email(email, password, rendered)]
 
-    def send_trade_offer_init(
+    def build_trade_offer_init(
         self,
         trade_id: str,
         sender_info: tuple[str, str, str],
         receiver_info: tuple[str, str, str],
         games: tuple[str, str]
-    ) -> None:
-        sender_name, sender_email, sender_password = sender_info
-        receiver_name, receiver_email, receiver_password = receiver_info
-        offered_game, requested_game = games
-
-        sender_body: str = (
-            f"Hello, {sender_name}!\n"
-            f"We have received your trade offer of {offered_game} for {requested_game} from {receiver_name} | {receiver_email}!\n"
-            f"The trade ID of your trade offer is {trade_id}!\n"
-            "Sincerely, ok\n"
-        )
+    ) -> list[NotifEmail]:
+        return self._build_trade_notif("trade_offer_init", sender_info, receiver_info, games, trade_id=trade_id)
 
-        self._send_notif_email(
-            email=sender_email,
-            password=sender_password,
-            subject="Trade offer processed",
-            body=sender_body
-        )
-
-        receiver_body: str = (
-            f"Hello, {receiver_name}!\n"
-            f"You have received a trade offer from '{sender_name}/{sender_email}'!\n"
-            f"They have offered '{offered_game}' for '{requested_game}'!\n"
-            f"Use this trade ID: '/api/trades/accept/{trade_id}' or '/api/trades/reject/{trade_id}' to accept/reject the offer!\n"
-            "Sincerely, yeah whatever"
-        )
-
-        self._send_notif_email(
-            email=receiver_email,
-            password=receiver_password,
-            subject="Trade offer received",
-            body=receiver_body
-        )
-
-    def send_trade_offer_accepted(
+    def build_trade_offer_accepted(
         self,
         sender_info: tuple[str, str, str],
         receiver_info: tuple[str, str, str],
         games: tuple[str, str]
-    ) -> None:
-        sender_name, sender_email, sender_password = sender_info
-        receiver_name, receiver_email, receiver_password = receiver_info
-        offered_game, requested_game = games
-
-        sender_body: str = (
-            f"Hello, {sender_name}!\n"
-            f"Your trade offer of '{offered_game}' for '{requested_game}' from '{receiver_name}/{receiver_email}' was successfully accepted!\n"
-            "Sincerely, yep yep yep\n"
-        )
-
-        self._send_notif_email(
-            email=sender_email,
-            password=sender_password,
-            subject="Trade offer accepted",
-            body=sender_body
-        )
-
-        receiver_body: str = (
-            f"Hello, {receiver_name}!\n"
-            f"The trade offer of '{requested_game}' for '{offered_game}' from '{sender_name}/{sender_email}' was successfully accepted!\n"
-            "Sincerely, yep yep yep\n"
-        )
+    ) -> list[NotifEmail]:
+        return self._build_trade_notif("trade_offer_accepted", sender_info, receiver_info, games)
 
-        self._send_notif_email(
-            email=receiver_email,
-            password=receiver_password,
-            subject="Trade offer accepted",
-            body=receiver_body
-        )
-
-    def send_trade_offer_rejected(
+    def build_trade_offer_rejected(
         self,
         sender_info: tuple[str, str, str],
         receiver_info: tuple[str, str, str],
         games: tuple[str, str]
-    ) -> None:
+    ) -> list[NotifEmail]:
+        return self._build_trade_notif("trade_offer_rejected", sender_info, receiver_info, games)
+
+    # NOTE: Both traders' emails are rendered from the same values in one go
+    def _build_trade_notif(
+        self,
+        notif_type: str,
+        sender_info: tuple[str, str, str],
+        receiver_info: tuple[str, str, str],
+        games: tuple[str, str],
+        **extra: str
+    ) -> list[NotifEmail]:
         sender_name, sender_email, sender_password = sender_info
         receiver_name, receiver_email, receiver_password = receiver_info
         offered_game, requested_game = games
 
-        sender_body: str = (
-            f"Hello, {sender_name}!\n"
-            f"Your trade offer of '{offered_game}' for '{requested_game}' from '{receiver_name}/{receiver_email}' was unfortunately rejected :(!\n"
-            "Sincerely, yep yep yep\n"
-        )
-
-        self._send_notif_email(
-            email=sender_email,
-            password=sender_password,
-            subject="Trade offer rejected :(",
-            body=sender_body
-        )
-
-        receiver_body: str = (
-            f"Hello, {receiver_name}!\n"
-            f"The trade offer of '{requested_game}' for '{offered_game}' from '{sender_name}/{sender_email}' was unfortunately rejected!\n"
-            "Sincerely, yep yep yep\n"
-        )
-
-        self._send_notif_email(
-            email=receiver_email,
-            password=receiver_password,
-            subject="Trade offer rejected",
-            body=receiver_body
-        )
-
+        sender_msg, receiver_msg = TEMPLATES[notif_type].render_pair({
+            "sender_name"    : sender_name,
+            "sender_email"   : sender_email,
+            "receiver_name"  : receiver_name,
+            "receiver_email" : receiver_email,
+            "offered_game"   : offered_game,
+            "requested_game" : requested_game,
+            **extra,
+        })
+
+        return [
+            self._notif_email(sender_email, sender_password, sender_msg),
+            self._notif_email(receiver_email, receiver_password, receiver_msg),
+        ]
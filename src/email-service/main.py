@@ -1,5 +1,9 @@
 from email_notif_consumer import EmailNotifConsumer
+from metrics import METRICS_PORT
 
+from prometheus_client import start_http_server
+
+import signal
 import logging
 logging.basicConfig(
     level=logging.INFO,
@@ -12,9 +16,19 @@ if __name__ == "__main__":
 
     logger.info("Email service Started!")
 
+    start_http_server(METRICS_PORT)
+    logger.info(f"Metrics served on port {METRICS_PORT}!")
+
     try:
+        consumer: EmailNotifConsumer = EmailNotifConsumer(logger)
+
+        # NOTE: `docker stop` sends SIGTERM, the consumer gets until the stop timeout to wind down
+        # before it's killed outright
+        signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: consumer.stop())
+
         logger.info("Consumer started!")
-        EmailNotifConsumer(logger).start_consuming_notifs()
+        consumer.start_consuming_notifs()
 
     except Exception as e:
         logging.error(e)
@@ -0,0 +1,145 @@
+import typing
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# NOTE: Served by `start_http_server` in main.py and scraped by prometheus as the "email-service" job
+METRICS_PORT: typing.Final[int] = 8000
+
+smtp_handshakes: Counter = Counter(
+    "email_smtp_handshakes_total",
+    "SMTP sessions opened (connect + STARTTLS + LOGIN)"
+)
+
+smtp_handshake_latency_histo: Histogram = Histogram(
+    "email_smtp_handshake_latency_s",
+    "Time to open an SMTP session (connect + STARTTLS + LOGIN) in seconds",
+    buckets=[0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+)
+
+smtp_session_reuses: Counter = Counter(
+    "email_smtp_session_reuses_total",
+    "Emails sent over an already warm pooled SMTP session"
+)
+
+smtp_session_recycles: Counter = Counter(
+    "email_smtp_session_recycles_total",
+    "Pooled SMTP sessions closed",
+    ["reason"]
+)
+
+smtp_send_latency_histo: Histogram = Histogram(
+    "email_smtp_send_latency_s",
+    "Time to send a single email, including any handshake it needed, in seconds",
+    buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+)
+
+notif_retries: Counter = Counter(
+    "email_notif_retries_total",
+    "Failed email sends scheduled for another attempt"
+)
+
+notif_retries_pending: Gauge = Gauge(
+    "email_notif_retries_pending",
+    "Failed email sends waiting in the retry delay heap"
+)
+
+notif_dead_letters: Counter = Counter(
+    "email_notif_dead_letters_total",
+    "Email notifications published to the dead letter topic",
+    ["stage"]
+)
+
+notif_dead_letter_failures: Counter = Counter(
+    "email_notif_dead_letter_failures_total",
+    "Dead letters that couldn't be published and were dropped"
+)
+
+# NOTE: The dead letter topic's end offsets minus where the replay group (replay_dlq.py) left off,
+# or minus the start of the topic if it has never been replayed. Refreshed every 30s by DeadLetterQueue
+notif_dead_letter_depth: Gauge = Gauge(
+    "email_notif_dead_letter_depth",
+    "Dead letters that haven't been replayed yet"
+)
+
+notif_time_to_delivery_histo: Histogram = Histogram(
+    "email_notif_time_to_delivery_s",
+    "Time from a notification being produced to one of its emails being sent, including retries, in seconds",
+    buckets=[0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+)
+
+notif_duplicates_skipped: Counter = Counter(
+    "email_notif_duplicates_skipped_total",
+    "Redelivered emails skipped because they had already been sent"
+)
+
+notif_dedupe_errors: Counter = Counter(
+    "email_notif_dedupe_errors_total",
+    "Dedupe store operations that failed (the email is sent undeduped)"
+)
+
+# NOTE: The coalescing ratio is emails in / sends out, i.e.
+# rate(email_notif_coalescer_emails_in_total[5m]) / rate(email_notif_coalescer_sends_out_total[5m])
+notif_coalescer_emails_in: Counter = Counter(
+    "email_notif_coalescer_emails_in_total",
+    "Emails handed to the coalescer"
+)
+
+notif_coalescer_sends_out: Counter = Counter(
+    "email_notif_coalescer_sends_out_total",
+    "Sends (single emails or digests) flushed by the coalescer"
+)
+
+notif_coalescer_held: Gauge = Gauge(
+    "email_notif_coalescer_held",
+    "Emails currently held by the coalescer waiting to be flushed"
+)
+
+notif_digest_size_histo: Histogram = Histogram(
+    "email_notif_digest_size",
+    "Emails per send flushed by the coalescer",
+    buckets=[1, 2, 3, 5, 10, 20, 50]
+)
+
+email_rate_limit_queued: Gauge = Gauge(
+    "email_rate_limit_queued",
+    "Emails queued waiting on a recipient or SMTP host rate limit"
+)
+
+email_rate_limited: Counter = Counter(
+    "email_rate_limited_total",
+    "Sends that had to wait, by the limit that held them back",
+    ["limit"]
+)
+
+email_rate_limit_wait_histo: Histogram = Histogram(
+    "email_rate_limit_wait_s",
+    "Time a send waited on the rate limits in seconds (0 when it didn't have to)",
+    buckets=[0.0, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0]
+)
+
+# NOTE: From the consumer picking a notification up to every one of its emails being sent or
+# dead lettered, so it includes any coalescing, rate limit and retry waits
+notif_handle_latency_histo: Histogram = Histogram(
+    "email_notif_handle_latency_s",
+    "Time to fully handle a notification in seconds",
+    ["type"],
+    buckets=[0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+)
+
+notif_in_flight: Gauge = Gauge(
+    "email_notif_in_flight",
+    "Notifications consumed but not yet fully handled (i.e. not yet committable)"
+)
+
+# NOTE: Highwater minus position, refreshed by the consumer's poll loop
+notif_consumer_lag: Gauge = Gauge(
+    "email_notif_consumer_lag",
+    "Notifications on a partition that the consumer hasn't read yet",
+    ["partition"]
+)
+
+notif_errors: Counter = Counter(
+    "email_notif_errors_total",
+    "Errors while consuming, parsing, handling or sending notifications",
+    ["stage", "error"]
+)
@@ -0,0 +1,80 @@
+import uuid
+import typing
+import functools
+
+from email.header import Header
+from email import base64mime
+from email.message import EmailMessage
+
+SENDER: typing.Final[str] = "noreply@email-service.com"
+
+# NOTE: SMTP's hard limit on line length (excluding the CRLF)
+MAX_LINE_LENGTH: typing.Final[int] = 998
+
+# NOTE: One per process, the odds of it turning up in a rendered body are nil
+BOUNDARY: typing.Final[str] = f"=============={uuid.uuid4().hex}=="
+
+# NOTE: Building an `EmailMessage` and having smtplib flatten it costs ~1.5ms per email, which caps
+# a single core at a few hundred emails a second once SMTP sessions are pooled. The messages sent
+# here are always the same shape (a text body and maybe an HTML alternative), so they're written
+# out directly instead, with each subject's headers encoded once and cached
+def render_mime(to: str, subject: str, text: str, html: str | None = None) -> bytes:
+    if "\r" in to or "\n" in to or "\r" in subject or "\n" in subject:
+        raise ValueError("Email headers can't contain line breaks!")
+
+    # NOTE: Internationalised addresses need proper header encoding, which isn't worth redoing here
+    if not to.isascii():
+        return _render_email_message(to, subject, text, html)
+
+    headers: bytes = b"To: " + to.encode("ascii") + b"\r\n" + _subject_headers(subject)
+
+    if html is None:
+        return headers + _body_part("plain", text)
+
+    return b"".join((
+        headers,
+        f'Content-Type: multipart/alternative; boundary="{BOUNDARY}"\r\n\r\n'.encode("ascii"),
+        f"--{BOUNDARY}\r\n".encode("ascii"),
+        _body_part("plain", text),
+        f"\r\n--{BOUNDARY}\r\n".encode("ascii"),
+        _body_part("html", html),
+        f"\r\n--{BOUNDARY}--\r\n".encode("ascii"),
+    ))
+
+@functools.lru_cache(maxsize=256)
+def _subject_headers(subject: str) -> bytes:
+    encoded_subject: str = subject if subject.isascii() else Header(subject, "utf-8").encode()
+
+    return (
+        f"From: {SENDER}\r\n"
+        f"Subject: {encoded_subject}\r\n"
+        "MIME-Version: 1.0\r\n"
+    ).encode("ascii")
+
+def _body_part(subtype: str, body: str) -> bytes:
+    lines: list[str] = body.replace("\r\n", "\n").split("\n")
+
+    if body.isascii() and all(len(line) <= MAX_LINE_LENGTH for line in lines):
+        encoding: str = "7bit"
+        payload: bytes = "\r\n".join(lines).encode("ascii")
+
+    else:
+        encoding = "base64"
+        payload = base64mime.body_encode(body.encode("utf-8"), maxlinelen=76, eol="\r\n").encode("ascii")
+
+    return (
+        f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+        f"Content-Transfer-Encoding: {encoding}\r\n\r\n"
+    ).encode("ascii") + payload
+
+def _render_email_message(to: str, subject: str, text: str, html: str | None) -> bytes:
+    msg: EmailMessage = EmailMessage()
+    msg["From"]    = SENDER
+    msg["To"]      = to
+    msg["Subject"] = subject
+    msg.set_content(text)
+
+    if html is not None:
+        msg.add_alternative(html, subtype="html")
+
+    return msg.as_bytes()
@@ -0,0 +1,378 @@
+import time
+import random
+import typing
+import smtplib
+import functools
+import threading
+
+from logging import Logger
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from emailer import NotifEmail
+from coalescer import NotifCoalescer
+from rate_limiter import RateLimiter
+from delay_scheduler import DelayScheduler
+from metrics import (
+    notif_retries,
+    notif_retries_pending,
+    notif_time_to_delivery_histo,
+    notif_handle_latency_histo,
+    notif_in_flight,
+    notif_errors,
+    email_rate_limit_queued,
+    email_rate_limited,
+    email_rate_limit_wait_histo
+)
+
+from kafka.structs import TopicPartition, OffsetAndMetadata
+
+# NOTE: One delivery of an offset, the same offset can be delivered (and started) more than once,
+# e.g. when a rebalance or a seek hands it out again while the first copy is still in flight
+@dataclass(slots=True)
+class TrackedOffset:
+    tp: TopicPartition
+    offset: int
+    completed: bool = False
+
+# NOTE: Tracks which offsets of each partition have finished. Notifications complete out of order,
+# so only the highest offset below which *everything* has completed is safe to commit
+class OffsetTracker:
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.started: dict[TopicPartition, deque[TrackedOffset]] = {}
+
+    def start(self, tp: TopicPartition, offset: int) -> TrackedOffset:
+        tracked: TrackedOffset = TrackedOffset(tp, offset)
+
+        with self.lock:
+            self.started.setdefault(tp, deque()).append(tracked)
+
+        return tracked
+
+    def complete(self, tracked: TrackedOffset) -> None:
+        with self.lock:
+            tracked.completed = True
+
+    # NOTE: Called when partitions are revoked or assigned, whatever is still in flight for them
+    # completes without effect and is redelivered to (or by) whoever owns the partition next
+    def forget(self, tps: typing.Iterable[TopicPartition]) -> None:
+        with self.lock:
+            for tp in tps:
+                self.started.pop(tp, None)
+
+    def pop_committable(self) -> dict[TopicPartition, OffsetAndMetadata]:
+        committable: dict[TopicPartition, OffsetAndMetadata] = {}
+
+        with self.lock:
+            for tp, started in self.started.items():
+                # NOTE: A redelivered offset is started after higher ones, so the highest offset
+                # popped is committed rather than the last one
+                highest: int | None = None
+                while started and started[0].completed:
+                    popped: int = started.popleft().offset
+                    highest = popped if highest is None else max(highest, popped)
+
+                # NOTE: The committed offset is the *next* offset to be consumed
+                if highest is not None:
+                    committable[tp] = OffsetAndMetadata(highest + 1, "", -1)
+
+        return committable
+
+# NOTE: (email, reason, attempts), called once an email has run out of attempts
+DeadLetter = typing.Callable[[NotifEmail, str, int], None]
+
+# NOTE: A notification still being dispatched, it completes once each of its emails has either
+# been sent or dead lettered
+class PendingNotif:
+    def __init__(
+        self,
+        tracked: TrackedOffset,
+        emails: int,
+        produced_at: float,
+        dead_letter: DeadLetter,
+        notif_type: str
+    ) -> None:
+        self.tracked: TrackedOffset = tracked
+        self.tp: TopicPartition = tracked.tp
+        self.offset: int = tracked.offset
+        self.produced_at: float = produced_at
+        self.dead_letter: DeadLetter = dead_letter
+
+        self.notif_type: str = notif_type
+        self.started_at: float = time.perf_counter()
+
+        self.remaining: int = emails
+        self.lock: threading.Lock = threading.Lock()
+
+    def settle(self) -> bool:
+        with self.lock:
+            self.remaining -= 1
+            return self.remaining == 0
+
+# NOTE: Raised by `send` when an email can't be sent yet but nothing has failed either (e.g. another
+# consumer holds its claim), it's tried again after the usual backoff without using up an attempt
+class SendDeferred(Exception):
+    pass
+
+# NOTE: Errors that another attempt won't fix, i.e. the server rejected the credentials or the
+# recipient (5xx), the rest (timeouts, dropped connections, 4xx) are worth retrying
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return False
+
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code < 500
+
+    return True
+
+# NOTE: One email of a pending notification, a single send carries one or more of these (all to
+# the same recipient) and its outcome settles each of them
+Part = tuple[PendingNotif, NotifEmail]
+
+# NOTE: Sends the emails of many notifications concurrently while keeping every recipient's emails
+# in order. Each recipient always hashes onto the same single threaded lane, so their emails are
+# sent one after another, while different recipients are spread across the other lanes.
+# Coalesced emails are held per recipient first and then sent together (as a digest) in one send.
+# Every send first waits (off the lanes) for its recipient's rate limit, then for the SMTP host's.
+# A failed send is retried with backoff off the lanes (a retry may therefore overtake newer emails
+# to the same recipient), and dead lettered once it runs out of attempts
+class NotifDispatcher:
+    def __init__(
+        self,
+        logger: Logger,
+        send: typing.Callable[[list[NotifEmail]], None],
+        lanes: int,
+        max_in_flight: int,
+        max_attempts: int,
+        retry_base_delay_s: float,
+        retry_max_delay_s: float,
+        coalesce_window_s: float,
+        coalesce_max_delay_s: float,
+        coalesce_max_batch: int,
+        smtp_host: str,
+        host_rate_per_s: float,
+        host_burst: int,
+        recipient_rate_per_s: float,
+        recipient_burst: int
+    ) -> None:
+        self.logger: Logger = logger
+        self.send: typing.Callable[[list[NotifEmail]], None] = send
+
+        self.lanes: list[ThreadPoolExecutor] = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"email-lane-{i}")
+            for i in range(lanes)
+        ]
+
+        # NOTE: Bounds how far the consumer can read ahead of the slowest email (retries and
+        # coalesced emails included). Submitting never blocks, the consumer stops fetching while
+        # `saturated` instead, so the cap can be overshot by up to one poll's worth
+        self.max_in_flight: int = max_in_flight
+        self.in_flight: int = 0
+        self.in_flight_lock: threading.Lock = threading.Lock()
+        self.offsets: OffsetTracker = OffsetTracker()
+
+        self.max_attempts: int = max_attempts
+        self.retry_base_delay_s: float = retry_base_delay_s
+        self.retry_max_delay_s: float = retry_max_delay_s
+        self.retries: DelayScheduler = DelayScheduler(logger, "email-retries", pending=notif_retries_pending)
+
+        # NOTE: Emails over a rate limit are queued here until their token comes round, never dropped
+        self.smtp_host: str = smtp_host
+        self.rate_limiter: RateLimiter = RateLimiter(
+            host_rate_per_s=host_rate_per_s,
+            host_burst=host_burst,
+            recipient_rate_per_s=recipient_rate_per_s,
+            recipient_burst=recipient_burst
+        )
+        # NOTE: Holds one task per throttled recipient (plus one per send waiting on the SMTP host),
+        # so email_rate_limit_queued is kept by the dispatcher instead, counting every send waiting
+        self.rate_limited: DelayScheduler = DelayScheduler(logger, "email-rate-limits")
+
+        self.rate_lock: threading.Lock = threading.Lock()
+        self.rate_queues: dict[str, deque[tuple[list[Part], int, float]]] = {}
+
+        self.coalescer: NotifCoalescer[Part] = NotifCoalescer(
+            logger,
+            flush=lambda parts: self._attempt(parts, attempt=1),
+            window_s=coalesce_window_s,
+            max_delay_s=coalesce_max_delay_s,
+            max_batch=coalesce_max_batch
+        )
+
+    def submit(
+        self,
+        tp: TopicPartition,
+        offset: int,
+        notif_emails: list[NotifEmail],
+        produced_at: float,
+        dead_letter: DeadLetter,
+        coalesce: bool = False,
+        notif_type: str = "unknown"
+    ) -> None:
+        with self.in_flight_lock:
+            self.in_flight += 1
+
+        tracked: TrackedOffset = self.offsets.start(tp, offset)
+        notif_in_flight.inc()
+
+        if not notif_emails:
+            notif_handle_latency_histo.labels(type=notif_type).observe(0.0)
+            self._complete(tracked)
+            return
+
+        pending: PendingNotif = PendingNotif(tracked, len(notif_emails), produced_at, dead_letter, notif_type)
+        for notif_email in notif_emails:
+            if coalesce:
+                self.coalescer.add(notif_email.email, (pending, notif_email))
+            else:
+                self._attempt([(pending, notif_email)], attempt=1)
+
+    # NOTE: Each recipient's sends queue up and only the one at the head waits on the rate limits, so
+    # they keep their order and each is spaced from when the previous one actually went out
+    def _attempt(self, parts: list[Part], attempt: int) -> None:
+        recipient: str = parts[0][1].email
+
+        with self.rate_lock:
+            queue: deque[tuple[list[Part], int, float]] = self.rate_queues.setdefault(recipient, deque())
+            queue.append((parts, attempt, time.monotonic()))
+            email_rate_limit_queued.inc()
+
+            # NOTE: Already being worked through
+            if len(queue) > 1:
+                return
+
+        self._drain_rate_queue(recipient)
+
+    def _drain_rate_queue(self, recipient: str) -> None:
+        while True:
+            wait_s: float = self.rate_limiter.recipient_wait(recipient)
+            if wait_s > 0:
+                email_rate_limited.labels(limit="recipient").inc()
+                self.rate_limited.schedule(wait_s, lambda: self._drain_rate_queue(recipient))
+                return
+
+            with self.rate_lock:
+                queue: deque[tuple[list[Part], int, float]] = self.rate_queues[recipient]
+                parts, attempt, queued_at = queue.popleft()
+
+                send_in_s: float = self.rate_limiter.reserve(self.smtp_host, recipient)
+
+                drained: bool = not queue
+                if drained:
+                    del self.rate_queues[recipient]
+
+            if send_in_s <= 0:
+                email_rate_limit_queued.dec()
+                email_rate_limit_wait_histo.observe(time.monotonic() - queued_at)
+                self._submit(parts, attempt)
+
+            else:
+                email_rate_limited.labels(limit="smtp_host").inc()
+                self.rate_limited.schedule(send_in_s, functools.partial(self._submit_rate_limited, parts, attempt, queued_at))
+
+            if drained:
+                return
+
+    def _submit_rate_limited(self, parts: list[Part], attempt: int, queued_at: float) -> None:
+        email_rate_limit_queued.dec()
+        email_rate_limit_wait_histo.observe(time.monotonic() - queued_at)
+        self._submit(parts, attempt)
+
+    def _submit(self, parts: list[Part], attempt: int) -> None:
+        recipient: str = parts[0][1].email
+
+        lane: ThreadPoolExecutor = self.lanes[hash(recipient) % len(self.lanes)]
+        lane.submit(self.send, [notif_email for _, notif_email in parts]).add_done_callback(
+            lambda future: self._on_attempt_done(future, parts, attempt)
+        )
+
+    def _on_attempt_done(self, future: Future, parts: list[Part], attempt: int) -> None:
+        exc: BaseException | None = future.exception()
+        if exc is None:
+            for pending, _ in parts:
+                notif_time_to_delivery_histo.observe(max(0.0, time.time() - pending.produced_at))
+                self._settle(pending)
+
+            return
+
+        recipient: str = parts[0][1].email
+
+        if isinstance(exc, SendDeferred):
+            defer_s: float = self._backoff_s(attempt)
+            self.logger.info(f"Deferring {len(parts)} email(s) to '{recipient}' for {defer_s:.1f}s! Reason: {str(exc)}")
+
+            # NOTE: Dropped while shutting down, the offsets are then left uncommitted for kafka to redeliver
+            self.retries.schedule(defer_s, lambda: self._attempt(parts, attempt))
+            return
+
+        notif_errors.labels(stage="send", error=type(exc).__name__).inc()
+
+        if attempt < self.max_attempts and is_retryable(exc):
+            delay_s: float = self._backoff_s(attempt)
+            self.logger.warning(
+                f"Failed attempt {attempt}/{self.max_attempts} to send {len(parts)} email(s) to '{recipient}', "
+                f"retrying in {delay_s:.1f}s! Reason: {str(exc)}"
+            )
+
+            # NOTE: Only false while shutting down, the offsets are then left uncommitted for kafka to redeliver
+            if self.retries.schedule(delay_s, lambda: self._attempt(parts, attempt + 1)):
+                notif_retries.inc()
+
+            return
+
+        self.logger.error(
+            f"Failed to send {len(parts)} email(s) to '{recipient}' after {attempt} attempt(s), "
+            f"dead lettering! Reason: {str(exc)}"
+        )
+
+        for pending, notif_email in parts:
+            try:
+                pending.dead_letter(notif_email, f"{type(exc).__name__}: {str(exc)}", attempt)
+
+            except Exception as e:
+                self.logger.error(f"Failed to dead letter email for offset {pending.offset} of {pending.tp}! Reason: {str(e)}")
+
+            self._settle(pending)
+
+    # NOTE: Exponential backoff with jitter, so a burst of failures against the same SMTP server
+    # doesn't come back as a burst of retries
+    def _backoff_s(self, attempt: int) -> float:
+        delay_s: float = min(self.retry_max_delay_s, self.retry_base_delay_s * 2 ** (attempt - 1))
+        return delay_s / 2 + random.uniform(0, delay_s / 2)
+
+    def _settle(self, pending: PendingNotif) -> None:
+        if pending.settle():
+            notif_handle_latency_histo.labels(type=pending.notif_type).observe(time.perf_counter() - pending.started_at)
+            self._complete(pending.tracked)
+
+    def pop_committable(self) -> dict[TopicPartition, OffsetAndMetadata]:
+        return self.offsets.pop_committable()
+
+    def saturated(self) -> bool:
+        with self.in_flight_lock:
+            return self.in_flight >= self.max_in_flight
+
+    def forget_partitions(self, tps: typing.Iterable[TopicPartition]) -> None:
+        self.offsets.forget(tps)
+
+    def _complete(self, tracked: TrackedOffset) -> None:
+        self.offsets.complete(tracked)
+        with self.in_flight_lock:
+            self.in_flight -= 1
+
+        notif_in_flight.dec()
+
+    # NOTE: The coalescer flushes whatever it's holding onto the lanes first, then the delay
+    # schedulers stop so that nothing gets submitted to a lane after it shuts down
+    def shutdown(self) -> None:
+        self.coalescer.shutdown()
+        self.retries.shutdown()
+        self.rate_limited.shutdown()
+
+        # NOTE: Whatever was still waiting on the rate limits has just been dropped
+        email_rate_limit_queued.set(0)
+
+        for lane in self.lanes:
+            lane.shutdown(wait=True)
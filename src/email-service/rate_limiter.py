@@ -0,0 +1,69 @@
+import time
+import threading
+
+# NOTE: A token bucket of `burst` tokens refilling at `rate_per_s`, kept per key as GCRA's
+# "theoretical arrival time" instead of a token count. It's the same limit, but it can also
+# answer when a send *would* conform in the future and take the token at that point, which is
+# what lets a send queue for its turn instead of being refused
+class RateLimit:
+    def __init__(self, rate_per_s: float, burst: int) -> None:
+        self.interval_s: float = 1 / rate_per_s
+        self.tolerance_s: float = (burst - 1) * self.interval_s
+
+        self.tats: dict[str, float] = {}
+
+    def earliest(self, key: str, now: float) -> float:
+        return max(now, self.tats.get(key, now) - self.tolerance_s)
+
+    def take(self, key: str, at: float) -> None:
+        self.tats[key] = max(self.tats.get(key, at), at) + self.interval_s
+
+    # NOTE: A key whose arrival time has passed has a full bucket, which is no different from
+    # not having one, so recipients don't pile up forever
+    def sweep(self, now: float) -> None:
+        self.tats = {key: tat for key, tat in self.tats.items() if tat > now}
+
+# NOTE: A send first waits until its recipient's bucket has a token, and only then queues for the
+# SMTP host's. Both tokens are taken at the time the host gives it, so the recipient's next send is
+# spaced from when this one actually goes out, and a throttled recipient never books host tokens
+# ahead of everyone else's sends. Nothing is ever refused, a send over either limit is just given
+# a later time. The caller has to reserve one send per recipient at a time to keep their order
+class RateLimiter:
+    SWEEP_EVERY: int = 10_000
+
+    def __init__(
+        self,
+        host_rate_per_s: float,
+        host_burst: int,
+        recipient_rate_per_s: float,
+        recipient_burst: int
+    ) -> None:
+        self.host: RateLimit = RateLimit(host_rate_per_s, host_burst)
+        self.recipient: RateLimit = RateLimit(recipient_rate_per_s, recipient_burst)
+
+        self.lock: threading.Lock = threading.Lock()
+        self.reservations: int = 0
+
+    # NOTE: How long until the recipient has a token, nothing is taken
+    def recipient_wait(self, recipient: str) -> float:
+        now: float = time.monotonic()
+
+        with self.lock:
+            return max(0.0, self.recipient.earliest(recipient, now) - now)
+
+    # NOTE: Takes the host's next free token and the recipient's token along with it, returns how
+    # long to wait before sending. Only called once `recipient_wait` is 0
+    def reserve(self, host: str, recipient: str) -> float:
+        now: float = time.monotonic()
+
+        with self.lock:
+            at: float = self.host.earliest(host, now)
+            self.host.take(host, at)
+            self.recipient.take(recipient, at)
+
+            self.reservations += 1
+            if self.reservations % self.SWEEP_EVERY == 0:
+                self.host.sweep(now)
+                self.recipient.sweep(now)
+
+        return at - now
@@ -0,0 +1,105 @@
+# Replays dead lettered notifications back onto the email notification topic.
+#
+# Reads the dead letter topic from wherever the replay consumer group left off, republishes every
+# replayable dead letter and then commits, so each dead letter is replayed at most once per run
+# (the group's lag is the DLQ depth, see email_notif_dead_letter_depth). Send failures are only redelivered to the recipients that
+# failed, parse/handle failures are skipped unless their stage is asked for explicitly.
+#
+# Usage (inside the email-service container):
+#   python3 replay_dlq.py [--stages send] [--limit 100] [--dry-run]
+
+import json
+import argparse
+
+from dead_letters import DeadLetterQueue, DeadLetterStage
+from email_notif_consumer import EmailNotifConsumer
+
+from kafka import KafkaConsumer, KafkaProducer
+from kafka.structs import TopicPartition, OffsetAndMetadata
+
+POLL_TIMEOUT_MS: int = 2000
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", default=DeadLetterStage.SEND.value, help="comma separated stages to replay")
+    parser.add_argument("--limit", type=int, default=None, help="replay at most this many dead letters")
+    parser.add_argument("--dry-run", action="store_true", help="print the dead letters without replaying or committing")
+    args = parser.parse_args()
+
+    stages: set[str] = set(args.stages.split(","))
+
+    consumer: KafkaConsumer = KafkaConsumer(
+        DeadLetterQueue.TOPIC,
+        bootstrap_servers=DeadLetterQueue.BOOTSTRAP_SERVERS,
+        value_deserializer=lambda msg: json.loads(msg.decode("utf-8")),
+        auto_offset_reset="earliest",
+        group_id=DeadLetterQueue.REPLAY_GROUP_ID,
+        enable_auto_commit=False
+    )
+
+    producer: KafkaProducer = KafkaProducer(
+        bootstrap_servers=EmailNotifConsumer.BOOTSTRAP_SERVERS,
+        value_serializer=lambda msg: json.dumps(msg).encode("utf-8"),
+        acks="all"
+    )
+
+    replayed: int = 0
+    skipped: int = 0
+
+    # NOTE: Only the offsets that were actually looked at get committed, and only after everything
+    # replayed has been flushed
+    processed: dict[TopicPartition, OffsetAndMetadata] = {}
+
+    def _limit_hit() -> bool:
+        return args.limit is not None and replayed >= args.limit
+
+    # NOTE: Stops at the end of the topic (a poll that comes back empty) or once the limit is hit
+    while not _limit_hit():
+        batch = consumer.poll(timeout_ms=POLL_TIMEOUT_MS)
+        if not batch:
+            break
+
+        for tp, dead_letters in batch.items():
+            for record in dead_letters:
+                if _limit_hit():
+                    break
+
+                processed[tp] = OffsetAndMetadata(record.offset + 1, "", -1)
+
+                dead_letter: dict = record.value
+                source: dict = dead_letter["source"]
+
+                print(
+                    f"[{dead_letter['stage']}] {source['topic']}/{source['partition']}@{source['offset']} "
+                    f"attempts={dead_letter['attempts']} recipients={dead_letter['recipients']} "
+                    f"reason={dead_letter['reason']}"
+                )
+
+                if dead_letter["stage"] not in stages or dead_letter["notif"] is None:
+                    skipped += 1
+                    continue
+
+                notif: dict = dict(dead_letter["notif"])
+                if dead_letter["recipients"] is not None:
+                    notif["recipients"] = dead_letter["recipients"]
+
+                if not args.dry_run:
+                    producer.send(EmailNotifConsumer.TOPIC, value=notif)
+
+                replayed += 1
+
+    if args.dry_run:
+        print(f"Would replay {replayed} dead letter(s), skipping {skipped}!")
+
+    else:
+        producer.flush()
+        if processed:
+            consumer.commit(offsets=processed)
+
+        print(f"Replayed {replayed} dead letter(s), skipped {skipped}!")
+
+    producer.close()
+    consumer.close()
+
+if __name__ == "__main__":
+    main()
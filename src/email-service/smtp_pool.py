@@ -0,0 +1,195 @@
+import time
+import typing
+import smtplib
+import threading
+
+from logging import Logger
+from collections import deque
+from ssl import SSLContext
+
+from metrics import (
+    smtp_handshakes,
+    smtp_handshake_latency_histo,
+    smtp_session_reuses,
+    smtp_session_recycles
+)
+
+# NOTE: (server, port, username, password)
+SessionKey = tuple[str, int, str, str]
+
+class PooledSession:
+    def __init__(self, smtp: smtplib.SMTP) -> None:
+        self.smtp: smtplib.SMTP = smtp
+        self.sends: int = 0
+        self.last_used: float = time.monotonic()
+
+# NOTE: Keeps warm (already STARTTLS'd and logged in) SMTP sessions around per server + credentials
+# so that a notification doesn't pay for a fresh TLS handshake on every single email
+class SMTPPool:
+    def __init__(
+        self,
+        logger: Logger,
+        ssl_ctx: SSLContext,
+        max_idle_s: float,
+        max_sends_per_session: int,
+        max_idle_sessions_per_key: int,
+        timeout: float
+    ) -> None:
+        self.logger: Logger = logger
+        self.ssl_ctx: SSLContext = ssl_ctx
+
+        self.max_idle_s: float = max_idle_s
+        self.max_sends_per_session: int = max_sends_per_session
+        self.max_idle_sessions_per_key: int = max_idle_sessions_per_key
+        self.timeout: float = timeout
+
+        self.lock: threading.Lock = threading.Lock()
+        self.idle: dict[SessionKey, deque[PooledSession]] = {}
+
+        self.last_sweep: float = time.monotonic()
+
+    # NOTE: `msg` is an already rendered message (see mime.py)
+    def send(self, key: SessionKey, from_addr: str, to_addr: str, msg: bytes) -> None:
+        session, reused = self._acquire(key)
+
+        try:
+            self._sendmail(key, session, from_addr, to_addr, msg)
+
+        except Exception as e:
+            # NOTE: A warm session may have been dropped by the server while it sat idle, so
+            # reconnect once before giving up. Anything the server actually answered (e.g. a 5xx)
+            # would only be answered the same way again, and a fresh session failing is a real error
+            if not reused or not self._connection_lost(e):
+                raise
+
+            self.logger.warning(f"Pooled SMTP session failed, reconnecting! Reason: {str(e)}")
+
+            session = self._handshake(key)
+            self._sendmail(key, session, from_addr, to_addr, msg)
+
+        # NOTE: Sessions are keyed per user credentials, so under steady traffic the keys that
+        # aren't used again would otherwise never get their idle sessions closed
+        if time.monotonic() - self.last_sweep > self.max_idle_s:
+            self.recycle_idle()
+
+    # NOTE: The session is always either returned to the pool or closed, whether or not the send fails
+    def _sendmail(self, key: SessionKey, session: PooledSession, from_addr: str, to_addr: str, msg: bytes) -> None:
+        try:
+            session.smtp.sendmail(from_addr, [to_addr], msg)
+
+        except Exception as e:
+            # NOTE: smtplib RSETs the session after the server refuses a message, so it can be
+            # reused, unless the server hung up on it as well (e.g. a 421)
+            if isinstance(e, smtplib.SMTPException) and not self._connection_lost(e) and session.smtp.sock is not None:
+                session.last_used = time.monotonic()
+                self._release(key, session)
+            else:
+                self._close(session, reason="failed")
+
+            raise
+
+        session.sends += 1
+        session.last_used = time.monotonic()
+
+        self._release(key, session)
+
+    # NOTE: SMTPException is an OSError too, but all bar SMTPServerDisconnected mean the server answered
+    def _connection_lost(self, e: Exception) -> bool:
+        if isinstance(e, smtplib.SMTPServerDisconnected):
+            return True
+
+        return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+    def _acquire(self, key: SessionKey) -> tuple[PooledSession, bool]:
+        stale: list[PooledSession] = []
+        session: PooledSession | None = None
+
+        with self.lock:
+            idle: deque[PooledSession] = self.idle.get(key, deque())
+            while idle:
+                candidate: PooledSession = idle.pop()
+                if time.monotonic() - candidate.last_used > self.max_idle_s:
+                    stale.append(candidate)
+                    continue
+
+                session = candidate
+                break
+
+        for stale_session in stale:
+            self._close(stale_session, reason="idle")
+
+        if session is not None:
+            smtp_session_reuses.inc()
+            return session, True
+
+        return self._handshake(key), False
+
+    def _release(self, key: SessionKey, session: PooledSession) -> None:
+        if session.sends >= self.max_sends_per_session:
+            self._close(session, reason="max_sends")
+            return
+
+        with self.lock:
+            idle: deque[PooledSession] = self.idle.setdefault(key, deque())
+            if len(idle) < self.max_idle_sessions_per_key:
+                idle.append(session)
+                return
+
+        self._close(session, reason="pool_full")
+
+    def _handshake(self, key: SessionKey) -> PooledSession:
+        server, port, username, password = key
+
+        start: float = time.perf_counter()
+
+        smtp: smtplib.SMTP = smtplib.SMTP(server, port, timeout=self.timeout)
+        try:
+            smtp.starttls(context=self.ssl_ctx)
+            smtp.login(username, password)
+
+        except Exception:
+            smtp.close()
+            raise
+
+        smtp_handshakes.inc()
+        smtp_handshake_latency_histo.observe(time.perf_counter() - start)
+
+        return PooledSession(smtp)
+
+    def _close(self, session: PooledSession, reason: str) -> None:
+        smtp_session_recycles.labels(reason=reason).inc()
+
+        try:
+            session.smtp.quit()
+
+        except Exception:
+            session.smtp.close()
+
+    # NOTE: Called periodically so idle sessions don't hold server connections open forever
+    def recycle_idle(self) -> None:
+        stale: list[PooledSession] = []
+
+        with self.lock:
+            now: float = time.monotonic()
+            self.last_sweep = now
+
+            for key in list(self.idle):
+                fresh: deque[PooledSession] = deque()
+                for session in self.idle[key]:
+                    (stale if now - session.last_used > self.max_idle_s else fresh).append(session)
+
+                if fresh:
+                    self.idle[key] = fresh
+                else:
+                    del self.idle[key]
+
+        for session in stale:
+            self._close(session, reason="idle")
+
+    def close_all(self) -> None:
+        with self.lock:
+            sessions: list[PooledSession] = [s for idle in self.idle.values() for s in idle]
+            self.idle.clear()
+
+        for session in sessions:
+            self._close(session, reason="shutdown")
@@ -0,0 +1,163 @@
+import typing
+
+from html import escape
+from string import Formatter
+from dataclasses import dataclass
+
+# NOTE: Templates are written with `{field}` placeholders and compiled once, at import, into a
+# printf style string, which renders in a single `%` with no reparsing of the template. Fields
+# are checked when compiling, so a typo in a template fails at startup rather than on a send
+class CompiledText:
+    def __init__(self, source: str) -> None:
+        compiled: list[str] = []
+        fields: set[str] = set()
+
+        for literal, field, spec, conversion in Formatter().parse(source):
+            compiled.append(literal.replace("%", "%%"))
+
+            if field is None:
+                continue
+
+            if not field.isidentifier() or spec or conversion:
+                raise ValueError(f"Unsupported template field '{{{field}}}', only plain names are allowed!")
+
+            compiled.append(f"%({field})s")
+            fields.add(field)
+
+        self.compiled: str = "".join(compiled)
+        self.fields: frozenset[str] = frozenset(fields)
+
+    def render(self, values: dict[str, str]) -> str:
+        return self.compiled % values
+
+@dataclass(frozen=True)
+class RenderedEmail:
+    subject: str
+    text: str
+    html: str | None
+
+# NOTE: A single email's subject and plain text body, plus an optional HTML body which gets sent
+# as a multipart/alternative. Values are HTML escaped for the HTML body only
+class EmailTemplate:
+    def __init__(self, subject: str, text: str, html: str | None = None) -> None:
+        self.subject: CompiledText = CompiledText(subject)
+        self.text: CompiledText = CompiledText(text)
+        self.html: CompiledText | None = CompiledText(html) if html is not None else None
+
+    def render(self, values: dict[str, str]) -> RenderedEmail:
+        html_body: str | None = None
+        if self.html is not None:
+            html_body = self.html.render({field: escape(values[field]) for field in self.html.fields})
+
+        return RenderedEmail(
+            subject=self.subject.render(values),
+            text=self.text.render(values),
+            html=html_body
+        )
+
+# NOTE: Everything a notification type sends, trade notifications email both traders from the same
+# values so they're rendered together
+class NotifTemplate:
+    def __init__(self, sender: EmailTemplate, receiver: EmailTemplate | None = None) -> None:
+        self.sender: EmailTemplate = sender
+        self.receiver: EmailTemplate | None = receiver
+
+    def render_pair(self, values: dict[str, str]) -> tuple[RenderedEmail, RenderedEmail]:
+        if self.receiver is None:
+            raise ValueError("Template only has a single recipient!")
+
+        return self.sender.render(values), self.receiver.render(values)
+
+# NOTE: Keyed by notification type, i.e. the 'type' of the kafka message (plus the digest)
+TEMPLATES: typing.Final[dict[str, NotifTemplate]] = {
+    "pw_update": NotifTemplate(
+        sender=EmailTemplate(
+            subject="Password Update",
+            text=(
+                "Hello, {name}!\n"
+                "Your password has been successfully reset!\n"
+                "If this was not you then contact support immediately!\n"
+                "Sincerely, Notification Service"
+            )
+        )
+    ),
+
+    "trade_offer_init": NotifTemplate(
+        sender=EmailTemplate(
+            subject="Trade offer processed",
+            text=(
+                "Hello, {sender_name}!\n"
+                "We have received your trade offer of {offered_game} for {requested_game} from {receiver_name} | {receiver_email}!\n"
+                "The trade ID of your trade offer is {trade_id}!\n"
+                "Sincerely, ok\n"
+            )
+        ),
+        receiver=EmailTemplate(
+            subject="Trade offer received",
+            text=(
+                "Hello, {receiver_name}!\n"
+                "You have received a trade offer from '{sender_name}/{sender_email}'!\n"
+                "They have offered '{offered_game}' for '{requested_game}'!\n"
+                "Use this trade ID: '/api/trades/accept/{trade_id}' or '/api/trades/reject/{trade_id}' to accept/reject the offer!\n"
+                "Sincerely, yeah whatever"
+            ),
+            html=(
+                "<p>Hello, {receiver_name}!</p>\n"
+                "<p>You have received a trade offer from <b>{sender_name}</b> ({sender_email})!</p>\n"
+                "<p>They have offered <b>{offered_game}</b> for <b>{requested_game}</b>!</p>\n"
+                "<p>Use <code>/api/trades/accept/{trade_id}</code> or <code>/api/trades/reject/{trade_id}</code> to accept/reject the offer!</p>\n"
+                "<p>Sincerely, yeah whatever</p>\n"
+            )
+        )
+    ),
+
+    "trade_offer_accepted": NotifTemplate(
+        sender=EmailTemplate(
+            subject="Trade offer accepted",
+            text=(
+                "Hello, {sender_name}!\n"
+                "Your trade offer of '{offered_game}' for '{requested_game}' from '{receiver_name}/{receiver_email}' was successfully accepted!\n"
+                "Sincerely, yep yep yep\n"
+            )
+        ),
+        receiver=EmailTemplate(
+            subject="Trade offer accepted",
+            text=(
+                "Hello, {receiver_name}!\n"
+                "The trade offer of '{requested_game}' for '{offered_game}' from '{sender_name}/{sender_email}' was successfully accepted!\n"
+                "Sincerely, yep yep yep\n"
+            )
+        )
+    ),
+
+    "trade_offer_rejected": NotifTemplate(
+        sender=EmailTemplate(
+            subject="Trade offer rejected :(",
+            text=(
+                "Hello, {sender_name}!\n"
+                "Your trade offer of '{offered_game}' for '{requested_game}' from '{receiver_name}/{receiver_email}' was unfortunately rejected :(!\n"
+                "Sincerely, yep yep yep\n"
+            )
+        ),
+        receiver=EmailTemplate(
+            subject="Trade offer rejected",
+            text=(
+                "Hello, {receiver_name}!\n"
+                "The trade offer of '{requested_game}' for '{offered_game}' from '{sender_name}/{sender_email}' was unfortunately rejected!\n"
+                "Sincerely, yep yep yep\n"
+            )
+        )
+    ),
+
+    "digest": NotifTemplate(
+        sender=EmailTemplate(
+            subject="{count} trade updates",
+            text=(
+                "Hello!\n"
+                "Here are your {count} latest trade updates!\n\n"
+                "{sections}\n"
+                "Sincerely, Notification Service"
+            )
+        )
+    ),
+}
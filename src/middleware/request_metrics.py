@@ -0,0 +1,79 @@
+import time
+
+from typing import Final, Callable, Awaitable
+
+from models.user_identity_map import UserIdentityMap
+
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.routing import APIRoute
+
+from prometheus_client import Histogram
+
+# NOTE: [AI CITATION]: Partially generated by chatGPT
+request_latency_histo: Histogram = Histogram(
+    "api_request_latency_s",
+    "HTTP request latency in seconds",
+    ["method", "endpoint", "status"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+)
+
+request_user_lookups_histo: Histogram = Histogram(
+    "api_request_user_lookups",
+    "User store lookups made per request",
+    ["endpoint"],
+    buckets=[0, 1, 2, 3, 4, 6, 8]
+)
+
+# NOTE: Endpoints are labelled by their route template (e.g. /api/trades/accept/{trade_id}) so
+# the series count stays bounded, the cap is only a safety net for routes we don't know about
+MAX_ENDPOINT_LABELS: Final[int] = 64
+UNMATCHED_ENDPOINT_LABEL: Final[str] = "__unmatched__"
+OVERFLOW_ENDPOINT_LABEL: Final[str] = "__overflow__"
+
+seen_endpoint_labels: set[str] = set()
+
+# NOTE: [AI CITATION]: Got help from chatGPT but documentation was mostly used
+
+def _endpoint_label(request: Request) -> str:
+    route: APIRoute | None = request.scope.get("route")
+    if route is None:
+        return UNMATCHED_ENDPOINT_LABEL
+
+    endpoint: str = route.path
+    if endpoint in seen_endpoint_labels:
+        return endpoint
+
+    if len(seen_endpoint_labels) >= MAX_ENDPOINT_LABELS:
+        return OVERFLOW_ENDPOINT_LABEL
+
+    seen_endpoint_labels.add(endpoint)
+    return endpoint
+
+# NOTE: Registered on the app with `app.middleware("http")`, kept apart from api.py so it can be
+# exercised without the stores and brokers the app connects to
+async def init_metrics(
+    request: Request,
+    call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+    if request.url.path == "/metrics":
+        return await call_next(request)
+
+    start: float = time.perf_counter()
+    api_resp: Response = await call_next(request)
+    end: float = time.perf_counter()
+
+    endpoint: str = _endpoint_label(request)
+
+    request_latency_histo.labels(
+        method=request.method,
+        endpoint=endpoint,
+        status=str(api_resp.status_code)
+    ).observe(end - start)
+
+    identity_map: UserIdentityMap | None = getattr(request.state, "user_identity_map", None)
+    if identity_map is not None:
+        request_user_lookups_histo.labels(endpoint=endpoint).observe(identity_map.lookups)
+        api_resp.headers["X-User-Lookups"] = str(identity_map.lookups)
+
+    return api_resp
@@ -1,19 +1,42 @@
 import jwt
+import time
+import typing
 
 from models.user import User
 from models.users import Users
+from models.local_cache import LocalCache
+from models.user_identity_map import UserIdentityMap
 
 from typing import Any
 from datetime import datetime, timedelta
 
+# NOTE: Light weight identity built from a verified JWT, the full user (and all of their games)
+# is only fetched if the handler actually asks for it
+class Principal:
+    def __init__(self, email: str, identity_map: UserIdentityMap) -> None:
+        self.email: str = email
+        self.identity_map: UserIdentityMap = identity_map
+
+    async def load_user(self) -> User | None:
+        return await self.identity_map.get_user(self.email)
+
 class UserAuth:
     # NOTE: Obviously bad, just hardcoding in the src for simplicity
     SECRET_KEY = "secret_jwt_key123321!"
 
+    VERIFIED_JWT_CACHE_SIZE: typing.Final[int] = 10_000
+    VERIFIED_JWT_CACHE_TTL: typing.Final[float] = 300.0
+
     def __init__(self, users: Users) -> None:
         self.users: Users = users
 
-    def register(
+        self.verified_jwts: LocalCache = LocalCache(
+            name="verified_jwts",
+            max_size=self.VERIFIED_JWT_CACHE_SIZE,
+            ttl=self.VERIFIED_JWT_CACHE_TTL
+        )
+
+    async def register(
         self,
         name: str,
         email: str,
@@ -28,10 +51,10 @@ class UserAuth:
             games={}
         )
 
-        self.users.add_user(user)
+        await self.users.add_user(user)
 
-    def auth(self, email: str, password: str) -> str:
-        user: User | None = self.users.get_user(email)
+    async def auth(self, email: str, password: str) -> str:
+        user: User | None = await self.users.get_user(email)
         if not user or user.password != password:
             raise ValueError("Failed to authenticate user! Invalid credentials!")
 
@@ -45,6 +68,18 @@ class UserAuth:
 
         return jwt.encode(payload, self.SECRET_KEY, algorithm="HS256")
 
+    # NOTE: Tokens that already passed HMAC verification are remembered so repeat requests
+    # only pay for a dict lookup, expiry still has to be checked on every hit though
     def verify_jwt(self, token: str) -> dict[str, Any]:
-        return jwt.decode(token, self.SECRET_KEY, algorithms=["HS256"])
-    
+        payload: dict[str, Any] | None = self.verified_jwts.get(token)
+        if payload is not None and payload["exp"] > time.time():
+            return payload
+
+        payload = jwt.decode(token, self.SECRET_KEY, algorithms=["HS256"])
+        self.verified_jwts.set(token, payload)
+
+        return payload
+
+    def principal_from_jwt(self, token: str, identity_map: UserIdentityMap) -> Principal:
+        return Principal(self.verify_jwt(token)["sub"], identity_map)
+
@@ -0,0 +1,74 @@
+import json
+import typing
+
+from enum import IntEnum
+
+import msgpack
+
+# NOTE: zstd is optional, without it large entries are just stored uncompressed (and entries other
+# replicas compressed are treated as misses)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# NOTE: Written as the first byte of every cached value. Legacy entries are bare JSON with no
+# format byte, which always start with '{' and so can't be mistaken for one of these
+class CacheFormat(IntEnum):
+    JSON = 1
+    MSGPACK = 2
+    MSGPACK_ZSTD = 3
+
+LEGACY_JSON_PREFIX: typing.Final[int] = ord("{")
+
+# NOTE: Encodes cached values in one format and decodes any format it knows, so replicas that
+# write different formats (i.e. mid rollout) can still read each other's entries. A format it
+# doesn't know (written by a newer replica) decodes to None and is treated as a cache miss
+class CacheCodec:
+    # NOTE: Below this, compressing costs more time than the bytes it saves are worth
+    COMPRESS_OVER_BYTES: typing.Final[int] = 2048
+    ZSTD_LEVEL: typing.Final[int] = 3
+
+    def __init__(self, format: CacheFormat = CacheFormat.MSGPACK_ZSTD) -> None:
+        if format == CacheFormat.MSGPACK_ZSTD and zstandard is None:
+            format = CacheFormat.MSGPACK
+
+        self.format: CacheFormat = format
+
+        self.compressor: typing.Any = None
+        self.decompressor: typing.Any = None
+        if zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=self.ZSTD_LEVEL)
+            self.decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, value: typing.Any) -> bytes:
+        if self.format == CacheFormat.JSON:
+            return bytes((CacheFormat.JSON,)) + json.dumps(value).encode("utf-8")
+
+        packed: bytes = msgpack.packb(value)
+
+        if self.format == CacheFormat.MSGPACK_ZSTD and len(packed) > self.COMPRESS_OVER_BYTES:
+            return bytes((CacheFormat.MSGPACK_ZSTD,)) + self.compressor.compress(packed)
+
+        return bytes((CacheFormat.MSGPACK,)) + packed
+
+    def decode(self, data: bytes) -> typing.Any | None:
+        prefix: int = data[0]
+        payload: memoryview = memoryview(data)[1:]
+
+        if prefix == CacheFormat.MSGPACK:
+            return msgpack.unpackb(payload)
+
+        if prefix == CacheFormat.MSGPACK_ZSTD:
+            if self.decompressor is None:
+                return None
+
+            return msgpack.unpackb(self.decompressor.decompress(payload))
+
+        if prefix == CacheFormat.JSON:
+            return json.loads(bytes(payload))
+
+        if prefix == LEGACY_JSON_PREFIX:
+            return json.loads(data)
+
+        return None
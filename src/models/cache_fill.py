@@ -0,0 +1,191 @@
+import math
+import time
+import uuid
+import random
+import typing
+import asyncio
+
+from logging import Logger
+from collections.abc import Callable, Awaitable
+
+import redis
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+from prometheus_client import Counter
+
+cache_fills_coalesced: Counter = Counter(
+    "cache_fills_coalesced_total",
+    "Cache misses that waited on a fill already running in this process",
+    ["cache"]
+)
+
+cache_fill_lease_waits: Counter = Counter(
+    "cache_fill_lease_waits_total",
+    "Cache misses that waited on a fill already running on another replica",
+    ["cache", "outcome"]
+)
+
+cache_early_refreshes: Counter = Counter(
+    "cache_early_refreshes_total",
+    "Cache entries refreshed ahead of their expiry",
+    ["cache"]
+)
+
+# NOTE: Only gives the lease up if this fill still holds it
+RELEASE_LEASE_SCRIPT: typing.Final[str] = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+T = typing.TypeVar("T")
+
+# NOTE: Makes sure a cache miss is filled from Mongo once, not once per request that missed. When a
+# popular entry expires, every concurrent request for it on every replica misses together:
+#   - requests in the same process share one load (the first one's)
+#   - across replicas, whoever takes the entry's Redis lease loads it, the rest poll the cache
+#     for the result and only load it themselves if the lease holder takes too long
+# Entries are also refreshed in the background shortly before they expire (XFetch, i.e. the
+# closer to expiry and the slower the load, the likelier a hit is to trigger a refresh), so hot
+# entries rarely expire at all
+class CacheFill:
+    LEASE_TTL_MS: typing.Final[int] = 5_000
+    LEASE_WAIT_S: typing.Final[float] = 1.0
+    LEASE_POLL_S: typing.Final[float] = 0.02
+
+    # NOTE: > 1 favours refreshing earlier, < 1 later
+    EARLY_REFRESH_BETA: typing.Final[float] = 1.0
+
+    # NOTE: How long a load takes, tracked as a moving average since it's what decides how early
+    # to refresh
+    INITIAL_LOAD_S: typing.Final[float] = 0.01
+    LOAD_S_SMOOTHING: typing.Final[float] = 0.1
+
+    def __init__(self, logger: Logger, cache: Redis, name: str) -> None:
+        self.logger: Logger = logger
+        self.cache: Redis = cache
+        self.name: str = name
+
+        self.release_lease_script: AsyncScript = self.cache.register_script(RELEASE_LEASE_SCRIPT)
+
+        self.fills: dict[str, asyncio.Task] = {}
+        self.refreshes: dict[str, asyncio.Task] = {}
+
+        self.load_s: float = self.INITIAL_LOAD_S
+
+    # NOTE: `read_cached` is what waiting on another replica polls, it should return None until
+    # the entry is in the cache
+    async def fill(
+        self,
+        key: str,
+        load: Callable[[], Awaitable[T]],
+        read_cached: Callable[[], Awaitable[T | None]]
+    ) -> T:
+        fill: asyncio.Task | None = self.fills.get(key)
+
+        if fill is None:
+            fill = asyncio.create_task(self._leased_fill(key, load, read_cached))
+            fill.add_done_callback(lambda _: self.fills.pop(key, None))
+            self.fills[key] = fill
+
+        else:
+            cache_fills_coalesced.labels(cache=self.name).inc()
+
+        # NOTE: Shielded so a request giving up doesn't cancel the load everyone else is waiting on
+        return await asyncio.shield(fill)
+
+    def should_refresh_early(self, ttl_s: float) -> bool:
+        if ttl_s <= 0:
+            return False
+
+        return -self.load_s * self.EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= ttl_s
+
+    # NOTE: Fire and forget, the hit that triggered it is served from the cache as usual
+    def refresh(self, key: str, load: Callable[[], Awaitable[typing.Any]]) -> None:
+        if key in self.refreshes or key in self.fills:
+            return
+
+        refresh: asyncio.Task = asyncio.create_task(self._refresh(key, load))
+        refresh.add_done_callback(lambda _: self.refreshes.pop(key, None))
+        self.refreshes[key] = refresh
+
+    async def _leased_fill(
+        self,
+        key: str,
+        load: Callable[[], Awaitable[T]],
+        read_cached: Callable[[], Awaitable[T | None]]
+    ) -> T:
+        token: str | None = await self._acquire_lease(key)
+        if token is not None:
+            try:
+                return await self._timed_load(load)
+            finally:
+                await self._release_lease(key, token)
+
+        deadline: float = time.monotonic() + self.LEASE_WAIT_S
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.LEASE_POLL_S)
+
+            try:
+                cached: T | None = await read_cached()
+            except redis.RedisError:
+                break
+
+            if cached is not None:
+                cache_fill_lease_waits.labels(cache=self.name, outcome="filled").inc()
+                return cached
+
+        # NOTE: The lease holder is slow or died mid load, the lease expires on its own
+        cache_fill_lease_waits.labels(cache=self.name, outcome="timed_out").inc()
+        return await self._timed_load(load)
+
+    async def _refresh(self, key: str, load: Callable[[], Awaitable[typing.Any]]) -> None:
+        try:
+            # NOTE: Someone else holding the lease is already refreshing (or filling) it
+            token: str | None = await self._acquire_lease(key)
+            if token is None:
+                return
+
+            try:
+                await self._timed_load(load)
+                cache_early_refreshes.labels(cache=self.name).inc()
+            finally:
+                await self._release_lease(key, token)
+
+        except Exception as e:
+            self.logger.warning(f"Failed to refresh cache entry '{key}' early! Reason: {str(e)}")
+
+    async def _timed_load(self, load: Callable[[], Awaitable[T]]) -> T:
+        start: float = time.perf_counter()
+        result: T = await load()
+
+        self.load_s += self.LOAD_S_SMOOTHING * (time.perf_counter() - start - self.load_s)
+        return result
+
+    def _lease_key(self, key: str) -> str:
+        return f"lease:{key}"
+
+    # NOTE: Returns the lease's token, or None if someone else holds it. Redis being unavailable
+    # fails open, every replica just loads for itself like it would without a cache
+    async def _acquire_lease(self, key: str) -> str | None:
+        token: str = uuid.uuid4().hex
+
+        try:
+            acquired: bool | None = await self.cache.set(
+                self._lease_key(key),
+                token,
+                nx=True,
+                px=self.LEASE_TTL_MS
+            )
+        except redis.RedisError:
+            return token
+
+        return token if acquired else None
+
+    async def _release_lease(self, key: str, token: str) -> None:
+        try:
+            await self.release_lease_script(keys=[self._lease_key(key)], args=[token])
+        except redis.RedisError:
+            self.logger.warning(f"Failed to release cache lease for '{key}', it will expire on its own")
@@ -1,84 +1,171 @@
 import json
+import uuid
 import typing
+import asyncio
+import logging
 
-from .user import User
-from .users import Users
+from enum import Enum, auto
+from concurrent.futures import ThreadPoolExecutor
 
+from .user import User
 from .trade import Trade
-from .trades import Trades
 
 from kafka import KafkaProducer
 from kafka.errors import KafkaError
 
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+notif_delivery_failures: Counter = Counter(
+    "email_notif_delivery_failures_total",
+    "Email notifications that kafka failed to deliver",
+    ["type"]
+)
+
+notif_drops: Counter = Counter(
+    "email_notif_drops_total",
+    "Email notifications dropped before reaching kafka",
+    ["type", "reason"]
+)
+
+notif_buffered: Gauge = Gauge(
+    "email_notif_buffered",
+    "Email notifications sent to kafka but not yet acknowledged"
+)
+
+# NOTE: What to do with a new notification when the in-memory buffer is full
+class BackpressurePolicy(Enum):
+    BLOCK = auto()  # Wait up to BLOCK_TIMEOUT_S for room, then drop
+    DROP = auto()   # Drop immediately
+
 class EmailNotifProducer:
     TOPIC: typing.Final[str] = "email-notifs"
     BOOTSTRAP_SERVERS: typing.Final[str] = "kafka:9092"
 
-    def __init__(self, users: Users, trades: Trades) -> None:
-        self.users:  Users  = users
-        self.trades: Trades = trades
+    # NOTE: Sends are batched per partition for up to LINGER_MS (or until a batch fills)
+    LINGER_MS: typing.Final[int] = 20
+    BATCH_SIZE_BYTES: typing.Final[int] = 64 * 1024
+    COMPRESSION_TYPE: typing.Final[str] = "gzip"
+
+    MAX_BUFFERED_NOTIFS: typing.Final[int] = 10_000
+    BLOCK_TIMEOUT_S: typing.Final[float] = 0.5
+
+    # NOTE: Only bounds how long `send` itself may stall the publisher thread (i.e. a metadata
+    # fetch while kafka is unreachable, or a full accumulator)
+    MAX_BLOCK_MS: typing.Final[int] = 1000
+    CLOSE_TIMEOUT_S: typing.Final[float] = 10.0
+
+    def __init__(
+        self,
+        backpressure_policy: BackpressurePolicy = BackpressurePolicy.BLOCK
+    ) -> None:
+        self.backpressure_policy: BackpressurePolicy = backpressure_policy
+        self.buffer_slots: asyncio.Semaphore = asyncio.Semaphore(self.MAX_BUFFERED_NOTIFS)
 
         self.producer: KafkaProducer = KafkaProducer(
             bootstrap_servers=self.BOOTSTRAP_SERVERS,
-            value_serializer=lambda msg: json.dumps(msg).encode("utf-8")
+            value_serializer=lambda msg: json.dumps(msg).encode("utf-8"),
+            linger_ms=self.LINGER_MS,
+            batch_size=self.BATCH_SIZE_BYTES,
+            compression_type=self.COMPRESSION_TYPE,
+            max_block_ms=self.MAX_BLOCK_MS
         )
 
+        # NOTE: `send` can block, so it never runs on the event loop. A single thread keeps the
+        # notifications in the order they were published, the buffer slots bound its queue
+        self.publisher: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="email-notif-publisher")
+
     # NOTE: An enum should be preferred over str for the 'type' value
-    def send_pw_update_notif(self, name: str, auth_combo: tuple[str, str]) -> None:
-        self._publish_notif({
+    async def send_pw_update_notif(self, name: str, auth_combo: tuple[str, str]) -> None:
+        await self._publish_notif({
             "type"       : "pw_update",
             "name"       : name,
             "auth_combo" : auth_combo
         })
 
-    def send_trade_offer_notif(self, trade_id: str) -> None:
-        self._build_trade_notif(type="trade_offer_init", trade_id=trade_id)
+    # NOTE: The handlers have already loaded the trade and both traders, so they're passed
+    # in rather than being looked up again here
+    async def send_trade_offer_notif(self, trade: Trade, sender: User, receiver: User) -> None:
+        await self._build_trade_notif("trade_offer_init", trade, sender, receiver)
 
-    def send_trade_accepted_notif(self, trade_id: str) -> None:
-        self._build_trade_notif(type="trade_offer_accepted", trade_id=trade_id)
+    async def send_trade_accepted_notif(self, trade: Trade, sender: User, receiver: User) -> None:
+        await self._build_trade_notif("trade_offer_accepted", trade, sender, receiver)
 
-    def send_trade_rejected_notif(self, trade_id: str) -> None:
-        self._build_trade_notif(type="trade_offer_rejected", trade_id=trade_id)
+    async def send_trade_rejected_notif(self, trade: Trade, sender: User, receiver: User) -> None:
+        await self._build_trade_notif("trade_offer_rejected", trade, sender, receiver)
 
-    def _build_trade_notif(self, type: str, trade_id: str) -> None:
-        sender_info, receiver_info, games = self._get_traders_info(trade_id)
-
-        self._publish_notif({
+    async def _build_trade_notif(self, type: str, trade: Trade, sender: User, receiver: User) -> None:
+        await self._publish_notif({
             "type"          : type,
-            "trade_id"      : trade_id,
-            "sender_info"   : sender_info,
-            "receiver_info" : receiver_info,
-            "games"         : games,
+            "trade_id"      : trade.id,
+            "sender_info"   : (sender.name, sender.email, sender.password),
+            "receiver_info" : (receiver.name, receiver.email, receiver.password),
+            "games"         : (trade.offered_game, trade.requested_game),
         })
 
-    # NOTE: I'm not type annotating that god forsaken abomination of a return type
-    def _get_traders_info(self, trade_id: str):
-        trade: Trade | None = self.trades.get_trade(trade_id)
-        if trade is None:
-            raise ValueError(f"Failed to get trade info! Reason: {trade_id} does not point to a valid trade!")
+    # NOTE: Fire and forget, the handler never waits on kafka. Sends happen on the publisher thread,
+    # delivery on the producer's IO thread, and failures are only recorded to metrics.
+    # Every notification gets a unique event id, which the email service dedupes redeliveries on
+    async def _publish_notif(self, value: dict) -> None:
+        notif_type: str = value["type"]
+        value = {"event_id": str(uuid.uuid4()), **value}
 
-        sender_user: User | None = self.users.get_user(trade.sender_email)
-        if sender_user is None:
-            raise ValueError(f"Failed to get user '{trade.sender_email}'! Reason: not a valid email!")
+        if not await self._reserve_buffer_slot():
+            notif_drops.labels(type=notif_type, reason="buffer_full").inc()
+            logger.warning(f"Dropped '{notif_type}' notification, notification buffer is full!")
+            return
 
-        receiver_user: User | None = self.users.get_user(trade.receiver_email)
-        if receiver_user is None:
-            raise ValueError(f"Failed to get user '{trade.receiver_email}'! Reason: not a valid email!")
+        self.publisher.submit(self._send, notif_type, value, asyncio.get_running_loop())
 
-        return (
-            (sender_user.name, sender_user.email, sender_user.password),
-            (receiver_user.name, receiver_user.email, receiver_user.password),
-            (trade.offered_game, trade.requested_game)
-        )
+    # NOTE: Runs on the publisher thread, the buffer slot is handed back on the event loop once
+    # kafka has either acknowledged the notification or given up on it
+    def _send(self, notif_type: str, value: dict, loop: asyncio.AbstractEventLoop) -> None:
+        def _on_delivered(_) -> None:
+            loop.call_soon_threadsafe(self._release_buffer_slot)
+
+        def _on_failed(e: Exception) -> None:
+            notif_delivery_failures.labels(type=notif_type).inc()
+            logger.error(f"Failed to deliver '{notif_type}' notification! Reason: {str(e)}")
+
+            loop.call_soon_threadsafe(self._release_buffer_slot)
 
-    def _publish_notif(self, value: dict) -> None:
         try:
-            self.producer.send(self.TOPIC, value=value)
-            self.producer.flush()
+            delivery = self.producer.send(self.TOPIC, value=value)
+            delivery.add_callback(_on_delivered)
+            delivery.add_errback(_on_failed)
 
         except KafkaError as e:
-            raise ValueError(f"Failed to send notification due to a kafka error! Reason: {str(e)}")
+            loop.call_soon_threadsafe(self._release_buffer_slot)
+            notif_drops.labels(type=notif_type, reason="kafka_error").inc()
+            logger.error(f"Failed to send notification due to a kafka error! Reason: {str(e)}")
 
         except Exception as e:
-            raise ValueError(f"Failed to send notification due to an unexpected error! Reason: {str(e)}")        
+            loop.call_soon_threadsafe(self._release_buffer_slot)
+            notif_drops.labels(type=notif_type, reason="unexpected_error").inc()
+            logger.error(f"Failed to send notification due to an unexpected error! Reason: {str(e)}")
+
+    async def _reserve_buffer_slot(self) -> bool:
+        if self.backpressure_policy == BackpressurePolicy.DROP and self.buffer_slots.locked():
+            return False
+
+        try:
+            await asyncio.wait_for(self.buffer_slots.acquire(), timeout=self.BLOCK_TIMEOUT_S)
+
+        except asyncio.TimeoutError:
+            return False
+
+        notif_buffered.inc()
+        return True
+
+    def _release_buffer_slot(self) -> None:
+        notif_buffered.dec()
+        self.buffer_slots.release()
+
+    # NOTE: Called on app shutdown so that buffered notifications aren't lost, whatever is still
+    # queued for the publisher thread is handed to the producer first
+    def close(self) -> None:
+        self.publisher.shutdown(wait=True)
 
+        self.producer.flush(timeout=self.CLOSE_TIMEOUT_S)
+        self.producer.close(timeout=self.CLOSE_TIMEOUT_S)
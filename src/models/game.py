@@ -1,4 +1,6 @@
 class Game:
+    __slots__ = ("name", "publisher", "year", "platform", "condition")
+
     def __init__(
         self,
         name: str,
@@ -0,0 +1,76 @@
+import time
+import typing
+
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+local_cache_hits: Counter = Counter(
+    "local_cache_hits_total",
+    "In-process cache hits",
+    ["cache"]
+)
+
+local_cache_misses: Counter = Counter(
+    "local_cache_misses_total",
+    "In-process cache misses",
+    ["cache"]
+)
+
+local_cache_evictions: Counter = Counter(
+    "local_cache_evictions_total",
+    "In-process cache evictions",
+    ["cache", "reason"]
+)
+
+# NOTE: Bounded LRU with a per entry TTL, the TTL caps how stale an entry can get if an
+# invalidation message is ever missed
+class LocalCache:
+    def __init__(self, name: str, max_size: int, ttl: float) -> None:
+        self.name: str = name
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+
+        self.entries: OrderedDict[str, tuple[float, typing.Any]] = OrderedDict()
+
+    def get(self, key: str) -> typing.Any | None:
+        entry: tuple[float, typing.Any] | None = self.entries.get(key)
+        if entry is None:
+            local_cache_misses.labels(cache=self.name).inc()
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+
+            local_cache_evictions.labels(cache=self.name, reason="expired").inc()
+            local_cache_misses.labels(cache=self.name).inc()
+            return None
+
+        self.entries.move_to_end(key)
+        local_cache_hits.labels(cache=self.name).inc()
+
+        return value
+
+    # NOTE: Looks at an entry without counting it as a hit or a miss, or refreshing its recency
+    def peek(self, key: str) -> typing.Any | None:
+        entry: tuple[float, typing.Any] | None = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+
+        return entry[1]
+
+    def set(self, key: str, value: typing.Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            local_cache_evictions.labels(cache=self.name, reason="capacity").inc()
+
+    def evict(self, key: str) -> None:
+        if self.entries.pop(key, None) is not None:
+            local_cache_evictions.labels(cache=self.name, reason="invalidated").inc()
+
+    def clear(self) -> None:
+        self.entries.clear()
@@ -0,0 +1,14 @@
+import typing
+
+from functools import cache
+from pymongo import AsyncMongoClient
+
+# NOTE: Mongo runs as a single node replica set (see docker-compose.yml) since multi document
+# transactions aren't supported on a standalone server
+MONGO_URI: typing.Final[str] = "mongodb://mongo:27017/?replicaSet=rs0"
+
+# NOTE: A session can only be used with the client that started it, so every store shares
+# this one client in order for a transaction to span both users and trades
+@cache
+def get_mongo_client() -> AsyncMongoClient:
+    return AsyncMongoClient(MONGO_URI)
@@ -2,13 +2,17 @@ import uuid
 
 from enum import Enum, auto
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
 
 class TradeStatus(Enum):
     PENDING = auto()
     ACCEPTED = auto()
     REJECTED = auto()
 
-@dataclass
+    # NOTE: Pending trades whose game left its owner (accepted elsewhere, deleted or renamed)
+    SUPERSEDED = auto()
+
+@dataclass(slots=True)
 class Trade:
     sender_email: str
     receiver_email: str
@@ -22,6 +26,8 @@ class Trade:
     # No need to create a ctor, just a default factory
     id: str = field(default_factory=lambda: str(uuid.uuid1()))
 
+    created: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
     def to_dict(self) -> dict[str, str]:
         return {
             "id"             : self.id,
@@ -30,5 +36,6 @@ class Trade:
             "status"         : self.status.name,
             "offered_game"   : self.offered_game,
             "requested_game" : self.requested_game,
+            "created"        : self.created.isoformat(),
         }
 
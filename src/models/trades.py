@@ -1,127 +1,493 @@
 import json
+import time
+import base64
 import typing
 from logging import Logger
-from pymongo.errors import PyMongoError
-from pymongo.collection import Collection
-from pymongo import MongoClient, ReturnDocument
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pymongo.errors import PyMongoError, OperationFailure
+from pymongo import AsyncMongoClient, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.client_session import AsyncClientSession
 
 import redis
+import orjson
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
 
 from .users import Users
+from .cache_fill import CacheFill
+from .cache_codec import CacheCodec, CacheFormat
+from .mongo import get_mongo_client
 from .trade import Trade, TradeStatus
 
+# NOTE: Bumps a user's trades version. A version that was lost (evicted, Redis restarted) starts
+# over from the current time rather than from 0, so it never repeats one that was handed out before
+BUMP_VERSION_SCRIPT: typing.Final[str] = """
+redis.call('SET', KEYS[1], ARGV[1], 'NX')
+local version = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return version
+"""
+
+# NOTE: A page of a user's trades already serialized, `body` is the page's JSON ({"incoming": [...],
+# "outgoing": [...]}) exactly as it's cached and sent. The next page's cursor is kept next to it so
+# that linking to the next page never needs the body decoded. `version` is the user's trades
+# version the page was loaded at (None if Redis was unavailable)
+@dataclass(slots=True)
+class TradesPage:
+    body: bytes
+    next_cursor: str | None
+    version: int | None = None
+
 # NOTE: [AI CITATION] Redis caching layer was implemented with help from Claude Code
 class Trades:
-    MONGO_URI: typing.Final[str] = "mongodb://mongo:27017"
     REDIS_HOST: typing.Final[str] = "redis"
     CACHE_TTL: typing.Final[int] = 120
 
+    # NOTE: Has to be a msgpack format, pages are cached as [next cursor, JSON body bytes, version]
+    CACHE_FORMAT: typing.Final[CacheFormat] = CacheFormat.MSGPACK_ZSTD
+
+    # NOTE: Only needs to outlive every cached page and any ETag a client still holds, a lost
+    # version is reseeded anyway (see BUMP_VERSION_SCRIPT)
+    VERSION_TTL: typing.Final[int] = 7 * 24 * 60 * 60
+
+    # NOTE: What trades created before the field existed are given, so they sort as the oldest
+    LEGACY_CREATED: typing.Final[datetime] = datetime.fromtimestamp(0, timezone.utc)
+
+    DEFAULT_PAGE_SIZE: typing.Final[int] = 50
+    MAX_PAGE_SIZE: typing.Final[int] = 200
+
+    # NOTE: Replaced by indexes that extend them, dropped on startup
+    SUPERSEDED_INDEXES: typing.Final[tuple[str, ...]] = ("receiver_status_created", "sender_status_created")
+    INDEX_NOT_FOUND: typing.Final[int] = 27
+
+    # NOTE: Only the fields `_dict_to_trade` actually reads
+    TRADE_PROJECTION: typing.Final[dict[str, int]] = {
+        "sender_email": 1,
+        "receiver_email": 1,
+        "offered_game": 1,
+        "requested_game": 1,
+        "status": 1,
+        "created": 1,
+    }
+
     def __init__(self, logger: Logger) -> None:
         self.logger = logger
 
-        client: MongoClient = MongoClient(self.MONGO_URI)
-        self.trades: Collection = client["video_game_exchange"]["trades"]
+        client: AsyncMongoClient = get_mongo_client()
+        self.trades: AsyncCollection = client["video_game_exchange"]["trades"]
+
+        # NOTE: Cached pages are binary (see CacheCodec), so nothing is decoded on the way out
+        self.cache: Redis = Redis(host=self.REDIS_HOST, port=6379, decode_responses=False)
+        self.codec: CacheCodec = CacheCodec(self.CACHE_FORMAT)
+        self.cache_fill: CacheFill = CacheFill(self.logger, self.cache, name="trades")
+
+        self.bump_version_script: AsyncScript = self.cache.register_script(BUMP_VERSION_SCRIPT)
+
+    # NOTE: Called once on app startup, create_index is a no-op if the index already exists
+    async def ensure_indexes(self) -> None:
+        try:
+            # NOTE: A trade with no `created` never matches the keyset clause of a page after the
+            # first one (see `_find_trades_page`), so it would only ever be reachable on page one
+            await self.trades.update_many(
+                {"created": {"$exists": False}},
+                {"$set": {"created": self.LEGACY_CREATED}}
+            )
+
+            # NOTE: End in _id so that pages come out of the index already in (created, _id) order,
+            # see `_find_trades_page`, rather than every page sorting all of a user's trades in memory
+            await self.trades.create_index(
+                [("receiver_email", ASCENDING), ("status", ASCENDING), ("created", DESCENDING), ("_id", DESCENDING)],
+                name="receiver_status_created_id"
+            )
+
+            await self.trades.create_index(
+                [("sender_email", ASCENDING), ("status", ASCENDING), ("created", DESCENDING), ("_id", DESCENDING)],
+                name="sender_status_created_id"
+            )
+
+            for superseded in self.SUPERSEDED_INDEXES:
+                await self._drop_index_if_exists(superseded)
+
+            # NOTE: (owner email, game name) -> pending trades, partial so that only PENDING trades
+            # are indexed, see `_supersede_pending_trades`
+            await self.trades.create_index(
+                [("sender_email", ASCENDING), ("offered_game", ASCENDING)],
+                name="pending_offered_game",
+                partialFilterExpression={"status": TradeStatus.PENDING.name}
+            )
+
+            await self.trades.create_index(
+                [("receiver_email", ASCENDING), ("requested_game", ASCENDING)],
+                name="pending_requested_game",
+                partialFilterExpression={"status": TradeStatus.PENDING.name}
+            )
+
+        except PyMongoError as e:
+            raise RuntimeError(f"Failed to create trade indexes: {e}")
+
+    async def _drop_index_if_exists(self, name: str) -> None:
+        try:
+            await self.trades.drop_index(name)
 
-        self.cache: redis.Redis = redis.Redis(host=self.REDIS_HOST, port=6379, decode_responses=True)
+        except OperationFailure as e:
+            if e.code != self.INDEX_NOT_FOUND:
+                raise
 
+    # NOTE: Every cached page for a user lives in a single hash so that invalidating
+    # the user's trades is still one DEL no matter how many pages were cached
     def _trades_cache_key(self, email: str) -> str:
         return f"trades:{email}"
 
-    def _invalidate_trades_cache(self, sender_email: str, receiver_email: str) -> None:
-        self.cache.delete(self._trades_cache_key(sender_email))
-        self.cache.delete(self._trades_cache_key(receiver_email))
+    def _trades_page_field(self, status: TradeStatus | None, limit: int, cursor: str | None) -> str:
+        return f"{status.name if status else 'ALL'}:{limit}:{cursor or ''}"
+
+    def _trades_version_key(self, email: str) -> str:
+        return f"trades-version:{email}"
+
+    # NOTE: Every change to a user's trades bumps their trades version, which is what their trades
+    # pages' ETags are made from. Cached pages remember the version they were loaded at too, so a
+    # page a slow fill cached after the bump is never served (the DEL alone can't stop that)
+    async def _invalidate_trades_cache(self, *emails: str) -> None:
+        for email in emails:
+            await self.bump_version_script(
+                keys=[self._trades_version_key(email)],
+                args=[time.time_ns(), self.VERSION_TTL]
+            )
+            await self.cache.delete(self._trades_cache_key(email))
+
+    # NOTE: None if Redis is unavailable, in which case there's nothing to compare against
+    async def get_trades_version(self, email: str) -> int | None:
+        version_key: str = self._trades_version_key(email)
+
+        try:
+            async with self.cache.pipeline(transaction=False) as pipe:
+                pipe.set(version_key, time.time_ns(), nx=True, ex=self.VERSION_TTL)
+                pipe.get(version_key)
+                _, version = await pipe.execute()
+
+            return int(version)
 
-    def add_trade(self, trade: Trade) -> str:
+        except redis.RedisError:
+            self.logger.warning(f"Redis unavailable, no trades version for '{email}'")
+            return None
+
+    async def add_trade(self, trade: Trade) -> str:
         try:
-            self.trades.insert_one({
+            await self.trades.insert_one({
                 "_id": trade.id,
                 "sender_email": trade.sender_email,
                 "receiver_email": trade.receiver_email,
                 "offered_game": trade.offered_game,
                 "requested_game": trade.requested_game,
-                "status": trade.status.name
+                "status": trade.status.name,
+                "created": trade.created
             })
-            self._invalidate_trades_cache(trade.sender_email, trade.receiver_email)
+            await self._invalidate_trades_cache(trade.sender_email, trade.receiver_email)
             return trade.id
         except PyMongoError as e:
             raise RuntimeError(f"Failed to insert trade '{trade.id}': {e}")
 
-    def get_trade(self, trade_id: str) -> Trade | None:
-        trade_data: dict | None = self._find_trade(trade_id)
+    async def get_trade(self, trade_id: str) -> Trade | None:
+        trade_data: dict | None = await self._find_trade(trade_id)
         if trade_data is None:
             return None
         return self._dict_to_trade(trade_data)
 
-    def accept_trade(self, trade_id: str, users: Users) -> None:
-        trade = self.get_trade(trade_id)
+    async def accept_trade(self, trade_id: str, users: Users) -> None:
+        trade = await self.get_trade(trade_id)
         if trade is None:
             raise ValueError(f"Trade '{trade_id}' does not exist!")
 
         if trade.status != TradeStatus.PENDING:
             raise ValueError(f"Trade '{trade_id}' is not pending!")
 
-        users.exchange_games(
+        superseded_traders: set[str] = set()
+
+        # NOTE: The status flip is guarded on PENDING and runs inside the same transaction as the
+        # game swap, so of several racing accepts at most one can ever commit. Every other pending
+        # trade involving either game is dead once the swap lands, so it is superseded here too
+        async def _claim_trade(session: AsyncClientSession) -> None:
+            result = await self.trades.update_one(
+                {"_id": trade_id, "status": TradeStatus.PENDING.name},
+                {"$set": {"status": TradeStatus.ACCEPTED.name}},
+                session=session
+            )
+
+            if result.matched_count == 0:
+                raise ValueError(f"Trade '{trade_id}' is not pending!")
+
+            # NOTE: with_transaction may retry the callback
+            superseded_traders.clear()
+            superseded_traders.update(await self._supersede_pending_trades(
+                [
+                    (trade.sender_email, trade.offered_game),
+                    (trade.receiver_email, trade.requested_game)
+                ],
+                session=session
+            ))
+
+        await users.exchange_games(
             sender_email=trade.sender_email,
             receiver_email=trade.receiver_email,
             sender_game_name=trade.offered_game,
-            receiver_game_name=trade.requested_game
+            receiver_game_name=trade.requested_game,
+            in_transaction=_claim_trade
         )
 
-        self._update_trade_status(trade_id, TradeStatus.ACCEPTED)
-        self._invalidate_trades_cache(trade.sender_email, trade.receiver_email)
+        await self._invalidate_trades_cache(trade.sender_email, trade.receiver_email, *superseded_traders)
+
+    # NOTE: Called when a game leaves its owner outside of a trade (deleted or renamed)
+    async def supersede_trades_for_game(self, email: str, game_name: str) -> None:
+        superseded_traders: set[str] = await self._supersede_pending_trades([(email, game_name)])
+        await self._invalidate_trades_cache(*superseded_traders)
+
+    # NOTE: Marks every pending trade that offers or requests any of the given (owner email, game name)
+    # pairs as superseded and returns the emails of everyone whose trade list changed
+    async def _supersede_pending_trades(
+        self,
+        owned_games: list[tuple[str, str]],
+        session: AsyncClientSession | None = None
+    ) -> set[str]:
+        query: dict = {
+            "status": TradeStatus.PENDING.name,
+            "$or": [
+                clause
+                for email, game_name in owned_games
+                for clause in (
+                    {"sender_email": email, "offered_game": game_name},
+                    {"receiver_email": email, "requested_game": game_name}
+                )
+            ]
+        }
+
+        try:
+            stale_trades: list[dict] = [
+                doc async for doc in self.trades.find(
+                    query,
+                    projection={"sender_email": 1, "receiver_email": 1},
+                    session=session
+                )
+            ]
+
+            if not stale_trades:
+                return set()
 
-    def reject_trade(self, trade_id: str) -> None:
-        trade = self.get_trade(trade_id)
+            await self.trades.update_many(
+                {"_id": {"$in": [doc["_id"] for doc in stale_trades]}, "status": TradeStatus.PENDING.name},
+                {"$set": {"status": TradeStatus.SUPERSEDED.name}},
+                session=session
+            )
+
+        except PyMongoError as e:
+            # NOTE: Inside a transaction the error is passed on as is, `with_transaction` only retries
+            # a PyMongoError labelled transient (e.g. the write conflict between two racing accepts
+            # superseding each other's trades) and the caller reports anything else
+            if session is not None:
+                raise
+
+            raise RuntimeError(f"Failed to supersede pending trades: {e}")
+
+        return {
+            email
+            for doc in stale_trades
+            for email in (doc["sender_email"], doc["receiver_email"])
+        }
+
+    async def reject_trade(self, trade_id: str) -> None:
+        trade = await self.get_trade(trade_id)
         if trade is None:
             raise ValueError(f"Trade '{trade_id}' does not exist!")
 
         if trade.status != TradeStatus.PENDING:
             raise ValueError(f"Trade '{trade_id}' is not pending!")
 
-        self._update_trade_status(trade_id, TradeStatus.REJECTED)
-        self._invalidate_trades_cache(trade.sender_email, trade.receiver_email)
+        await self._update_trade_status(trade_id, TradeStatus.REJECTED)
+        await self._invalidate_trades_cache(trade.sender_email, trade.receiver_email)
+
+    # NOTE: Keyset pagination on (created, _id), both newest first. The cursor is the sort key of
+    # the last trade on the previous page, so a page never has to skip over the earlier ones
+    def _encode_cursor(self, trade: Trade) -> str:
+        raw: bytes = json.dumps([trade.created.isoformat(), trade.id]).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii")
 
-    def _get_incoming_for(self, email: str) -> list[Trade]:
-        cursor = self.trades.find({"receiver_email": email})
-        return [self._dict_to_trade(doc) for doc in cursor]
+    def _decode_cursor(self, cursor: str) -> tuple[datetime, str]:
+        try:
+            created, trade_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return datetime.fromisoformat(created), str(trade_id)
 
-    def _get_outgoing_for(self, email: str) -> list[Trade]:
-        cursor = self.trades.find({"sender_email": email})
-        return [self._dict_to_trade(doc) for doc in cursor]
+        except Exception:
+            raise ValueError(f"Invalid trades cursor '{cursor}'!")
 
-    def get_trades_for(self, email: str) -> dict[str, list[dict]]:
-        cache_key: str = self._trades_cache_key(email)
+    # NOTE: One round trip for both directions, each $or branch is served by its own index.
+    # Filtering on every status when none is given keeps the status key of the index usable
+    async def _find_trades_page(
+        self,
+        email: str,
+        status: TradeStatus | None,
+        limit: int,
+        cursor: str | None
+    ) -> list[Trade]:
+        statuses: list[str] = [status.name] if status else [s.name for s in TradeStatus]
+
+        query: dict = {"$or": [
+            {"receiver_email": email, "status": {"$in": statuses}},
+            {"sender_email": email, "status": {"$in": statuses}}
+        ]}
+
+        if cursor is not None:
+            created, trade_id = self._decode_cursor(cursor)
+            query = {"$and": [query, {"$or": [
+                {"created": {"$lt": created}},
+                {"created": created, "_id": {"$lt": trade_id}}
+            ]}]}
+
+        try:
+            found = self.trades.find(
+                query,
+                projection=self.TRADE_PROJECTION
+            ).sort([("created", DESCENDING), ("_id", DESCENDING)]).limit(limit + 1)
+
+            return [self._dict_to_trade(doc) async for doc in found]
+
+        except PyMongoError as e:
+            raise RuntimeError(f"Failed to query trades for '{email}': {e}")
+
+    def check_page_request(self, limit: int, cursor: str | None) -> None:
+        if not 1 <= limit <= self.MAX_PAGE_SIZE:
+            raise ValueError(f"Page limit must be between 1 and {self.MAX_PAGE_SIZE}!")
+
+        if cursor is not None:
+            self._decode_cursor(cursor)
+
+    # NOTE: `version` is the user's trades version from `get_trades_version`, which the caller has
+    # already read for the ETag check. It has to be read before the page, so a page is never
+    # labelled with a version newer than it is
+    async def get_trades_for(
+        self,
+        email: str,
+        version: int | None,
+        status: TradeStatus | None = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: str | None = None
+    ) -> TradesPage:
+        self.check_page_request(limit, cursor)
+
+        page_field: str = self._trades_page_field(status, limit, cursor)
+        fill_key: str = f"{self._trades_cache_key(email)}:{page_field}:{version}"
         try:
-            cached: str | None = self.cache.get(cache_key)
+            cached, ttl_s = await self._read_cached_page(email, page_field, version)
             if cached is not None:
                 self.logger.info(f"Cache HIT for trades of '{email}'")
-                return json.loads(cached)
+
+                if self.cache_fill.should_refresh_early(ttl_s):
+                    self.cache_fill.refresh(
+                        fill_key,
+                        lambda: self._load_trades_page(email, status, limit, cursor, version, refresh=True)
+                    )
+
+                return cached
         except redis.RedisError:
             self.logger.warning(f"Redis unavailable, falling back to MongoDB for trades of '{email}'")
 
-        result: dict = {
-            "incoming": [trade.to_dict() for trade in self._get_incoming_for(email)],
-            "outgoing": [trade.to_dict() for trade in self._get_outgoing_for(email)]
-        }
+        return await self.cache_fill.fill(
+            fill_key,
+            lambda: self._load_trades_page(email, status, limit, cursor, version),
+            lambda: self._read_cached_page_only(email, page_field, version)
+        )
+
+    # NOTE: Returns the cached page and how long until the user's cached pages expire. A page
+    # loaded at any other version than the current one is a miss
+    async def _read_cached_page(
+        self,
+        email: str,
+        page_field: str,
+        version: int | None
+    ) -> tuple[TradesPage | None, float]:
+        cache_key: str = self._trades_cache_key(email)
+
+        async with self.cache.pipeline(transaction=False) as pipe:
+            pipe.hget(cache_key, page_field)
+            pipe.pttl(cache_key)
+            cached, ttl_ms = await pipe.execute()
+
+        if cached is None:
+            return None, 0.0
+
+        # NOTE: Pages cached before they were stored pre-serialized are dicts, they're refetched
+        decoded: typing.Any = self.codec.decode(cached)
+        if not isinstance(decoded, list) or len(decoded) != 3:
+            return None, 0.0
 
+        next_cursor, body, cached_version = decoded
+        if version is None or cached_version != version:
+            return None, 0.0
+
+        return TradesPage(body=body, next_cursor=next_cursor, version=version), ttl_ms / 1000
+
+    async def _read_cached_page_only(
+        self,
+        email: str,
+        page_field: str,
+        version: int | None
+    ) -> TradesPage | None:
+        cached, _ = await self._read_cached_page(email, page_field, version)
+        return cached
+
+    # NOTE: All of a user's pages share the hash's TTL, so an early refresh starts the hash over
+    # with just the refreshed page rather than extending how long every other page can live
+    async def _load_trades_page(
+        self,
+        email: str,
+        status: TradeStatus | None,
+        limit: int,
+        cursor: str | None,
+        version: int | None,
+        refresh: bool = False
+    ) -> TradesPage:
+        page: list[Trade] = await self._find_trades_page(email, status, limit, cursor)
+
+        has_next: bool = len(page) > limit
+        page = page[:limit]
+
+        directions: dict[str, list[dict]] = {"incoming": [], "outgoing": []}
+        for trade in page:
+            direction: str = "incoming" if trade.receiver_email == email else "outgoing"
+            directions[direction].append(trade.to_dict())
+
+        result: TradesPage = TradesPage(
+            body=orjson.dumps(directions),
+            next_cursor=self._encode_cursor(page[-1]) if has_next else None,
+            version=version
+        )
+
+        cache_key: str = self._trades_cache_key(email)
         try:
-            self.cache.setex(cache_key, self.CACHE_TTL, json.dumps(result))
+            async with self.cache.pipeline(transaction=refresh) as pipe:
+                if refresh:
+                    pipe.delete(cache_key)
+
+                pipe.hset(cache_key, self._trades_page_field(status, limit, cursor), self.codec.encode([result.next_cursor, result.body, result.version]))
+                pipe.expire(cache_key, self.CACHE_TTL, nx=not refresh)
+                await pipe.execute()
+
             self.logger.info(f"Cache MISS for trades of '{email}', cached result")
         except redis.RedisError:
             self.logger.warning(f"Failed to cache trades for '{email}'")
 
         return result
 
-    def _find_trade(self, trade_id: str) -> dict | None:
+    async def _find_trade(self, trade_id: str) -> dict | None:
         try:
-            return self.trades.find_one({"_id": trade_id})
+            return await self.trades.find_one({"_id": trade_id})
 
         except PyMongoError as e:
             raise RuntimeError(f"Failed to query trade '{trade_id}': {e}")
 
-    def _update_trade_status(self, trade_id: str, status: TradeStatus) -> None:
+    async def _update_trade_status(self, trade_id: str, status: TradeStatus) -> None:
         try:
-            result = self.trades.find_one_and_update(
+            result = await self.trades.find_one_and_update(
                 {"_id": trade_id},
                 {"$set": {"status": status.name}},
                 return_document=ReturnDocument.AFTER
@@ -140,7 +506,10 @@ class Trades:
             offered_game=data["offered_game"],
             requested_game=data["requested_game"],
             status=TradeStatus[data["status"]],
-            id=data["_id"]
+            id=data["_id"],
+            # NOTE: Backfilled by `ensure_indexes`, only missing if a replica predating the field
+            # inserted the trade since
+            created=data.get("created", self.LEGACY_CREATED)
         )
 
 
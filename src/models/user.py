@@ -1,19 +1,57 @@
 from .game import Game
 
+# NOTE: Most requests only ever look at one or two of a user's games (if any), so games are kept as
+# the raw documents they were loaded from and only turned into `Game`s when asked for. The raw
+# games can be shared with the user cache and are never modified, the first change to a user's
+# games materializes all of them first
 class User:
+    __slots__ = ("name", "email", "password", "street_address", "version", "_games", "_raw_games")
+
     def __init__(
         self, 
         name: str,
         email: str,
         password: str,
         street_address: str,
-        games: dict[str, Game] = {},
+        games: dict[str, Game] | None = None,
+        raw_games: dict[str, dict] | None = None,
+        version: int = 0
     ) -> None:
         self.name: str = name
         self.email: str = email
         self.password: str = password
         self.street_address: str = street_address
-        self.games: dict[str, Game] = games
+
+        # NOTE: The version of the stored document this user was loaded from
+        self.version: int = version
+
+        if games is None and raw_games is None:
+            games = {}
+
+        self._games: dict[str, Game] | None = games
+        self._raw_games: dict[str, dict] | None = raw_games
+
+    @staticmethod
+    def from_dict(data: dict):
+        return User(
+            name=data["name"],
+            email=data["email"],
+            password=data["password"],
+            street_address=data["street_address"],
+            raw_games=data.get("games", {}),
+            version=data.get("version", 0)
+        )
+
+    @property
+    def games(self) -> dict[str, Game]:
+        if self._games is None:
+            self._games = {
+                title: Game.from_dict(title, game)
+                for title, game in self._raw_games.items()
+            }
+            self._raw_games = None
+
+        return self._games
 
     def update_user(
         self,
@@ -32,8 +70,17 @@ class User:
 
         self.games[game.name] = game
 
+    # NOTE: Only builds the one game asked for, the returned `Game` is a copy until the user's
+    # games are materialized so changes to it aren't kept
     def get_game(self, name: str) -> Game | None:
-        return self.games.get(name)
+        if self._games is not None:
+            return self._games.get(name)
+
+        game: dict | None = self._raw_games.get(name)
+        if game is None:
+            return None
+
+        return Game.from_dict(name, game)
 
     def update_game(
         self,
@@ -41,7 +88,7 @@ class User:
         new_name:  str | None = None,
         condition: str | None = None
     ) -> None:
-        game: Game | None = self.get_game(name)
+        game: Game | None = self.games.get(name)
         if game is None:
             raise ValueError(f"Game '{name}' does not exist!")
 
@@ -64,5 +111,7 @@ class User:
         del self.games[name]
 
     def has_game(self, name: str) -> bool:
-        return name in self.games.keys()
+        if self._games is not None:
+            return name in self._games
 
+        return name in self._raw_games
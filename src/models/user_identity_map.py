@@ -0,0 +1,22 @@
+from .user import User
+from .users import Users
+
+# NOTE: Request scoped, every user is loaded from the store at most once per request no matter
+# how many times the auth dependency, the handler or the notification building asks for them
+class UserIdentityMap:
+    def __init__(self, users: Users) -> None:
+        self.users: Users = users
+
+        self.loaded: dict[str, User | None] = {}
+        self.lookups: int = 0
+
+    async def get_user(self, email: str) -> User | None:
+        if email in self.loaded:
+            return self.loaded[email]
+
+        self.lookups += 1
+
+        user: User | None = await self.users.get_user(email)
+        self.loaded[email] = user
+
+        return user
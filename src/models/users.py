@@ -3,69 +3,263 @@
 
 import json
 import typing
+import asyncio
 
 from logging import Logger
+from collections.abc import Callable, Awaitable
 
 from .user import User
 from .game import Game
+from .mongo import get_mongo_client
+from .cache_fill import CacheFill
+from .cache_codec import CacheCodec, CacheFormat
+from .local_cache import LocalCache
 
 import redis
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
 
 from pymongo.errors import PyMongoError
-from pymongo.collection import Collection
-from pymongo import MongoClient, ReturnDocument
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.client_session import AsyncClientSession
+
+# NOTE: Writes the user into the cache unless the cache already holds a newer version, so a slow
+# writer (or a read-through that raced a write) can never put an older state back. Rewriting the
+# same version just refreshes its TTL
+WRITE_THROUGH_SCRIPT: typing.Final[str] = """
+local cached = tonumber(redis.call('HGET', KEYS[1], 'ver'))
+if cached ~= nil and cached > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'ver', ARGV[1], 'data', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
 
 class Users:
-    MONGO_URI: typing.Final[str] = "mongodb://mongo:27017"
     REDIS_HOST: typing.Final[str] = "redis"
     CACHE_TTL: typing.Final[int] = 300
 
+    # NOTE: Unknown emails (failed logins, trades offered to a typo) are cached as missing too, but
+    # only briefly. Registering overwrites the entry straight away either way
+    NEGATIVE_CACHE_TTL: typing.Final[int] = 30
+
+    # NOTE: Cached in place of a user that doesn't exist. Its version is below that of any real
+    # user, so the write that creates the user always replaces it
+    MISSING: typing.Final[dict] = {"version": -1, "missing": True}
+
+    LOCAL_CACHE_SIZE: typing.Final[int] = 10_000
+    LOCAL_CACHE_TTL: typing.Final[float] = 30.0
+
+    INVALIDATION_CHANNEL: typing.Final[str] = "user-cache-invalidations"
+
+    CACHE_FORMAT: typing.Final[CacheFormat] = CacheFormat.MSGPACK_ZSTD
+
     def __init__(self, logger: Logger) -> None:
         self.logger = logger
 
-        client: MongoClient = MongoClient(self.MONGO_URI)
-        self.users: Collection = client["video_game_exchange"]["users"]
+        self.client: AsyncMongoClient = get_mongo_client()
+        self.users: AsyncCollection = self.client["video_game_exchange"]["users"]
 
-        self.cache: redis.Redis = redis.Redis(host=self.REDIS_HOST, port=6379, decode_responses=True)
+        # NOTE: Cached users are binary (see CacheCodec), so nothing is decoded on the way out
+        self.cache: Redis = Redis(host=self.REDIS_HOST, port=6379, decode_responses=False)
+        self.codec: CacheCodec = CacheCodec(self.CACHE_FORMAT)
         self.logger.info("Connected to Redis cache")
 
-    def add_user(self, user: User) -> None:
-        if self._find_user(user.email) is not None:
+        self.write_through_script: AsyncScript = self.cache.register_script(WRITE_THROUGH_SCRIPT)
+        self.cache_fill: CacheFill = CacheFill(self.logger, self.cache, name="users")
+
+        self.local_cache: LocalCache = LocalCache(
+            name="users",
+            max_size=self.LOCAL_CACHE_SIZE,
+            ttl=self.LOCAL_CACHE_TTL
+        )
+
+    async def add_user(self, user: User) -> None:
+        if await self._find_user(user.email) is not None:
             raise ValueError(f"User '{user.email}' already exists!")
 
-        self._insert_user(user)
+        await self._insert_user(user)
 
+    # NOTE: A hash of the user's document version and the document itself. The key changed from
+    # `user:{email}` when entries stopped being plain strings, so old entries are never misread
     def _cache_key(self, email: str) -> str:
-        return f"user:{email}"
+        return f"user:v2:{email}"
+
+    # NOTE: Every write to a user bumps the document's version, documents written before versions
+    # existed count as version 0
+    def _version(self, user_data: dict) -> int:
+        return user_data.get("version", 0)
+
+    # NOTE: Puts the given state of the user into both cache tiers, unless either already holds
+    # a newer version of them
+    async def _cache_user(self, user_data: dict) -> dict:
+        email: str = user_data["_id"]
+        version: int = self._version(user_data)
+
+        cacheable: dict = {k: v for k, v in user_data.items() if k != "_id"}
+        cacheable["email"] = email
+
+        self._cache_locally(email, cacheable)
+
+        try:
+            await self.write_through_script(
+                keys=[self._cache_key(email)],
+                args=[version, self.codec.encode(cacheable), self.CACHE_TTL]
+            )
+        except redis.RedisError:
+            self.logger.warning(f"Failed to cache user '{email}'")
+
+        return cacheable
+
+    # NOTE: Only ever moves the local tier forward, a read that started before a write on this
+    # replica would otherwise put the older version back after the write-through
+    def _cache_locally(self, email: str, user_data: dict) -> None:
+        local: dict | None = self.local_cache.peek(email)
+        if local is None or self._version(local) <= self._version(user_data):
+            self.local_cache.set(email, user_data)
+
+    async def _cache_missing(self, email: str) -> dict:
+        if self.local_cache.peek(email) is None:
+            self.local_cache.set(email, self.MISSING)
+
+        try:
+            await self.write_through_script(
+                keys=[self._cache_key(email)],
+                args=[self._version(self.MISSING), self.codec.encode(self.MISSING), self.NEGATIVE_CACHE_TTL]
+            )
+        except redis.RedisError:
+            self.logger.warning(f"Failed to cache missing user '{email}'")
+
+        return self.MISSING
+
+    # NOTE: Returns the cached user (or MISSING) and how long until the entry expires. An entry in
+    # a format this replica can't read counts as a miss, and gets rewritten in one it can
+    async def _read_cached(self, email: str) -> tuple[dict | None, float]:
+        async with self.cache.pipeline(transaction=False) as pipe:
+            pipe.hget(self._cache_key(email), "data")
+            pipe.pttl(self._cache_key(email))
+            cached, ttl_ms = await pipe.execute()
+
+        if cached is None:
+            return None, 0.0
+
+        return self.codec.decode(cached), ttl_ms / 1000
+
+    async def _read_cached_user(self, email: str) -> dict | None:
+        cached, _ = await self._read_cached(email)
+        return cached
+
+    async def _load_user(self, email: str) -> dict:
+        user_data: dict | None = await self._find_user(email)
+        if user_data is None:
+            return await self._cache_missing(email)
+
+        return await self._cache_user(user_data)
+
+    # NOTE: Called with the state a write returned, so the next read of the user is a cache hit
+    # instead of a trip to Mongo. Other replicas are told the new version so they can drop their
+    # older local copy (and pick the new one up from Redis)
+    async def _write_through(self, user_data: dict) -> None:
+        await self._cache_user(user_data)
+
+        try:
+            await self.cache.publish(
+                self.INVALIDATION_CHANNEL,
+                json.dumps({"email": user_data["_id"], "version": self._version(user_data)})
+            )
+        except redis.RedisError:
+            self.logger.warning(f"Failed to publish cache invalidation for user '{user_data['_id']}'")
+
+    # NOTE: Runs for the lifetime of the app so that a write on any replica evicts the user from
+    # every other replica's local cache. A replica already holding that version (i.e. the one that
+    # made the write) keeps its copy
+    async def listen_for_invalidations(self) -> None:
+        while True:
+            try:
+                async with self.cache.pubsub() as pubsub:
+                    await pubsub.subscribe(self.INVALIDATION_CHANNEL)
+
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._on_invalidation(message["data"])
+
+            except redis.RedisError:
+                self.logger.warning("Lost user cache invalidation channel, resubscribing")
 
-    def _invalidate_cache(self, email: str) -> None:
-        self.cache.delete(self._cache_key(email))
+                # Invalidations may have been missed while disconnected
+                self.local_cache.clear()
+                await asyncio.sleep(1)
+
+    def _on_invalidation(self, data: bytes) -> None:
+        try:
+            invalidation: dict = json.loads(data)
+            email: str = invalidation["email"]
+            version: int = invalidation["version"]
+
+        # NOTE: Replicas that haven't been upgraded yet publish the bare email
+        except (ValueError, TypeError, KeyError):
+            self.local_cache.evict(data.decode("utf-8"))
+            return
+
+        local: dict | None = self.local_cache.peek(email)
+        if local is not None and self._version(local) < version:
+            self.local_cache.evict(email)
+
+    async def get_user(self, email: str) -> User | None:
+        local: dict | None = self.local_cache.get(email)
+        if local is not None:
+            return self._dict_to_user(local)
 
-    def get_user(self, email: str) -> User | None:
         cache_key: str = self._cache_key(email)
         try:
-            cached: str | None = self.cache.get(cache_key)
+            cached, ttl_s = await self._read_cached(email)
             if cached is not None:
                 self.logger.info(f"Cache HIT for user '{email}'")
-                return self._dict_to_user(json.loads(cached))
+                self._cache_locally(email, cached)
+
+                if self.cache_fill.should_refresh_early(ttl_s):
+                    self.cache_fill.refresh(cache_key, lambda: self._load_user(email))
+
+                return self._dict_to_user(cached)
         except redis.RedisError:
             self.logger.warning(f"Redis unavailable, falling back to MongoDB for user '{email}'")
 
-        user_data: dict | None = self._find_user(email)
-        if user_data is None:
-            return None
+        self.logger.info(f"Cache MISS for user '{email}', caching result")
 
-        try:
-            cacheable: dict = {k: v for k, v in user_data.items() if k != "_id"}
-            cacheable["email"] = email
-            self.cache.setex(cache_key, self.CACHE_TTL, json.dumps(cacheable))
-            self.logger.info(f"Cache MISS for user '{email}', cached result")
-        except redis.RedisError:
-            self.logger.warning(f"Failed to cache user '{email}'")
+        user_data: dict = await self.cache_fill.fill(
+            cache_key,
+            lambda: self._load_user(email),
+            lambda: self._read_cached_user(email)
+        )
 
         return self._dict_to_user(user_data)
 
-    def update_user(
+    # NOTE: Just the version of the user's document, which is all a conditional GET needs to know
+    # whether the client's copy is still current. Comes from wherever `get_user` would get the user
+    # from, falling back to loading them. None if the user doesn't exist
+    async def get_user_version(self, email: str) -> int | None:
+        local: dict | None = self.local_cache.get(email)
+
+        if local is None:
+            try:
+                cached: bytes | None = await self.cache.hget(self._cache_key(email), "ver")
+                if cached is not None:
+                    version: int = int(cached)
+                    return version if version != self._version(self.MISSING) else None
+            except redis.RedisError:
+                self.logger.warning(f"Redis unavailable, falling back to MongoDB for user '{email}'")
+
+            user: User | None = await self.get_user(email)
+            return user.version if user is not None else None
+
+        if local.get("missing"):
+            return None
+
+        return self._version(local)
+
+    async def update_user(
         self,
         email: str,
         name: str | None = None,
@@ -84,15 +278,13 @@ class Users:
             update_fields["street_address"] = street_address
 
         if update_fields:
-            self._update(email, update_fields)
-            self._invalidate_cache(email)
+            await self._write_through(await self._update(email, update_fields))
 
-    def add_game(self, email: str, game: Game) -> None:
-        self._update(email, {f"games.{game.name}": game.to_dict()})
-        self._invalidate_cache(email)
+    async def add_game(self, email: str, game: Game) -> None:
+        await self._write_through(await self._update(email, {f"games.{game.name}": game.to_dict()}))
 
-    def get_game(self, email: str, game_name: str) -> Game | None:
-        user_data: dict | None = self._find_user(email)
+    async def get_game(self, email: str, game_name: str) -> Game | None:
+        user_data: dict | None = await self._find_user(email)
         if user_data is None:
             raise ValueError(f"User '{email}' does not exist!")
 
@@ -102,14 +294,14 @@ class Users:
 
         return Game.from_dict(game_name, game_data)
 
-    def update_game(
+    async def update_game(
         self,
         email: str,
         game_name: str,
         new_name: str | None = None,
         condition: str | None = None
     ) -> None:
-        user_data: dict | None = self._find_user(email)
+        user_data: dict | None = await self._find_user(email)
         if user_data is None:
             raise ValueError(f"User '{email}' does not exist!")
 
@@ -117,111 +309,171 @@ class Users:
         if game_data is None:
             raise ValueError(f"Game '{game_name}' does not exist for user '{email}'!")
 
+        updated_user: dict | None = None
+
         if condition is not None:
-            self._update(email, {f"games.{game_name}.condition": condition})
+            updated_user = await self._update(email, {f"games.{game_name}.condition": condition})
 
         if new_name is not None:
-            self._update(email, {f"games.{game_name}": ""}, unset=True)
+            await self._update(email, {f"games.{game_name}": ""}, unset=True)
 
             game_data["name"] = new_name
-            self._update(email, {f"games.{new_name}": game_data})
+            updated_user = await self._update(email, {f"games.{new_name}": game_data})
 
-        self._invalidate_cache(email)
+        if updated_user is not None:
+            await self._write_through(updated_user)
 
-    def delete_game(self, email: str, game_name: str) -> None:
-        user_data: dict | None = self._find_user(email)
+    async def delete_game(self, email: str, game_name: str) -> None:
+        user_data: dict | None = await self._find_user(email)
         if user_data is None:
             raise ValueError(f"User '{email}' does not exist!")
 
         if game_name not in user_data.get("games", {}):
             raise ValueError(f"Game '{game_name}' does not exist for user '{email}'!")
 
-        self._update(email, {f"games.{game_name}": ""}, unset=True)
-        self._invalidate_cache(email)
+        await self._write_through(await self._update(email, {f"games.{game_name}": ""}, unset=True))
 
-    def exchange_games(
+    # NOTE: The swap runs as one transaction, `in_transaction` lets the caller (i.e. Trades) apply
+    # its own writes in the same transaction so that either everything commits or nothing does
+    async def exchange_games(
         self,
         sender_email: str,
         receiver_email: str,
         sender_game_name: str,
-        receiver_game_name: str
+        receiver_game_name: str,
+        in_transaction: Callable[[AsyncClientSession], Awaitable[None]] | None = None
     ) -> None:
-        sender: dict | None = self._find_user(sender_email)
-        receiver: dict | None = self._find_user(receiver_email)
+        updated_traders: list[dict] = []
+
+        async def _exchange(session: AsyncClientSession) -> None:
+            # NOTE: The callback is rerun if the transaction is retried
+            updated_traders.clear()
+
+            if in_transaction is not None:
+                await in_transaction(session)
+
+            traders: dict[str, dict] = {
+                doc["_id"]: doc
+                async for doc in self.users.find(
+                    {"_id": {"$in": [sender_email, receiver_email]}},
+                    projection={f"games.{sender_game_name}": 1, f"games.{receiver_game_name}": 1},
+                    session=session
+                )
+            }
 
-        if sender is None:
-            raise ValueError(f"Sender '{sender_email}' does not exist!")
+            sender: dict | None = traders.get(sender_email)
+            receiver: dict | None = traders.get(receiver_email)
 
-        if receiver is None:
-            raise ValueError(f"Receiver '{receiver_email}' does not exist!")
+            if sender is None:
+                raise ValueError(f"Sender '{sender_email}' does not exist!")
 
-        sender_game: dict | None = sender.get("games", {}).get(sender_game_name)
-        receiver_game: dict | None = receiver.get("games", {}).get(receiver_game_name)
+            if receiver is None:
+                raise ValueError(f"Receiver '{receiver_email}' does not exist!")
 
-        if sender_game is None:
-            raise ValueError(f"Sender no longer has game '{sender_game_name}'!")
+            sender_game: dict | None = sender.get("games", {}).get(sender_game_name)
+            receiver_game: dict | None = receiver.get("games", {}).get(receiver_game_name)
 
-        if receiver_game is None:
-            raise ValueError(f"Receiver no longer has game '{receiver_game_name}'!")
+            if sender_game is None:
+                raise ValueError(f"Sender no longer has game '{sender_game_name}'!")
 
-        self._update(sender_email, {f"games.{sender_game_name}": ""}, unset=True)
-        self._update(receiver_email, {f"games.{receiver_game_name}": ""}, unset=True)
+            if receiver_game is None:
+                raise ValueError(f"Receiver no longer has game '{receiver_game_name}'!")
 
-        self._update(sender_email, {f"games.{receiver_game_name}": receiver_game})
-        self._update(receiver_email, {f"games.{sender_game_name}": sender_game})
+            updated_traders.append(
+                await self._swap_game(sender_email, sender_game_name, receiver_game_name, receiver_game, session)
+            )
+            updated_traders.append(
+                await self._swap_game(receiver_email, receiver_game_name, sender_game_name, sender_game, session)
+            )
+
+        try:
+            async with self.client.start_session() as session:
+                await session.with_transaction(_exchange)
+
+        except PyMongoError as e:
+            raise RuntimeError(f"Failed to exchange games between '{sender_email}' and '{receiver_email}': {e}")
+
+        # NOTE: Only written through after the commit, otherwise a concurrent read could see the
+        # post-trade state before the transaction lands (or even though it aborted)
+        for updated_trader in updated_traders:
+            await self._write_through(updated_trader)
+
+    # NOTE: The $exists guard makes the swap fail (and the transaction abort) if the game was
+    # moved by someone else after it was read
+    async def _swap_game(
+        self,
+        email: str,
+        given_game_name: str,
+        received_game_name: str,
+        received_game: dict,
+        session: AsyncClientSession
+    ) -> dict:
+        updated_user: dict | None = await self.users.find_one_and_update(
+            {"_id": email, f"games.{given_game_name}": {"$exists": True}},
+            {
+                "$unset": {f"games.{given_game_name}": ""},
+                "$set": {f"games.{received_game_name}": received_game},
+                "$inc": {"version": 1}
+            },
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+
+        if updated_user is None:
+            raise ValueError(f"User '{email}' no longer has game '{given_game_name}'!")
 
-        self._invalidate_cache(sender_email)
-        self._invalidate_cache(receiver_email)
+        return updated_user
 
-    def _find_user(self, email: str) -> dict | None:
+    async def _find_user(self, email: str) -> dict | None:
         try:
-            return self.users.find_one({"_id": email})
+            return await self.users.find_one({"_id": email})
 
         except PyMongoError as e:
             raise RuntimeError(f"Failed to query user '{email}': {e}")
 
-    def _insert_user(self, user: User) -> None:
+    async def _insert_user(self, user: User) -> None:
+        user_data: dict = {
+            "_id": user.email,
+            "name": user.name,
+            "email": user.email,
+            "password": user.password,
+            "street_address": user.street_address,
+            "games": {},
+            "version": 1
+        }
+
         try:
-            self.users.insert_one({
-                "_id": user.email,
-                "name": user.name,
-                "email": user.email,
-                "password": user.password,
-                "street_address": user.street_address,
-                "games": {}
-            })
+            await self.users.insert_one(user_data)
 
         except PyMongoError as e:
             raise RuntimeError(f"Failed to insert user '{user.email}'! Reason: {str(e)}")
 
-    def _update(self, email: str, fields: dict, unset: bool = False) -> dict:
+        # NOTE: A new user is nearly always logged in (and given games) right after registering.
+        # Also replaces them being cached as missing, on every replica
+        await self._write_through(user_data)
+
+    # NOTE: Returns the user as it is after the update, which is what gets written to the cache
+    async def _update(self, email: str, fields: dict, unset: bool = False) -> dict:
         try:
             update_query: dict = {"$unset" : fields } if unset else {"$set" : fields}
-            prev_user_state: dict | None = self.users.find_one_and_update(
+            update_query["$inc"] = {"version": 1}
+
+            updated_user: dict | None = await self.users.find_one_and_update(
                 {"_id" : email},
                 update_query,
-                return_document=ReturnDocument.BEFORE
+                return_document=ReturnDocument.AFTER
             )
 
-            if prev_user_state is None:
+            if updated_user is None:
                 raise ValueError(f"User '{email}' does not exist!")
 
-            return prev_user_state
+            return updated_user
 
         except PyMongoError as e:
             raise RuntimeError(f"Failed to update user '{email}': {e}")
 
-    def _dict_to_user(self, data: dict) -> User:
-        games: dict[str, Game] = {
-            title: Game.from_dict(title, g)
-            for title, g in data.get("games", {}).items()
-        }
-
-        return User(
-            name=data["name"],
-            email=data["email"],
-            password=data["password"],
-            street_address=data["street_address"],
-            games=games
-        )
+    def _dict_to_user(self, data: dict) -> User | None:
+        if data.get("missing"):
+            return None
 
+        return User.from_dict(data)
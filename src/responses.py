@@ -0,0 +1,12 @@
+import typing
+
+import orjson
+
+from fastapi.responses import JSONResponse
+
+# NOTE: Renders with orjson rather than the stdlib json. It's the app's default response class, and
+# handlers return it directly (rather than a dict) so FastAPI's jsonable_encoder pass is skipped too.
+# Content that's already JSON can be spliced in as an `orjson.Fragment` without being decoded
+class FastJSONResponse(JSONResponse):
+    def render(self, content: typing.Any) -> bytes:
+        return orjson.dumps(content)
@@ -0,0 +1,71 @@
+# The request metrics middleware keeps the latency histogram's series count bounded no matter how
+# many distinct ids the API is hit with. Runs against a bare app, no Mongo, Redis or Kafka needed.
+#
+# Usage: python -m pytest tests
+
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from middleware import request_metrics
+from middleware.request_metrics import init_metrics, request_latency_histo
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+def make_client() -> TestClient:
+    app: FastAPI = FastAPI()
+    app.middleware("http")(init_metrics)
+
+    @app.post("/api/trades/accept/{trade_id}")
+    async def accept_trade_offer(trade_id: str) -> dict:
+        return {"trade_id": trade_id}
+
+    return TestClient(app)
+
+def latency_label_sets() -> set[tuple[str, str, str]]:
+    return {
+        (sample.labels["method"], sample.labels["endpoint"], sample.labels["status"])
+        for metric in request_latency_histo.collect()
+        for sample in metric.samples
+        if sample.name == "api_request_latency_s_count"
+    }
+
+def test_series_count_constant_across_trade_ids() -> None:
+    client: TestClient = make_client()
+
+    client.post(f"/api/trades/accept/{uuid.uuid4()}")
+    client.get(f"/api/nowhere/{uuid.uuid4()}")
+    before: set[tuple[str, str, str]] = latency_label_sets()
+
+    for _ in range(10_000):
+        assert client.post(f"/api/trades/accept/{uuid.uuid4()}").status_code == 200
+
+    for _ in range(1_000):
+        assert client.get(f"/api/nowhere/{uuid.uuid4()}").status_code == 404
+
+    after: set[tuple[str, str, str]] = latency_label_sets()
+
+    assert after == before
+    assert ("POST", "/api/trades/accept/{trade_id}", "200") in after
+    assert ("GET", request_metrics.UNMATCHED_ENDPOINT_LABEL, "404") in after
+
+def test_unknown_routes_past_the_cap_share_one_label() -> None:
+    app: FastAPI = FastAPI()
+    app.middleware("http")(init_metrics)
+
+    routes: int = request_metrics.MAX_ENDPOINT_LABELS + 10
+    for seq in range(routes):
+        app.add_api_route(f"/api/generated/{seq}/{{item_id}}", lambda item_id: None, methods=["PUT"])
+
+    client: TestClient = TestClient(app)
+    for seq in range(routes):
+        client.put(f"/api/generated/{seq}/{uuid.uuid4()}")
+
+    endpoints: set[str] = {endpoint for method, endpoint, _ in latency_label_sets() if method == "PUT"}
+
+    assert len(request_metrics.seen_endpoint_labels) == request_metrics.MAX_ENDPOINT_LABELS
+    assert request_metrics.OVERFLOW_ENDPOINT_LABEL in endpoints
+    assert len(endpoints) <= request_metrics.MAX_ENDPOINT_LABELS + 1